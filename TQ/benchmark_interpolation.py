@@ -0,0 +1,54 @@
+"""
+Compare nearest grid cell lookup against bilinear interpolation
+on the same GRIB2 file and positions, reporting the run time
+of each mode and the largest difference between their values.
+"""
+import argparse
+import csv
+import time
+import numpy as np
+from get_trajectory_point_forecasts import DEF_VARIABLES, parse_datetime, process_fleet_file
+
+
+def run_mode(filepath, bundle, points, mode):
+    issuance, valid_time = parse_datetime(filepath.split("/")[-1])
+    config = [filepath, bundle, DEF_VARIABLES[bundle], issuance, str(valid_time), points, mode]
+    start = time.perf_counter()
+    batch = process_fleet_file(config)
+    elapsed = time.perf_counter() - start
+    # index the values by (point, variable) for comparison
+    values = {}
+    for i, point in enumerate(batch.keys):
+        for name, long_name, value, units, dtype in batch.point_values(i):
+            values[(point, name)] = value
+    return elapsed, values
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Benchmark nearest against bilinear point extraction from a GRIB2 file"
+    )
+    parser.add_argument("filepath", type=str, help="The path to the GRIB2 file to read")
+    parser.add_argument("csvfiles", type=str, nargs="+", help="Position CSV files with latitude and longitude columns")
+    args = parser.parse_args()
+    bundle = args.filepath.split("/")[-1].split(".")[-4]
+    # every position of every input file is extracted in both modes
+    points = []
+    for filename in args.csvfiles:
+        with open(filename, "r") as csvfile:
+            for row in csv.DictReader(csvfile):
+                points.append((len(points), row["latitude"], row["longitude"]))
+    bilinear_time, bilinear = run_mode(args.filepath, bundle, points, "bilinear")
+    nearest_time, nearest = run_mode(args.filepath, bundle, points, "nearest")
+    print("Positions: {}".format(len(points)))
+    print("Bilinear:  {:.3f} s".format(bilinear_time))
+    print("Nearest:   {:.3f} s ({:.1f}x faster)".format(nearest_time, bilinear_time / max(nearest_time, 1e-9)))
+    # report the largest difference of each variable
+    for name in DEF_VARIABLES[bundle]:
+        diffs = [
+            abs(bilinear[key] - nearest[key])
+            for key in bilinear
+            if key[1] == name and key in nearest
+        ]
+        if diffs:
+            print("{:<24} max abs difference {:.4g}".format(name, np.nanmax(diffs)))
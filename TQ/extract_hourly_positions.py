@@ -1,6 +1,7 @@
 import os
 import csv
 import glob
+import argparse
 from dateutil import parser
 from datetime import datetime, timedelta
 
@@ -47,6 +48,89 @@ def get_hourly_positions(filename):
     return hourly_positions
 
 
+def get_all_positions(filename):
+    # Keep every position report, without collapsing them to one per hour,
+    # for trajectory extraction that interpolates between forecast times
+    datafile = os.path.join(os.path.dirname(__file__), filename)
+    with open(datafile) as csv_file:
+        reader = csv.DictReader(csv_file)
+        positions = {}
+        for row in reader:
+            timestamp = parser.parse(row["report_date"])
+            # later reports with the same timestamp replace earlier ones
+            positions[str(timestamp)] = row
+    # the rounded hour is still written for the nearest-hour lookup
+    for time_string, row in positions.items():
+        row["rounded_time"] = str(round_time_to_hour(parser.parse(time_string)))
+    return positions
+
+
+def stream_reports(filename):
+    # Yield the position reports of a CSV file one row at a time
+    with open(filename) as csv_file:
+        for row in csv.DictReader(csv_file):
+            yield row
+
+
+def stream_hourly_positions(reports, max_delay=timedelta(hours=1)):
+    # Streaming version of `get_hourly_positions` for reports in time order,
+    # yielding the report closest to each hour with its "rounded_time" set.
+    # An hour is yielded once a report more than `max_delay` after the end
+    # of the hour has been seen, so reports may arrive up to `max_delay`
+    # out of order, and later reports for an hour already yielded are dropped.
+    window = timedelta(minutes=30) + max_delay
+    pending = {}
+    latest = None
+    for row in reports:
+        timestamp = parser.parse(row["report_date"])
+        rounded_time = round_time_to_hour(timestamp)
+        time_string = str(rounded_time)
+        # drop reports for hours that were already yielded
+        if latest is not None and latest - rounded_time > window:
+            continue
+        # keep the report closest to the rounded hour, the first one on ties
+        if time_string not in pending or abs(timestamp - rounded_time) < abs(
+            pending[time_string][1] - rounded_time
+        ):
+            pending[time_string] = (row, timestamp, rounded_time)
+        latest = timestamp if latest is None else max(latest, timestamp)
+        # yield the hours that no later report can round to anymore
+        for time_string in list(pending):
+            row, timestamp, rounded_time = pending[time_string]
+            if latest - rounded_time > window:
+                del pending[time_string]
+                row["rounded_time"] = time_string
+                yield row
+    for time_string, (row, timestamp, rounded_time) in pending.items():
+        row["rounded_time"] = time_string
+        yield row
+
+
+def stream_all_positions(reports, max_delay=timedelta(hours=1)):
+    # Streaming version of `get_all_positions` for reports in time order,
+    # yielding every report with its "rounded_time" set.
+    # Later reports with the same timestamp replace earlier ones
+    # until the timestamp is more than `max_delay` old, and are dropped after.
+    pending = {}
+    latest = None
+    for row in reports:
+        timestamp = parser.parse(row["report_date"])
+        # drop reports for timestamps that were already yielded
+        if latest is not None and latest - timestamp > max_delay:
+            continue
+        pending[str(timestamp)] = (row, timestamp)
+        latest = timestamp if latest is None else max(latest, timestamp)
+        for time_string in list(pending):
+            row, timestamp = pending[time_string]
+            if latest - timestamp > max_delay:
+                del pending[time_string]
+                row["rounded_time"] = str(round_time_to_hour(timestamp))
+                yield row
+    for time_string, (row, timestamp) in pending.items():
+        row["rounded_time"] = str(round_time_to_hour(timestamp))
+        yield row
+
+
 def write_output(filename, hourly_positions):
     outname = filename.split("/")[-1]
     with open("hourly-positions-" + outname, "w") as outfile:
@@ -55,15 +139,27 @@ def write_output(filename, hourly_positions):
         # write the header first
         writer.writeheader()
         for rounded_time, data in hourly_positions.items():
-            data["rounded_time"] = rounded_time
+            if "rounded_time" not in data:
+                data["rounded_time"] = rounded_time
             # write the data to a new CSV row
             writer.writerow(data)
 
 
 if __name__ == "__main__":
+    argparser = argparse.ArgumentParser()
+    argparser.add_argument(
+        "--all-positions",
+        action="store_true",
+        help="keep every position report instead of the one closest to each hour",
+    )
+    args = argparser.parse_args()
     filenames = glob.glob("position_data/*.csv")
     for filename in filenames:
-        # replace all timestamps with a rounded hourly timestamp
-        hourly_positions = get_hourly_positions(filename)
+        if args.all_positions:
+            # keep the exact timestamps for temporal interpolation
+            hourly_positions = get_all_positions(filename)
+        else:
+            # replace all timestamps with a rounded hourly timestamp
+            hourly_positions = get_hourly_positions(filename)
         # write new data to CSV
         write_output(filename, hourly_positions)
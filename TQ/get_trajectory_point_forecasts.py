@@ -4,20 +4,43 @@ extract point values from GRIB files corresponding to the same time,
 and export result into a new CSV.
 
 Bilinear interpolation is performed on the data to obtain the point values if
-the chosen location is not one of the grid points from the forecast fields.
+the chosen location is not one of the grid points from the forecast fields,
+unless `--interpolation-mode nearest` is given, in which case the value of the
+nearest grid cell is used.
+With `--interpolate`, the values are also interpolated linearly in time
+between the two forecast files bracketing each position's report time.
+With `--wide`, the CSV has one row per time and position with a column
+for each variable, instead of one row per value.
 """
 from __future__ import print_function
-from datetime import datetime, timedelta
+from datetime import datetime, timedelta, timezone
 from pathlib import Path
+import argparse
+import bisect
 import csv
+import glob
+import os
+import sys
 import Nio
 import multiprocessing
+import numpy as np
+import dateutil.parser
+
+dir_path = os.path.dirname(os.path.realpath(__file__))
+sys.path.append(os.path.join(dir_path, os.pardir))
+from utils_cube import CubeStore
+from utils_grib_index import open_subset
+from utils_derived import available
+from utils_workqueue import DEFAULT_STALE, run_jobs
+from grid_lookup import GridLookup
+from point_cache import PointCache, round_position
+from point_batch import PointBatch, WideTable, interpolate_values
 
 
 # set up multiprocessing, which drastically reduces script runtime
-def process_all_files(configs):
+def process_all_files(configs, func):
     with multiprocessing.Pool(len(configs), initializer=None) as pool:
-        rows = pool.map(process_file, configs)
+        rows = pool.map(func, configs)
         return rows
 
 
@@ -44,19 +67,9 @@ DEF_VARIABLES = {
     ],
 }
 
-# Build a dictionary row object for the output CSV
-def create_row(issuance, time, lat, lon, name, long_name, value, units, bundle):
-    return {
-        "Forecast Issuance": issuance,
-        "Valid Time": time,
-        "Latitude": lat,
-        "Longitude": lon,
-        "Variable": name,
-        "Name": long_name,
-        "Value": value,
-        "Units": units,
-        "Bundle": bundle,
-    }
+# Name the output file of an input position CSV, in the same directory
+def output_filename(filename):
+    return os.path.join(os.path.dirname(filename), "nwp-" + os.path.basename(filename))
 
 
 # Write the data to an output CSV file
@@ -73,12 +86,27 @@ def write_output(filename, data):
         "Units",
         "Bundle",
     ]
-    # Write the extracted data to the output CSV
-    with open("nwp-" + filename, "w") as outfile:
-        writer = csv.DictWriter(outfile, fieldnames=headers)
-        writer.writeheader()
-        for rows in data:
-            writer.writerows(rows)
+    # Write the extracted data to the output CSV,
+    # expanding each batch of values into one row per value
+    with open(output_filename(filename), "w") as outfile:
+        writer = csv.writer(outfile)
+        writer.writerow(headers)
+        for batch in data:
+            writer.writerows(batch.rows())
+
+
+# Write the data to an output CSV file in wide format:
+# one row per forecast issuance, valid time and position,
+# with a column for each variable of every bundle
+def write_wide_output(filename, data, variables):
+    table = WideTable(variables)
+    for batch in data:
+        table.add(batch)
+    headers = ["Forecast Issuance", "Valid Time", "Latitude", "Longitude"] + table.variables
+    with open(output_filename(filename), "w") as outfile:
+        writer = csv.writer(outfile)
+        writer.writerow(headers)
+        writer.writerows(table.rows())
 
 
 # Parse the datetime out of a grib2 filename,
@@ -103,45 +131,353 @@ def parse_datetime(filename):
     return issuance_dt, valid_dt
 
 
-# Extract data from a grib2 file at multiple point locations
-# and return an array of dictionary row objects
-def process_file(config):
+# Grid lookups already built in this process, keyed by the grid axes
+GRID_LOOKUPS = {}
+
+
+# Extract all variables at many points from an open Nio file into one batch.
+# In nearest mode each field is read once and all points are gathered
+# in one indexing operation, otherwise each point is interpolated by PyNIO.
+def extract_batch(nc, bundle, variables, issuance, time, points, mode="bilinear"):
+    batch = PointBatch.for_variables(bundle, issuance, time, points, variables)
+    if mode == "nearest":
+        lats = nc.variables["lat_0"][:]
+        lons = nc.variables["lon_0"][:]
+        key = (lats.tobytes(), lons.tobytes())
+        if key not in GRID_LOOKUPS:
+            GRID_LOOKUPS[key] = GridLookup(lats, lons)
+        point_lats = np.array([float(lat) for point, lat, lon in points])
+        point_lons = np.array([float(lon) for point, lat, lon in points])
+        rows, cols = GRID_LOOKUPS[key].indices(point_lats, point_lons)
+    for c, name in enumerate(variables):
+        if name not in nc.variables:
+            continue
+        var = nc.variables[name]
+        if mode == "nearest":
+            values = var[:][rows, cols]
+        else:
+            # the selection of a point may be a scalar or a one-element array,
+            # which are flattened into one value per point in the source dtype
+            values = np.concatenate(
+                [np.ravel(var["lat_0|{lat}i lon_0|{lon}i".format(lat=lat, lon=lon)]) for point, lat, lon in points]
+            )
+        batch.values[:, c] = values
+        batch.set_metadata(c, var.attributes["long_name"], var.attributes["units"], values.dtype)
+    # derive wind and current speed and direction for all points at once
+    return batch.derive()
+
+
+# Extract data from a grib2 file at the positions of many vessels
+# and return a batch of values with one row per position
+def process_fleet_file(config):
     # unpack the config for processing
     filename = config[0]
     bundle = config[1]
     variables = config[2]
     issuance = config[3]
     time = config[4]
-    lat = config[5]
-    lon = config[6]
-    print("Processing", filename)
-    nc = Nio.open_file(filename, mode="r", format="grib")
-    # initialize output data
-    rows = []
-    # Use PyNio's extended selection to do the interpolation for us.
-    # https://www.pyngl.ucar.edu/NioExtendedSelection.shtml
-    # Here all variables are 2-D. If 3-D (or higher dimension) fields will be extracted
-    # the pattern will need to be adjusted.
-    select = "lat_0|{lat}i lon_0|{lon}i".format(lat=lat, lon=lon)
-    # Iterate through variables to collect the data
-    for name in variables:
-        if name in nc.variables:
-            var = nc.variables[name]
-            value = var[select]
-            units = var.attributes["units"]
-            lname = var.attributes["long_name"]
-            # Append a single row of data for this variable
-            rows.append(
-                create_row(issuance, time, lat, lon, name, lname, value, units, bundle)
+    points = config[5]
+    mode = config[6] if len(config) > 6 else "bilinear"
+    print("Processing", filename, "for", len(points), "positions")
+    # The file is opened once for every position that shares its valid time
+    with open_subset(filename, variables) as subset:
+        nc = Nio.open_file(subset, mode="r", format="grib")
+        batch = extract_batch(nc, bundle, variables, issuance, time, points, mode)
+        nc.close()
+    return batch
+
+
+# Read the position rows of each vessel's CSV file,
+# returning (vessel, rows) pairs keyed by the filename
+def read_tracks(csvfiles):
+    tracks = []
+    for vessel in csvfiles:
+        with open(vessel, "r") as csvfile:
+            tracks.append((vessel, list(csv.DictReader(csvfile))))
+    return tracks
+
+
+# Group the positions of all vessels by (bundle, valid time),
+# creating one config per GRIB2 file with every position it serves
+def build_fleet_configs(csvfiles, bundles, filenames, mode="bilinear"):
+    return group_fleet_positions(read_tracks(csvfiles), bundles, filenames, mode)
+
+
+# Group the position rows of (vessel, rows) pairs by GRIB2 file
+def group_fleet_positions(tracks, bundles, filenames, mode="bilinear"):
+    groups = {}
+    for vessel, rows in tracks:
+        # iterate through each of the bundles
+        for bundle in bundles:
+            for row in rows:
+                # cut the timezone out of the timestamp
+                rounded_time = row["rounded_time"].split("+")[0]
+                # create the lookup key to find the correct GRIB2 file
+                lookup_key = bundle + rounded_time
+                # skip positions without a GRIB2 file for their hourly timestamp
+                if lookup_key not in filenames:
+                    continue
+                if lookup_key not in groups:
+                    details = filenames[lookup_key]
+                    groups[lookup_key] = [
+                        details["filepath"],
+                        bundle,
+                        DEF_VARIABLES[bundle],
+                        details["issuance"],
+                        rounded_time,
+                        [],
+                        mode,
+                    ]
+                groups[lookup_key][5].append((vessel, row["latitude"], row["longitude"]))
+    # sort by bundle, then time, to keep the per-vessel output in order
+    configs = list(groups.values())
+    configs.sort(key=lambda c: (bundles.index(c[1]), c[4]))
+    return configs
+
+
+# Look up the unique positions of each config in the point cache,
+# returning the cached values of each config and one extraction task
+# per GRIB2 file with the positions that are not cached
+def schedule_fleet(configs, cache=None):
+    # the extracted batch and its row, or the cached values,
+    # of each unique position of each config
+    resolved = [{} for config in configs]
+    tasks = []
+    for c, config in enumerate(configs):
+        filename = config[0]
+        mode = config[6] if len(config) > 6 else "bilinear"
+        unique = {}
+        for vessel, lat, lon in config[5]:
+            position = round_position(lat, lon)
+            if position in resolved[c] or position in unique:
+                continue
+            values = cache.get(filename, position, mode) if cache else None
+            if values is not None:
+                resolved[c][position] = values
+            else:
+                unique[position] = (position, lat, lon)
+        if unique:
+            task = list(config)
+            task[5] = list(unique.values())
+            tasks.append((c, task))
+    return resolved, tasks
+
+
+# Record the extracted batches of some of the tasks,
+# and store their values in the point cache
+def collect_fleet(resolved, tasks, results, cache=None):
+    for (c, task), batch in zip(tasks, results):
+        mode = task[6] if len(task) > 6 else "bilinear"
+        for row, position in enumerate(batch.keys):
+            resolved[c][position] = (batch, row)
+            if cache:
+                cache.put(task[0], position, mode, batch.point_values(row))
+
+
+# Fan the values back out to every requesting position,
+# as one batch per vessel and file
+def scatter_fleet(configs, resolved):
+    output_data = {}
+    for c, config in enumerate(configs):
+        points = config[5]
+        batch = PointBatch.for_variables(config[1], config[3], config[4], points, config[2])
+        vessels = {}
+        for row, (vessel, lat, lon) in enumerate(points):
+            entry = resolved[c][round_position(lat, lon)]
+            if isinstance(entry, tuple):
+                source, source_row = entry
+                batch.values[row] = source.values[source_row]
+                for column, name in enumerate(source.long_names):
+                    if name is not None:
+                        batch.set_metadata(column, name, source.units[column], source.dtypes[column])
+            else:
+                batch.set_point_values(row, entry)
+            vessels.setdefault(vessel, []).append(row)
+        for vessel, rows in vessels.items():
+            output_data.setdefault(vessel, []).append(batch.take(rows))
+    return output_data
+
+
+# Process every GRIB2 file of the fleet once
+# and scatter the values back to each vessel, as one batch per vessel and file.
+# Repeated positions within a file are looked up once, and positions
+# found in the point cache are not scheduled at all.
+# The files are processed by the given pool if any, otherwise
+# by a new pool for every chunk of `n` files.
+def process_fleet(configs, n=50, cache=None, queue=None, workers=0, stale=DEFAULT_STALE, pool=None):
+    resolved, tasks = schedule_fleet(configs, cache)
+    # extract the remaining positions, one task per GRIB2 file,
+    # through a work queue shared with other nodes if one is given,
+    # whose workers import this module from its own directory
+    if queue:
+        chunks = [tasks]
+    else:
+        chunks = split_array_into_chunks(tasks, n)
+    i = 0
+    for chunk in chunks:
+        if queue:
+            results = run_jobs(
+                queue,
+                "get_trajectory_point_forecasts:process_fleet_file",
+                [task for c, task in chunk],
+                workers,
+                stale=stale,
+                path=[dir_path],
+            )
+        elif pool:
+            results = pool.map(process_fleet_file, [task for c, task in chunk])
+        else:
+            results = process_all_files([task for c, task in chunk], process_fleet_file)
+        collect_fleet(resolved, chunk, results, cache)
+        print("Finished batch {}/{}".format(i, int(len(tasks) / n)))
+        i += 1
+    return scatter_fleet(configs, resolved)
+
+
+# Sort the valid times of the GRIB2 files of each bundle,
+# returning the sorted times and their lookup keys per bundle
+def get_bundle_times(filenames):
+    times = {}
+    for lookup_key, details in filenames.items():
+        bundle = details["filename"].split(".")[-4]
+        valid_dt = parse_datetime(details["filename"])[1]
+        times.setdefault(bundle, []).append((valid_dt, lookup_key))
+    for bundle in times:
+        times[bundle].sort()
+        times[bundle] = ([t for t, k in times[bundle]], [k for t, k in times[bundle]])
+    return times
+
+
+# Find the GRIB2 files whose valid times bracket the given time,
+# returning (lookup key, weight) pairs, or None if the time is out of range
+def find_bracket(valid_times, keys, time):
+    i = bisect.bisect_left(valid_times, time)
+    if i < len(valid_times) and valid_times[i] == time:
+        return [(keys[i], 1.0)]
+    if i == 0 or i == len(valid_times):
+        return None
+    t0 = valid_times[i - 1]
+    t1 = valid_times[i]
+    weight = (time - t0).total_seconds() / (t1 - t0).total_seconds()
+    return [(keys[i - 1], 1.0 - weight), (keys[i], weight)]
+
+
+# Group the positions of all vessels by the GRIB2 files bracketing their
+# report times, so each file is read once for every position that needs it.
+# Returns the file configs and a plan with the files and weights of each point.
+def build_interpolated_configs(csvfiles, bundles, filenames, mode="bilinear"):
+    return group_interpolated_positions(read_tracks(csvfiles), bundles, filenames, mode)
+
+
+# Group the position rows of (vessel, rows) pairs by bracketing GRIB2 files
+def group_interpolated_positions(tracks, bundles, filenames, mode="bilinear", times=None):
+    times = times or get_bundle_times(filenames)
+    groups = {}
+    plan = []
+    for vessel, rows in tracks:
+        for bundle in bundles:
+            if bundle not in times:
+                continue
+            valid_times, keys = times[bundle]
+            for row in rows:
+                # convert the exact report time to naive UTC
+                report_time = dateutil.parser.parse(row["report_date"])
+                if report_time.tzinfo is not None:
+                    report_time = report_time.astimezone(timezone.utc).replace(tzinfo=None)
+                bracket = find_bracket(valid_times, keys, report_time)
+                # skip positions outside of the forecast time range
+                if bracket is None:
+                    continue
+                point = len(plan)
+                plan.append((vessel, bundle, str(report_time), bracket))
+                for lookup_key, weight in bracket:
+                    if lookup_key not in groups:
+                        details = filenames[lookup_key]
+                        groups[lookup_key] = [
+                            details["filepath"],
+                            bundle,
+                            DEF_VARIABLES[bundle],
+                            details["issuance"],
+                            lookup_key[len(bundle):],
+                            [],
+                            mode,
+                        ]
+                    groups[lookup_key][5].append((point, row["latitude"], row["longitude"]))
+    configs = list(groups.values())
+    configs.sort(key=lambda c: (bundles.index(c[1]), c[4]))
+    return configs, plan
+
+
+# Process every GRIB2 file bracketing the fleet's positions once,
+# then interpolate each position in time and scatter it back to its vessel
+def process_interpolated(configs, plan, n=50, cache=None, queue=None, workers=0, stale=DEFAULT_STALE, pool=None):
+    return interpolate_plan(plan, process_fleet(configs, n, cache, queue, workers, stale, pool))
+
+
+# Interpolate each position of the plan in time between the batches
+# of its bracketing files, returned by `process_fleet` per point
+def interpolate_plan(plan, by_point):
+    output_data = {}
+    for point, (vessel, bundle, time, bracket) in enumerate(plan):
+        # index the batch of each bracketing file by its valid time
+        file_batches = {batch.time: batch for batch in by_point.get(point, [])}
+        valid_times = [lookup_key[len(bundle):] for lookup_key, weight in bracket]
+        if any(t not in file_batches for t in valid_times):
+            continue
+        batch0 = file_batches[valid_times[0]]
+        if len(bracket) == 1:
+            # copy the batch, which may be shared with other points
+            batch = batch0.take(range(len(batch0)))
+        else:
+            batch1 = file_batches[valid_times[1]]
+            values = interpolate_values(
+                batch0.values, batch1.values, bracket[0][1], bracket[1][1], batch0.units
+            )
+            # only variables found in both files are kept
+            long_names = [
+                name if other is not None else None
+                for name, other in zip(batch0.long_names, batch1.long_names)
+            ]
+            batch = PointBatch(
+                bundle,
+                batch0.issuance,
+                time,
+                batch0.keys,
+                batch0.lats,
+                batch0.lons,
+                batch0.variables,
+                long_names,
+                batch0.units,
+                values,
             )
-        # else:
-        #     # Variable name was not found
-        #     # so indicate in the output that data is missing
-        #     value = units = lname = "Missing"
-        # # Append a single row of data for this variable
-        # rows.append(create_row(issuance, time, lat, lon, name, lname, value, units))
-    nc.close()
-    return rows
+            # derived variables are computed from the interpolated values
+            batch.derive()
+        batch.keys = [vessel]
+        output_data.setdefault(vessel, []).append(batch)
+    return output_data
+
+
+# Append the extracted data of one vessel to a chunked time-series store,
+# using the vessel's input filename as the station name
+def append_to_cube(cube, station, data):
+    # Gather the values of each forecast file by issuance and valid time.
+    # The station holds one position per time, so of several points
+    # with the same valid time the last one is kept, with its own position.
+    steps = {}
+    for batch in data:
+        key = (batch.issuance, batch.time)
+        for i in range(len(batch)):
+            steps[key] = {
+                "latitude": [float(batch.lats[i])],
+                "longitude": [float(batch.lons[i])],
+            }
+            for name, long_name, value, units, dtype in batch.point_values(i):
+                steps[key][name] = [value]
+    # Write one lead time at a time
+    for (issuance, time), values in steps.items():
+        valid_dt = dateutil.parser.parse(time)
+        lead = int((valid_dt - issuance).total_seconds() // 3600)
+        cube.append(issuance, lead, [station], values)
 
 
 def get_grib2_filenames():
@@ -169,75 +505,107 @@ def split_array_into_chunks(array, n):
 
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "csvfiles",
+        nargs="*",
+        help="hourly position CSV files, one per vessel (default: hourly-positions-*.csv)",
+    )
+    parser.add_argument(
+        "--interpolate",
+        action="store_true",
+        help="interpolate in time between the forecast files bracketing each report time",
+    )
+    parser.add_argument(
+        "--interpolation-mode",
+        choices=["bilinear", "nearest"],
+        default="bilinear",
+        help="bilinear interpolation between grid points, or the value of the nearest grid cell",
+    )
+    parser.add_argument(
+        "--point-cache",
+        default=None,
+        help="JSON file caching extracted point values across runs",
+    )
+    parser.add_argument(
+        "--point-cache-size",
+        type=int,
+        default=100000,
+        help="maximum number of (file, position) entries kept in the point cache",
+    )
+    parser.add_argument(
+        "--queue",
+        default=None,
+        help="queue directory on a shared filesystem, to share the GRIB2 files with workers on other nodes",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=0,
+        help="number of local worker processes to start on the queue",
+    )
+    parser.add_argument(
+        "--stale",
+        type=float,
+        default=DEFAULT_STALE,
+        help="seconds after which a unit claimed by a worker that died is queued again",
+    )
+    parser.add_argument(
+        "--wide",
+        action="store_true",
+        help="write one row per time and position with a column per variable, instead of one row per value",
+    )
+    parser.add_argument(
+        "--cube",
+        default=None,
+        help="directory of a chunked store to append the extracted values to (not with --interpolate)",
+    )
+    args = parser.parse_args()
+    # The store has one slot per whole lead hour, while interpolated
+    # positions fall anywhere between two lead files
+    if args.cube and args.interpolate:
+        parser.error("--cube cannot be combined with --interpolate")
     # Specify the weather bundles of interest
     bundles = ["basic", "maritime"]
+    # List the extracted and derived variables of all bundles
+    variables = []
+    for bundle in bundles:
+        variables += DEF_VARIABLES[bundle]
+        variables += available(DEF_VARIABLES[bundle])
+    # Open the chunked time-series store
+    if args.cube:
+        cube = CubeStore(args.cube, variables=["latitude", "longitude"] + variables)
     # Specify input position data files
-    csvfiles = ["hourly-positions-nienburg.csv", "hourly-positions-niteroi.csv"]
+    csvfiles = args.csvfiles or sorted(glob.glob("hourly-positions-*.csv"))
     # Create the filenames object
     filenames = get_grib2_filenames()
-    # iterate through the input CSV files
+    ############################################
+    ############################################
+    # if your computer is freaking out, reduce this number
+    # to decrease the number of processes running at the same time
+    n = 50
+    ############################################
+    ############################################
+    # Collapse repeated lookups, across runs if a cache file is given
+    cache = PointCache(args.point_cache, args.point_cache_size)
+    if args.interpolate:
+        # Group the positions of the whole fleet by bracketing GRIB2 files
+        configs, plan = build_interpolated_configs(
+            csvfiles, bundles, filenames, args.interpolation_mode
+        )
+        OUTPUT_DATA = process_interpolated(configs, plan, n, cache, args.queue, args.workers, args.stale)
+    else:
+        # Group the positions of the whole fleet by GRIB2 file
+        configs = build_fleet_configs(csvfiles, bundles, filenames, args.interpolation_mode)
+        OUTPUT_DATA = process_fleet(configs, n, cache, args.queue, args.workers, args.stale)
+    cache.save()
+    print("Point cache: {} hits, {} misses".format(cache.hits, cache.misses))
     for filename in csvfiles:
-        # initialize the configs array
-        configs = []
-        # open the CSV input file
-        with open(filename, "r") as csvfile:
-            reader = csv.DictReader(csvfile)
-            # unpack the DictReader contents first
-            # so we can iterate through the rows twice,
-            # (one time per bundle)
-            rows = []
-            for row in reader:
-                rows.append(row)
-            # iterate through each of the bundles
-            for bundle in bundles:
-                # get the variable names for this bundle
-                variables = DEF_VARIABLES[bundle]
-                # iterate through each row of this input CSV
-                for row in rows:
-                    # unpack the input data
-                    lat = row["latitude"]
-                    lon = row["longitude"]
-                    original_time = row["report_date"]
-                    # cut the timezone out of the timestamp
-                    rounded_time = row["rounded_time"].split("+")[0]
-                    # create the lookup key to find the correct GRIB2 file
-                    lookup_key = bundle + rounded_time
-                    # check if we have a GRIB2 file that corresponds
-                    # to the hourly timestamp of this position update
-                    if lookup_key in filenames:
-                        details = filenames[lookup_key]
-                        # extract weather data for this point
-                        config = [
-                            details["filepath"],
-                            bundle,
-                            variables,
-                            details["issuance"],
-                            rounded_time,
-                            lat,
-                            lon,
-                        ]
-                        # store the weather data for this location
-                        # in our final output data object
-                        configs.append(config)
-            # initialize output data object
-            OUTPUT_DATA = []
-            # split the configs to avoid opening too many files at once
-            # which results in the OS throwing an error
-            ############################################
-            ############################################
-            # if your computer is freaking out, reduce this number
-            # to decrease the number of processes running at the same time
-            n = 50
-            ############################################
-            ############################################
-            chunks = split_array_into_chunks(configs, n)
-            # process each batch of files,
-            # appending to OUTPUT_DATA along the way
-            i = 0
-            for c in chunks:
-                partial_data = process_all_files(c)
-                OUTPUT_DATA += partial_data
-                print("Finished batch {}/{}".format(i, int(len(configs) / n)))
-                i += 1
-            # write the output data to a CSV
-            write_output(filename, OUTPUT_DATA)
+        # write the output data of this vessel to a CSV
+        if args.wide:
+            write_wide_output(filename, OUTPUT_DATA.get(filename, []), variables)
+        else:
+            write_output(filename, OUTPUT_DATA.get(filename, []))
+        # append the output data to the chunked store
+        if args.cube:
+            append_to_cube(cube, filename, OUTPUT_DATA.get(filename, []))
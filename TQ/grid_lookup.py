@@ -0,0 +1,103 @@
+"""
+Nearest grid cell lookup for batches of lat/lon points
+
+On a regular lat/lon grid such as GLL0, the nearest cell of every point
+is found with plain arithmetic on the axes. Irregular grids fall back to
+a KD-tree (scipy, if installed) or a brute-force search. Either way all
+points are gathered from a field in one indexing operation.
+"""
+import numpy as np
+
+
+def _regular_step(axis):
+    # Return the constant step of an axis, or None if it is not regular
+    if len(axis) < 2:
+        return None
+    steps = np.diff(axis)
+    if np.allclose(steps, steps[0]):
+        return steps[0]
+    return None
+
+
+class GridLookup(object):
+    """ Maps lat/lon points to the indices of their nearest grid cells """
+
+    def __init__(self, lats, lons):
+        self.lats = np.asarray(lats, dtype=float)
+        self.lons = np.asarray(lons, dtype=float)
+        self.regular = self.lats.ndim == 1 and self.lons.ndim == 1
+        if self.regular:
+            self.dlat = _regular_step(self.lats)
+            self.dlon = _regular_step(self.lons)
+            self.regular = self.dlat is not None and self.dlon is not None
+        if self.regular:
+            # a global longitude axis wraps around at 360 degrees
+            self.wrap = abs(self.dlon * len(self.lons) - 360) < 1e-6
+        else:
+            self._build_tree()
+
+    def _build_tree(self):
+        # Index every grid point by its position on the unit sphere,
+        # so that straight-line distance orders points like great-circle distance
+        lats = self.lats
+        lons = self.lons
+        if lats.ndim == 1 and lons.ndim == 1:
+            lons, lats = np.meshgrid(lons, lats)
+        self.shape = lats.shape
+        self.xyz = _to_xyz(lats.ravel(), lons.ravel())
+        try:
+            from scipy.spatial import cKDTree
+            self.tree = cKDTree(self.xyz)
+        except ImportError:
+            self.tree = None
+
+    def indices(self, lat, lon):
+        """
+        Return the (row, column) index arrays of the nearest grid cells
+        """
+        lat = np.asarray(lat, dtype=float)
+        lon = np.asarray(lon, dtype=float)
+        if self.regular:
+            rows = np.rint((lat - self.lats[0]) / self.dlat).astype(np.int64)
+            rows = np.clip(rows, 0, len(self.lats) - 1)
+            if self.wrap:
+                # bring the longitudes into the range of the axis
+                lon = self.lons[0] + np.mod(lon - self.lons[0], 360)
+                cols = np.rint((lon - self.lons[0]) / self.dlon).astype(np.int64)
+                cols = np.mod(cols, len(self.lons))
+            else:
+                # use the longitude within 180 degrees of the middle of a
+                # regional axis, so points outside of it clip to the nearer edge
+                middle = (self.lons[0] + self.lons[-1]) / 2
+                lon = middle + np.mod(lon - middle + 180, 360) - 180
+                cols = np.rint((lon - self.lons[0]) / self.dlon).astype(np.int64)
+                cols = np.clip(cols, 0, len(self.lons) - 1)
+            return rows, cols
+        points = _to_xyz(lat.ravel(), lon.ravel())
+        if self.tree is not None:
+            flat = self.tree.query(points)[1]
+        else:
+            # brute force, in chunks to bound memory
+            flat = np.empty(len(points), dtype=np.int64)
+            for start in range(0, len(points), 256):
+                chunk = points[start:start + 256]
+                dist = ((chunk[:, None, :] - self.xyz[None, :, :]) ** 2).sum(axis=2)
+                flat[start:start + 256] = np.argmin(dist, axis=1)
+        return np.unravel_index(flat, self.shape)
+
+    def gather(self, field, lat, lon):
+        """
+        Return the values of a 2-D field at the nearest grid cells of the points
+        """
+        rows, cols = self.indices(lat, lon)
+        return np.asarray(field)[rows, cols]
+
+
+def _to_xyz(lats, lons):
+    lats = np.radians(lats)
+    lons = np.radians(lons)
+    return np.column_stack([
+        np.cos(lats) * np.cos(lons),
+        np.cos(lats) * np.sin(lons),
+        np.sin(lats),
+    ])
@@ -0,0 +1,237 @@
+"""
+Columnar batches of point forecast values
+
+A batch holds the values of every variable at many points of one forecast
+file as a single (point, variable) array. The issuance, valid time and
+bundle are stored once per batch, and the variable names, long names, units
+and source data types once per column, instead of in a dictionary for
+every value.
+Batches pickle to a few arrays, which keeps the transfer from pool workers
+small, and are only expanded into CSV rows by the writer: either long-format
+rows, one per value, or through a `WideTable` one row per point and time
+with a column for every variable of every bundle.
+"""
+import os
+import sys
+import numpy as np
+
+dir_path = os.path.dirname(os.path.realpath(__file__))
+sys.path.append(os.path.join(dir_path, os.pardir))
+from utils_derived import DERIVED_VARIABLES, available, derive
+
+
+class PointBatch(object):
+    """ Values of a fixed list of variables at many points of one forecast file """
+
+    def __init__(
+        self, bundle, issuance, time, keys, lats, lons, variables, long_names=None, units=None, values=None, dtypes=None
+    ):
+        self.bundle = bundle
+        self.issuance = issuance
+        self.time = time
+        # the key of each point (vessel or position) and its coordinates,
+        # kept as the strings read from the position files
+        self.keys = list(keys)
+        self.lats = list(lats)
+        self.lons = list(lons)
+        self.variables = list(variables)
+        # None marks a variable that is not in the forecast file
+        self.long_names = list(long_names) if long_names is not None else [None] * len(self.variables)
+        self.units = list(units) if units is not None else [None] * len(self.variables)
+        # values are held as float64, and each column is written with the
+        # precision of its source, e.g. float32 for values read from GRIB2
+        self.dtypes = list(dtypes) if dtypes is not None else ["float64"] * len(self.variables)
+        if values is None:
+            values = np.full((len(self.keys), len(self.variables)), np.nan)
+        self.values = values
+
+    @classmethod
+    def for_variables(cls, bundle, issuance, time, points, variables):
+        """
+        Create an empty batch for (key, lat, lon) points, with a column for
+        each variable followed by the derived variables it allows
+        """
+        names = list(variables) + available(variables)
+        return cls(
+            bundle,
+            issuance,
+            time,
+            [key for key, lat, lon in points],
+            [lat for key, lat, lon in points],
+            [lon for key, lat, lon in points],
+            names,
+        )
+
+    def __len__(self):
+        return len(self.keys)
+
+    def set_metadata(self, column, long_name, units, dtype="float64"):
+        self.long_names[column] = long_name
+        self.units[column] = units
+        self.dtypes[column] = str(np.dtype(dtype))
+
+    def derive(self):
+        """
+        Compute the derived variable columns from their input columns,
+        for all points at once
+        """
+        columns = {name: c for c, name in enumerate(self.variables)}
+        inputs = {name: self.values[:, c] for name, c in columns.items() if self.long_names[c] is not None}
+        for name, values in derive(inputs, available(inputs)).items():
+            if name not in columns:
+                continue
+            spec = DERIVED_VARIABLES[name]
+            self.values[:, columns[name]] = values
+            self.set_metadata(columns[name], spec["long_name"], spec["units"])
+        return self
+
+    def take(self, indices):
+        """
+        Return a new batch with the points at the given indices
+        """
+        return PointBatch(
+            self.bundle,
+            self.issuance,
+            self.time,
+            [self.keys[i] for i in indices],
+            [self.lats[i] for i in indices],
+            [self.lons[i] for i in indices],
+            self.variables,
+            self.long_names,
+            self.units,
+            self.values[indices],
+            self.dtypes,
+        )
+
+    def point_values(self, i):
+        """
+        Return the [variable, long name, value, units, dtype] lists of one point,
+        leaving out variables that are not in the file
+        """
+        return [
+            [name, self.long_names[c], float(self.values[i, c]), self.units[c], self.dtypes[c]]
+            for c, name in enumerate(self.variables)
+            if self.long_names[c] is not None
+        ]
+
+    def set_point_values(self, i, point_values):
+        """
+        Fill one point from the output of `point_values`
+        """
+        columns = {name: c for c, name in enumerate(self.variables)}
+        for name, long_name, value, units, dtype in point_values:
+            if name in columns:
+                self.values[i, columns[name]] = value
+                self.set_metadata(columns[name], long_name, units, dtype)
+
+    def rows(self):
+        """
+        Yield the long-format CSV rows of the batch: issuance, valid time,
+        latitude, longitude, variable, long name, value, units and bundle.
+        Derived values that could not be computed are left out.
+        """
+        present = [c for c, name in enumerate(self.variables) if self.long_names[c] is not None]
+        derived = [name in DERIVED_VARIABLES for name in self.variables]
+        # format the values column by column, in the precision of their source
+        text = np.empty(self.values.shape, dtype=object)
+        for c in present:
+            text[:, c] = self.values[:, c].astype(self.dtypes[c]).astype(str)
+        for i in range(len(self.keys)):
+            for c in present:
+                if derived[c] and np.isnan(self.values[i, c]):
+                    continue
+                yield [
+                    self.issuance,
+                    self.time,
+                    self.lats[i],
+                    self.lons[i],
+                    self.variables[c],
+                    self.long_names[c],
+                    text[i, c],
+                    self.units[c],
+                    self.bundle,
+                ]
+
+
+def interpolate_values(values0, values1, weight0, weight1, units):
+    """
+    Interpolate two (point, variable) arrays linearly in time,
+    using unit vectors for directions so that they wrap around 360 degrees
+    """
+    values0 = np.asarray(values0, dtype=float)
+    values1 = np.asarray(values1, dtype=float)
+    values = weight0 * values0 + weight1 * values1
+    for c, unit in enumerate(units):
+        if unit and "degree" in unit:
+            angle0 = np.radians(values0[:, c])
+            angle1 = np.radians(values1[:, c])
+            x = weight0 * np.sin(angle0) + weight1 * np.sin(angle1)
+            y = weight0 * np.cos(angle0) + weight1 * np.cos(angle1)
+            values[:, c] = np.mod(np.degrees(np.arctan2(x, y)), 360)
+    return values
+
+
+class WideTable(object):
+    """
+    Values of many batches joined into one row per (issuance, valid time,
+    latitude, longitude), with one column per variable across bundles
+    """
+
+    def __init__(self, variables):
+        self.variables = list(variables)
+        self.columns = {name: c for c, name in enumerate(self.variables)}
+        self.dtypes = ["float64"] * len(self.variables)
+        # the row of each (issuance, valid time, latitude, longitude) key
+        self.index = {}
+        self.keys = []
+        # the (rows, columns, values) block of each batch
+        self.blocks = []
+
+    def add(self, batch):
+        """
+        Place the values of a batch in the rows of its points
+        """
+        columns = [
+            c for c, name in enumerate(batch.variables)
+            if batch.long_names[c] is not None and name in self.columns
+        ]
+        rows = []
+        for lat, lon in zip(batch.lats, batch.lons):
+            key = (str(batch.issuance), batch.time, lat, lon)
+            if key not in self.index:
+                self.index[key] = len(self.keys)
+                self.keys.append(key)
+            rows.append(self.index[key])
+        targets = [self.columns[batch.variables[c]] for c in columns]
+        for c, target in zip(columns, targets):
+            self.dtypes[target] = batch.dtypes[c]
+        self.blocks.append((rows, targets, batch.values[:, columns]))
+
+    def values(self):
+        """
+        Return the (row, variable) array of all values, NaN where missing
+        """
+        values = np.full((len(self.keys), len(self.variables)), np.nan)
+        for rows, columns, block in self.blocks:
+            values[np.ix_(rows, columns)] = block
+        return values
+
+    def rows(self):
+        """
+        Yield the wide-format CSV rows: issuance, valid time, latitude,
+        longitude and the value of each variable. As in the long format,
+        cells of variables missing from the forecast files and derived values
+        that could not be computed are left empty, while missing values
+        of extracted variables are written as nan.
+        """
+        values = self.values()
+        text = np.empty(values.shape, dtype=object)
+        for c, dtype in enumerate(self.dtypes):
+            text[:, c] = values[:, c].astype(dtype).astype(str)
+        blank = np.ones(values.shape, dtype=bool)
+        for rows, columns, block in self.blocks:
+            blank[np.ix_(rows, columns)] = False
+        derived = np.array([name in DERIVED_VARIABLES for name in self.variables], dtype=bool)
+        text[blank | (np.isnan(values) & derived)] = ""
+        for key, row in zip(self.keys, text):
+            yield list(key) + row.tolist()
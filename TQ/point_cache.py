@@ -0,0 +1,88 @@
+"""
+Bounded LRU cache of point values extracted from GRIB2 files
+
+Vessels in port report the same position for hours, and recurring port
+positions are looked up again on every run. Values are cached per
+(GRIB2 file, rounded latitude, rounded longitude, interpolation mode)
+with the value, name, units and source data type of every variable at
+that point, so that cached values are written with the same precision as
+freshly extracted ones (float32 for values read from GRIB2). The cache is
+saved to a JSON file so it persists across runs.
+"""
+import os
+import json
+from collections import OrderedDict
+
+# Number of decimals coordinates are rounded to (about 10 m)
+COORDINATE_PRECISION = 4
+# Version of the cache file format. Version 1 files were a plain list of
+# entries without the data type of the values, and are not read.
+CACHE_VERSION = 2
+
+
+def round_position(lat, lon):
+    """
+    Return the rounded (lat, lon) position used to deduplicate lookups
+    """
+    return (
+        round(float(lat), COORDINATE_PRECISION),
+        round(float(lon), COORDINATE_PRECISION),
+    )
+
+
+class PointCache(object):
+    """ LRU cache of the variables extracted at one position of one file """
+
+    def __init__(self, path=None, max_entries=100000):
+        self.path = path
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        if path and os.path.exists(path):
+            with open(path, 'r') as cachefile:
+                data = json.load(cachefile)
+            # values cached without their data type would be written in
+            # float64 precision, so older files are extracted again
+            if isinstance(data, dict) and data.get('version') == CACHE_VERSION:
+                for key, values in data['entries']:
+                    self.entries[key] = values
+
+    def _key(self, filepath, position, mode):
+        return '{}|{}|{}|{}'.format(filepath, position[0], position[1], mode)
+
+    def get(self, filepath, position, mode):
+        """
+        Return the cached [variable, long name, value, units, dtype] lists
+        of a position, or None if the position is not cached
+        """
+        key = self._key(filepath, position, mode)
+        if key not in self.entries:
+            self.misses += 1
+            return None
+        # mark the entry as the most recently used
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return self.entries[key]
+
+    def put(self, filepath, position, mode, values):
+        """
+        Store the [variable, long name, value, units, dtype] lists of a position,
+        evicting the least recently used entries beyond the size limit
+        """
+        key = self._key(filepath, position, mode)
+        self.entries[key] = values
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    def save(self):
+        """
+        Write the cache to its JSON file, in least to most recently used order
+        """
+        if not self.path:
+            return
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as cachefile:
+            json.dump({'version': CACHE_VERSION, 'entries': list(self.entries.items())}, cachefile)
+        os.replace(tmp_path, self.path)
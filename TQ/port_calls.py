@@ -0,0 +1,136 @@
+"""
+Detect port calls in streams of vessel positions.
+
+The positions of each vessel, collapsed to one per hour like in
+`extract_hourly_positions.py`, are located in the city polygons of
+`500cities/cities.shp`, or of a region store built from it with
+`build_region_store.py`, a chunk at a time through a `PolygonIndex`, and
+consecutive positions in the same city are merged into one port call,
+from the report time of the first position in the city (arrival) to that
+of the last one (departure). The calls of each vessel are written to
+`port-calls-<vessel>.csv`, so that port weather can be attached to them.
+"""
+from __future__ import print_function
+from datetime import timedelta
+from itertools import islice
+import argparse
+import csv
+import glob
+import os
+import sys
+import numpy as np
+
+dir_path = os.path.dirname(os.path.realpath(__file__))
+sys.path.append(os.path.join(dir_path, os.pardir))
+from utils_polygon import open_index
+from extract_hourly_positions import stream_reports, stream_hourly_positions, stream_all_positions
+
+# The city shapefile and the fields describing each city
+CITIES_FILE = os.path.join(dir_path, os.pardir, "500cities", "cities.shp")
+CITY_FIELDS = ("NAME", "ST")
+
+
+def tag_positions(positions, index, chunk_size=10000):
+    """
+    Yield (position, polygon) pairs for a stream of position rows, with the
+    index of the polygon containing each position or -1, locating the
+    positions of a whole chunk at once
+    """
+    positions = iter(positions)
+    while True:
+        chunk = list(islice(positions, chunk_size))
+        if not chunk:
+            return
+        lats = np.array([float(row["latitude"]) for row in chunk])
+        lons = np.array([float(row["longitude"]) for row in chunk])
+        for row, polygon in zip(chunk, index.locate(lats, lons)):
+            yield row, int(polygon)
+
+
+def detect_port_calls(tagged, index):
+    """
+    Yield a port call for every run of consecutive positions in the same
+    polygon, with the polygon's properties, the arrival and departure
+    report times and the number of positions
+    """
+    call = None
+    for row, polygon in tagged:
+        if call is not None and polygon == call[0]:
+            # still in the same port
+            call[2] = row["report_date"]
+            call[3] += 1
+            continue
+        if call is not None:
+            yield port_call(index, *call)
+        call = [polygon, row["report_date"], row["report_date"], 1] if polygon >= 0 else None
+    if call is not None:
+        yield port_call(index, *call)
+
+
+def port_call(index, polygon, arrival, departure, positions):
+    call = dict(index.properties[polygon])
+    call.update({"arrival": arrival, "departure": departure, "positions": positions})
+    return call
+
+
+def write_port_calls(filename, calls, fields):
+    """
+    Write a stream of port calls to a CSV file, returning their number
+    """
+    count = 0
+    with open(filename, "w") as outfile:
+        writer = csv.DictWriter(outfile, fieldnames=list(fields) + ["arrival", "departure", "positions"])
+        writer.writeheader()
+        for call in calls:
+            writer.writerow(call)
+            count += 1
+    return count
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "csvfiles",
+        nargs="*",
+        help="raw position report CSV files, one per vessel (default: position_data/*.csv)",
+    )
+    parser.add_argument(
+        "--cities",
+        default=CITIES_FILE,
+        help="shapefile or region store of the port city polygons",
+    )
+    parser.add_argument(
+        "--buffer",
+        type=float,
+        default=0,
+        help="distance in degrees around each city polygon still counted as in port (shapefiles only)",
+    )
+    parser.add_argument(
+        "--all-positions",
+        action="store_true",
+        help="use every position report instead of the one closest to each hour",
+    )
+    parser.add_argument(
+        "--chunk-size",
+        type=int,
+        default=10000,
+        help="number of positions located together",
+    )
+    parser.add_argument(
+        "--max-delay",
+        type=float,
+        default=1,
+        help="hours a position report may arrive out of time order",
+    )
+    args = parser.parse_args()
+    # Index the city polygons once for all vessels
+    index = open_index(args.cities, CITY_FIELDS, args.buffer)
+    for filename in args.csvfiles or sorted(glob.glob("position_data/*.csv")):
+        reports = stream_reports(filename)
+        if args.all_positions:
+            positions = stream_all_positions(reports, timedelta(hours=args.max_delay))
+        else:
+            positions = stream_hourly_positions(reports, timedelta(hours=args.max_delay))
+        calls = detect_port_calls(tag_positions(positions, index, args.chunk_size), index)
+        count = write_port_calls("port-calls-" + os.path.basename(filename), calls, CITY_FIELDS)
+        print("Found {} port calls for {}".format(count, filename))
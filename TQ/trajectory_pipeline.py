@@ -0,0 +1,384 @@
+"""
+Stream raw vessel position reports to point forecast JSON in one process.
+
+The three scripts of the trajectory workflow each write a file for the next:
+extract_hourly_positions.py -> hourly-positions-*.csv ->
+get_trajectory_point_forecasts.py -> nwp-hourly-positions-*.csv ->
+wx_csv_to_point_forecast_json.py -> nwp-hourly-positions-*.json.
+This script chains the same stages as generators instead: the reports of
+each vessel are read and collapsed to positions one row at a time, the
+positions are grouped into chunks, the forecasts of the next chunks are
+extracted by one pool of processes while the current chunk is written,
+and each point forecast is written to the sink as soon as its chunk is done. The intermediate CSV files are
+only written with `--keep-positions` and `--keep-csv`.
+
+Reports are expected in time order, as exported from the position feeds,
+allowing for reports up to `--max-delay` hours out of order.
+"""
+from __future__ import print_function
+from datetime import timedelta
+import argparse
+import collections
+import csv
+import glob
+import json
+import multiprocessing
+import os
+import sys
+
+dir_path = os.path.dirname(os.path.realpath(__file__))
+sys.path.append(os.path.join(dir_path, os.pardir))
+from utils_derived import available
+from utils_workqueue import DEFAULT_STALE
+from extract_hourly_positions import stream_reports, stream_hourly_positions, stream_all_positions
+from get_trajectory_point_forecasts import (
+    DEF_VARIABLES,
+    get_bundle_times,
+    get_grib2_filenames,
+    group_fleet_positions,
+    group_interpolated_positions,
+    collect_fleet,
+    interpolate_plan,
+    process_fleet,
+    process_fleet_file,
+    process_interpolated,
+    scatter_fleet,
+    schedule_fleet,
+)
+from point_batch import WideTable
+from point_cache import PointCache
+from wx_csv_to_point_forecast_json import convert_wide_row
+
+# The columns of a wide-format point forecast row before the variables
+KEY_HEADERS = ["Forecast Issuance", "Valid Time", "Latitude", "Longitude"]
+
+
+class JSONSink(object):
+    """ Point forecast JSON document, written one record at a time """
+
+    def __init__(self, filename):
+        self.file = open(filename, "w")
+        self.count = 0
+        # the same layout as `wx_csv_to_point_forecast_json`
+        self.head, self.tail = json.dumps({"meta": {"unit_system": "si"}, "data": []}, indent=4).split("[]")
+        self.file.write(self.head + "[")
+
+    def write(self, record):
+        text = json.dumps(record, indent=4).replace("\n", "\n        ")
+        self.file.write(("," if self.count else "") + "\n        " + text)
+        self.count += 1
+
+    def flush(self):
+        self.file.flush()
+
+    def close(self):
+        self.file.write(("\n    ]" if self.count else "]") + self.tail)
+        self.file.close()
+
+
+class JSONLinesSink(object):
+    """ One point forecast JSON record per line """
+
+    def __init__(self, filename):
+        self.file = open(filename, "w")
+
+    def write(self, record):
+        self.file.write(json.dumps(record) + "\n")
+
+    def flush(self):
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+
+SINKS = {"json": JSONSink, "jsonl": JSONLinesSink}
+
+
+def tee_csv(rows, filename, fieldnames):
+    """
+    Write position rows to a CSV file while passing them on
+    """
+    with open(filename, "w") as outfile:
+        writer = csv.DictWriter(outfile, fieldnames=fieldnames, extrasaction="ignore")
+        writer.writeheader()
+        for row in rows:
+            writer.writerow(row)
+            yield row
+
+
+def chunk_positions(positions, size):
+    """
+    Group a stream of positions into lists of up to `size` positions
+    """
+    chunk = []
+    for row in positions:
+        chunk.append(row)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+class ChunkExtractor(object):
+    """ Extract the forecasts of all bundles at a chunk of one vessel's positions """
+
+    def __init__(self, vessel, bundles, filenames, variables, mode="bilinear", interpolate=False,
+                 cache=None, queue=None, workers=0, stale=DEFAULT_STALE):
+        self.vessel = vessel
+        self.bundles = bundles
+        self.filenames = filenames
+        self.variables = variables
+        self.mode = mode
+        self.interpolate = interpolate
+        self.times = get_bundle_times(filenames) if interpolate else None
+        self.cache = cache
+        self.queue = queue
+        self.workers = workers
+        self.stale = stale
+
+    def group(self, chunk):
+        """
+        Group the positions of a chunk by GRIB2 file, returning the file
+        configs and, when interpolating, the plan of each position
+        """
+        tracks = [(self.vessel, chunk)]
+        if self.interpolate:
+            return group_interpolated_positions(tracks, self.bundles, self.filenames, self.mode, self.times)
+        return group_fleet_positions(tracks, self.bundles, self.filenames, self.mode), None
+
+    def table(self, data):
+        """
+        Join the batches of all bundles into one row per time and position
+        """
+        table = WideTable(self.variables)
+        for batch in data.get(self.vessel, []):
+            table.add(batch)
+        return table
+
+    def submit(self, chunk, pool):
+        """
+        Start extracting the positions of a chunk that are not cached
+        on the pool, returning the pending job for `finish`
+        """
+        configs, plan = self.group(chunk)
+        resolved, tasks = schedule_fleet(configs, self.cache)
+        result = pool.map_async(process_fleet_file, [task for c, task in tasks]) if tasks else None
+        return configs, plan, resolved, tasks, result
+
+    def finish(self, job):
+        """
+        Wait for a job started by `submit` and return the table of its chunk
+        """
+        configs, plan, resolved, tasks, result = job
+        # the point cache is only updated from the calling process
+        collect_fleet(resolved, tasks, result.get() if result else [], self.cache)
+        data = scatter_fleet(configs, resolved)
+        if self.interpolate:
+            data = interpolate_plan(plan, data)
+        return self.table(data)
+
+    def __call__(self, chunk):
+        """
+        Extract the positions of a chunk, through the work queue if any
+        """
+        configs, plan = self.group(chunk)
+        if self.interpolate:
+            data = process_interpolated(
+                configs, plan, cache=self.cache, queue=self.queue, workers=self.workers, stale=self.stale
+            )
+        else:
+            data = process_fleet(configs, cache=self.cache, queue=self.queue, workers=self.workers, stale=self.stale)
+        return self.table(data)
+
+
+def extract_ahead(chunks, extract, pool=None, depth=1):
+    """
+    Yield (chunk, table) pairs, with up to `depth` chunks after the
+    current one being extracted by the pool while it is written.
+    Without a pool each chunk is extracted when it is needed.
+    """
+    if pool is None:
+        for chunk in chunks:
+            yield chunk, extract(chunk)
+        return
+    pending = collections.deque()
+    for chunk in chunks:
+        pending.append((chunk, extract.submit(chunk, pool)))
+        if len(pending) > depth:
+            chunk, job = pending.popleft()
+            yield chunk, extract.finish(job)
+    while pending:
+        chunk, job = pending.popleft()
+        yield chunk, extract.finish(job)
+
+
+def run_pipeline(reports, sink, extract, chunk_size=24, depth=1, all_positions=False,
+                 max_delay=timedelta(hours=1), positions_csv=None, forecasts_csv=None, pool=None):
+    """
+    Stream the reports of one vessel through the extractor of its positions
+    to the sink, which needs `write(record)`, `flush()` and `close()` methods,
+    and return the number of point forecasts written.
+    The GRIB2 files are processed by the given pool, which is shared by
+    all vessels, or by the extractor's work queue if no pool is given.
+    """
+    if all_positions:
+        positions = stream_all_positions(reports, max_delay)
+    else:
+        positions = stream_hourly_positions(reports, max_delay)
+    if positions_csv:
+        positions = tee_csv(positions, positions_csv, ["latitude", "longitude", "report_date", "rounded_time"])
+    writer = None
+    if forecasts_csv:
+        outfile = open(forecasts_csv, "w")
+        writer = csv.writer(outfile)
+        writer.writerow(KEY_HEADERS + extract.variables)
+    count = 0
+    try:
+        # extract the next chunks while the current one is written
+        for chunk, table in extract_ahead(chunk_positions(positions, chunk_size), extract, pool, depth):
+            for row in table.rows():
+                if writer:
+                    writer.writerow(row)
+                sink.write(convert_wide_row(dict(zip(KEY_HEADERS + table.variables, row))))
+                count += 1
+            sink.flush()
+    finally:
+        sink.close()
+        if writer:
+            outfile.close()
+    return count
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "csvfiles",
+        nargs="*",
+        help="raw position report CSV files, one per vessel (default: position_data/*.csv)",
+    )
+    parser.add_argument(
+        "--all-positions",
+        action="store_true",
+        help="keep every position report instead of the one closest to each hour",
+    )
+    parser.add_argument(
+        "--interpolate",
+        action="store_true",
+        help="interpolate in time between the forecast files bracketing each report time",
+    )
+    parser.add_argument(
+        "--interpolation-mode",
+        choices=["bilinear", "nearest"],
+        default="bilinear",
+        help="bilinear interpolation between grid points, or the value of the nearest grid cell",
+    )
+    parser.add_argument(
+        "--chunk-size",
+        type=int,
+        default=24,
+        help="number of positions extracted together",
+    )
+    parser.add_argument(
+        "--prefetch",
+        type=int,
+        default=1,
+        help="number of chunks extracted ahead of the one being written",
+    )
+    parser.add_argument(
+        "--processes",
+        type=int,
+        default=None,
+        help="number of processes extracting the forecast files (default: one per CPU)",
+    )
+    parser.add_argument(
+        "--max-delay",
+        type=float,
+        default=1,
+        help="hours a position report may arrive out of time order",
+    )
+    parser.add_argument(
+        "--format",
+        choices=sorted(SINKS),
+        default="json",
+        help="a point forecast JSON document, or one JSON record per line",
+    )
+    parser.add_argument(
+        "--keep-positions",
+        action="store_true",
+        help="also write the hourly-positions-*.csv files",
+    )
+    parser.add_argument(
+        "--keep-csv",
+        action="store_true",
+        help="also write the nwp-hourly-positions-*.csv files, in wide format",
+    )
+    parser.add_argument(
+        "--point-cache",
+        default=None,
+        help="JSON file caching extracted point values across runs",
+    )
+    parser.add_argument(
+        "--queue",
+        default=None,
+        help="queue directory on a shared filesystem, to share the GRIB2 files with workers on other nodes",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=0,
+        help="number of local worker processes to start on the queue",
+    )
+    parser.add_argument(
+        "--stale",
+        type=float,
+        default=DEFAULT_STALE,
+        help="seconds after which a unit claimed by a worker that died is queued again",
+    )
+    args = parser.parse_args()
+    # Specify the weather bundles of interest
+    bundles = ["basic", "maritime"]
+    variables = []
+    for bundle in bundles:
+        variables += DEF_VARIABLES[bundle]
+        variables += available(DEF_VARIABLES[bundle])
+    filenames = get_grib2_filenames()
+    cache = PointCache(args.point_cache)
+    # one pool extracts the chunks of every vessel, unless a work queue does
+    pool = None if args.queue else multiprocessing.Pool(args.processes)
+    try:
+        for filename in args.csvfiles or sorted(glob.glob("position_data/*.csv")):
+            # name the outputs like the files of the three-script workflow
+            vessel = "hourly-positions-" + os.path.basename(filename)
+            extract = ChunkExtractor(
+                vessel,
+                bundles,
+                filenames,
+                variables,
+                args.interpolation_mode,
+                args.interpolate,
+                cache,
+                args.queue,
+                args.workers,
+                args.stale,
+            )
+            sink = SINKS[args.format]("nwp-" + vessel.split(".")[0] + "." + args.format)
+            count = run_pipeline(
+                stream_reports(filename),
+                sink,
+                extract,
+                args.chunk_size,
+                args.prefetch,
+                args.all_positions,
+                timedelta(hours=args.max_delay),
+                vessel if args.keep_positions else None,
+                "nwp-" + vessel if args.keep_csv else None,
+                pool,
+            )
+            print("Wrote {} point forecasts for {}".format(count, filename))
+    finally:
+        if pool:
+            pool.close()
+            pool.join()
+    cache.save()
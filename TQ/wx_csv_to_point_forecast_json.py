@@ -1,6 +1,9 @@
 import csv
 import json
+import sys
 
+# Translation of GRIB2 variable names to JSON names,
+# the derived variables (see `utils_derived`) already use their JSON names
 VARIABLE_NAMES = {
     # basic bundle
     "PRMSL_P0_L101_GLL0": "air_pressure_at_sea_level",
@@ -10,8 +13,8 @@ VARIABLE_NAMES = {
     "TCDC_P0_L200_GLL0": "total_cloud_cover",
     "RH_P0_L103_GLL0": "relative_humidity",
     "GUST_P0_L1_GLL0": "wind_gust",
-    # "x": "wind_speed",
-    # "x": "wind_direction",
+    "wind_speed": "wind_speed",
+    "wind_direction": "wind_direction",
     "VGRD_P0_L103_GLL0": "northward_wind",
     "UGRD_P0_L103_GLL0": "eastward_wind",
     # maritime bundle
@@ -19,8 +22,8 @@ VARIABLE_NAMES = {
     "WWSDIR_P0_L101_GLL0": "sea_surface_wave_mean_direction",
     "MWSPER_P0_L101_GLL0": "sea_surface_wave_mean_period",
     "HTSGW_P0_L101_GLL0": "sea_surface_wave_significant_height",
-    # "x": "sea_water_speed",
-    # "x": "sea_water_direction",
+    "sea_water_speed": "sea_water_speed",
+    "sea_water_direction": "sea_water_direction",
     "VOGRD_P0_L1_GLL0": "northward_sea_water_velocity",
     "UOGRD_P0_L1_GLL0": "eastward_sea_water_velocity",
 }
@@ -37,9 +40,27 @@ def write_output_to_json_file(filename, data):
         # jsonFile.write(json.dumps(output))
 
 
-def convert_csv_to_json():
+# Build the point forecast of one row of a wide-format CSV,
+# which already holds every variable of its issuance, time and position
+def convert_wide_row(row):
+    issuance = row.pop("Forecast Issuance")
+    time = row.pop("Valid Time")
+    lat = row.pop("Latitude")
+    lon = row.pop("Longitude")
+    return {
+        "location": {"coordinates": {"lat": lat, "lon": lon}},
+        "times": {
+            "issuance_time": (issuance + "+00:00").replace(" ", "T"),
+            "valid_time": (time + "+00:00").replace(" ", "T"),
+        },
+        # empty cells are variables missing from the forecast files
+        "values": {VARIABLE_NAMES[variable]: value for variable, value in row.items() if value != ""},
+    }
+
+
+def convert_csv_to_json(csvfiles=None):
     # Specify input position data files
-    csvfiles = ["nwp-hourly-positions-nienburg.csv", "nwp-hourly-positions-niteroi.csv"]
+    csvfiles = csvfiles or ["nwp-hourly-positions-nienburg.csv", "nwp-hourly-positions-niteroi.csv"]
     # iterate through the input CSV files
     for filename in csvfiles:
         # initialize the output data object
@@ -47,6 +68,10 @@ def convert_csv_to_json():
         # open the CSV input file
         with open(filename, "r") as csvfile:
             reader = csv.DictReader(csvfile)
+            # files written with `--wide` need no pivoting
+            if "Variable" not in reader.fieldnames:
+                write_output_to_json_file(filename, dict(enumerate(convert_wide_row(row) for row in reader)))
+                continue
             for row in reader:
                 issuance = row["Forecast Issuance"]
                 time = row["Valid Time"]
@@ -80,4 +105,4 @@ def convert_csv_to_json():
 
 
 if __name__ == "__main__":
-    convert_csv_to_json()
+    convert_csv_to_json(sys.argv[1:])
@@ -0,0 +1,586 @@
+"""
+Equivalence and performance gate for faster implementations
+
+Each case runs a reference implementation, the original code of a
+pipeline step, and a candidate implementation on the same synthetic
+inputs, checks that their outputs match within a numeric tolerance, and
+times both. Only the speedup of the candidate over the reference, measured
+in the same run, is gated, so the gate does not depend on the speed of
+the machine: it may not fall below the speedup stored for the case in
+`benchmark_baseline.json`, or below 1 for a case without one, by more
+than the allowed margin.
+Reference implementations that were replaced in the scripts are kept
+here, as they were in the original code.
+Everything runs offline: shapefiles, grids and position reports are
+generated in a temporary directory. The trajectory case needs a local
+GRIB2 file, given with `--grib`, and is skipped otherwise.
+
+A candidate is a `module:function` taking the case's inputs dictionary
+and returning a dataframe, and replaces the default candidate of a case:
+
+    python benchmark_equivalence.py geo_filter --candidate geo_filter=my_module:my_filter
+
+Whole pipeline outputs (CSV, JSON or means.js files, or directories
+of them) can be compared the same way:
+
+    python benchmark_equivalence.py --compare golden/precip_data precip_data
+"""
+import os
+import io
+import csv
+import sys
+import json
+import time
+import tempfile
+import argparse
+import importlib
+import contextlib
+from datetime import timedelta
+import numpy as np
+import pandas as pd
+
+# Default file of the stored speedups of the candidates, kept next to this script
+BASELINE_FILE = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'benchmark_baseline.json')
+# Bounding box of the synthetic areas and positions (minlon, maxlon, minlat, maxlat)
+EXTENT = (-100.0, -80.0, 25.0, 45.0)
+
+
+#
+# Synthetic inputs
+#
+
+def star_wkt(lon, lat, radius, points, rng, hole=False):
+    """
+    Return the WKT of a jagged star-shaped polygon around a center,
+    optionally with a hole, so that containment tests are not trivial
+    """
+    angles = np.linspace(0, 2 * np.pi, points, endpoint=False)
+    radii = radius * rng.uniform(0.4, 1.0, points)
+    ring = [(lon + r * np.cos(a), lat + r * np.sin(a)) for r, a in zip(radii, angles)]
+    rings = [ring + ring[:1]]
+    if hole:
+        inner = [(lon + radius * 0.15 * np.cos(a), lat + radius * 0.15 * np.sin(a)) for a in angles[::-1]]
+        rings.append(inner + inner[:1])
+    return 'POLYGON ({})'.format(', '.join(
+        '({})'.format(', '.join('{:.6f} {:.6f}'.format(x, y) for x, y in r)) for r in rings
+    ))
+
+
+def write_shapefile(path, features):
+    """
+    Write (name, state, wkt) polygon features to a WGS84 shapefile
+    with the NAME and ST fields of the cities shapefile
+    """
+    from osgeo import ogr, osr
+    driver = ogr.GetDriverByName('ESRI Shapefile')
+    source = driver.CreateDataSource(path)
+    srs = osr.SpatialReference()
+    srs.ImportFromEPSG(4326)
+    layer = source.CreateLayer('areas', srs, ogr.wkbPolygon)
+    layer.CreateField(ogr.FieldDefn('NAME', ogr.OFTString))
+    layer.CreateField(ogr.FieldDefn('ST', ogr.OFTString))
+    for name, state, wkt in features:
+        feature = ogr.Feature(layer.GetLayerDefn())
+        feature.SetField('NAME', name)
+        feature.SetField('ST', state)
+        feature.SetGeometry(ogr.CreateGeometryFromWkt(wkt))
+        layer.CreateFeature(feature)
+    # closing the data source flushes the shapefile to disk
+    source = None
+
+
+def synthetic_areas(rng, count=6):
+    """
+    Return (name, state, wkt) features spread over the synthetic extent
+    """
+    minlon, maxlon, minlat, maxlat = EXTENT
+    features = []
+    for i in range(count):
+        lon = rng.uniform(minlon + 2, maxlon - 2)
+        lat = rng.uniform(minlat + 2, maxlat - 2)
+        wkt = star_wkt(lon, lat, rng.uniform(1, 2), 40, rng, hole=(i % 2 == 0))
+        features.append(('City {}'.format(i), 'ST', wkt))
+    return features
+
+
+def synthetic_points(rng, count):
+    """
+    Return random (lat, lon) arrays over the synthetic extent
+    """
+    minlon, maxlon, minlat, maxlat = EXTENT
+    return rng.uniform(minlat, maxlat, count), rng.uniform(minlon, maxlon, count)
+
+
+#
+# Original implementations, kept as the references of replaced code
+#
+
+def round_time_to_hour(t):
+    # Rounds to nearest hour by adding a timedelta hour if minute >= 30
+    return t.replace(second=0, microsecond=0, minute=0, hour=t.hour) + timedelta(
+        hours=t.minute // 30
+    )
+
+
+def baseline_get_hourly_positions(filename):
+    """
+    The original `get_hourly_positions` of `TQ/extract_hourly_positions.py`,
+    without the progress printed for every row
+    """
+    from dateutil import parser
+    csv_file = open(filename)
+    reader = csv.DictReader(csv_file)
+    hourly_positions = {}
+    for row in reader:
+        timestamp = parser.parse(row["report_date"])
+        rounded_time = round_time_to_hour(timestamp)
+        time_string = str(rounded_time)
+        # check if position data has already been stored for this hour
+        if time_string not in hourly_positions:
+            hourly_positions[time_string] = row
+        else:
+            # only replace the existing position data for this hour
+            # if the current timestamp is closer to the hour
+            previous_time = parser.parse(hourly_positions[time_string]["report_date"])
+            if abs(timestamp - rounded_time) < abs(previous_time - rounded_time):
+                hourly_positions[time_string] = row
+    csv_file.close()
+    return hourly_positions
+
+
+def baseline_process_file(config):
+    """
+    The original `process_file` of `TQ/get_trajectory_point_forecasts.py`,
+    decoding the whole GRIB2 file to interpolate the variables at one point
+    """
+    import Nio
+    filename, bundle, variables, issuance, time, lat, lon = config[:7]
+    nc = Nio.open_file(filename, mode="r", format="grib")
+    rows = []
+    # Use PyNio's extended selection to do the interpolation
+    select = "lat_0|{lat}i lon_0|{lon}i".format(lat=lat, lon=lon)
+    for name in variables:
+        if name in nc.variables:
+            var = nc.variables[name]
+            rows.append({
+                "Forecast Issuance": issuance,
+                "Valid Time": time,
+                "Latitude": lat,
+                "Longitude": lon,
+                "Variable": name,
+                "Name": var.attributes["long_name"],
+                "Value": var[select],
+                "Units": var.attributes["units"],
+                "Bundle": bundle,
+            })
+    nc.close()
+    return rows
+
+
+#
+# Cases
+#
+
+def setup_geo_filter(workdir, rng, args):
+    # One shapefile holding every synthetic area,
+    # and a global grid with longitudes from 0 to 360
+    area_file = os.path.join(workdir, 'areas.shp')
+    write_shapefile(area_file, synthetic_areas(rng))
+    return {
+        'area_file': area_file,
+        'lats': np.arange(-90, 90.5, 0.5),
+        'lons': np.arange(0, 360, 0.5),
+    }
+
+
+def reference_geo_filter(inputs):
+    from utils_grib import load_area, coarse_geo_filter, precise_geo_filter
+    lats = inputs['lats']
+    lons = inputs['lons']
+    AREA = load_area(inputs['area_file'])
+    index = pd.MultiIndex.from_product([lats, lons], names=['lat_0', 'lon_0'])
+    df = pd.DataFrame({'value': np.zeros(len(index))}, index=index)
+    df = coarse_geo_filter(df, AREA)
+    df = precise_geo_filter(df, AREA)
+    return df.loc[:, ['latitude', 'longitude']].reset_index(drop=True)
+
+
+def candidate_geo_filter(inputs):
+    import utils_grib
+    lats = inputs['lats']
+    lons = inputs['lons']
+    # time the computation of the mask, not the in-process cache
+    utils_grib.GRID_MASKS.clear()
+    lat_idx, lon_idx, mask = utils_grib.grid_area_mask(lats, lons, inputs['area_file'])
+    rows, cols = np.nonzero(mask)
+    longitude = lons[lon_idx][cols]
+    return pd.DataFrame({
+        'latitude': lats[lat_idx][rows],
+        'longitude': np.where(longitude > 180, longitude - 360, longitude),
+    })
+
+
+def setup_country_checker(workdir, rng, args):
+    # A cities shapefile and random points, some of which are in no city
+    area_file = os.path.join(workdir, 'cities.shp')
+    write_shapefile(area_file, synthetic_areas(rng))
+    lats, lons = synthetic_points(rng, args.points)
+    return {'area_file': area_file, 'lats': lats, 'lons': lons}
+
+
+def reference_country_checker(inputs):
+    from countries import countries
+    checker = countries.CountryChecker(inputs['area_file'])
+    names = []
+    for lat, lon in zip(inputs['lats'], inputs['lons']):
+        country = checker.getCountry(countries.Point(lat, lon))
+        names.append(country.NAME if country else '')
+    return pd.DataFrame({'point': np.arange(len(names)), 'name': names})
+
+
+def candidate_country_checker(inputs):
+    from countries import countries
+    from utils_regions import Region
+    # one region per city, tested in shapefile order after an envelope check
+    layer = countries.CountryChecker(inputs['area_file']).layer
+    regions = []
+    for i in range(layer.GetFeatureCount()):
+        feature = layer.GetFeature(i)
+        regions.append(Region(feature.GetField('NAME'), feature.geometry().Clone()))
+    names = []
+    for lat, lon in zip(inputs['lats'], inputs['lons']):
+        name = ''
+        for region in regions:
+            minlon, maxlon, minlat, maxlat = region.envelope
+            if minlon <= lon <= maxlon and minlat <= lat <= maxlat and region.contains(lat, lon):
+                name = region.name
+                break
+        names.append(name)
+    return pd.DataFrame({'point': np.arange(len(names)), 'name': names})
+
+
+def candidate_polygon_index(inputs):
+    from utils_polygon import PolygonIndex
+    # flat rings and an envelope grid, locating all points at once
+    index = PolygonIndex.from_shapefile(inputs['area_file'], fields=('NAME',))
+    located = index.locate(inputs['lats'], inputs['lons'])
+    names = [index.properties[p]['NAME'] if p >= 0 else '' for p in located]
+    return pd.DataFrame({'point': np.arange(len(names)), 'name': names})
+
+
+def setup_hourly_positions(workdir, rng, args):
+    # Position reports at irregular times over a few days,
+    # with several reports in most hours
+    filename = os.path.join(workdir, 'positions.csv')
+    start = pd.Timestamp('2020-03-17 00:00:00+00:00')
+    offsets = np.sort(rng.uniform(0, 72 * 3600, args.points))
+    lats, lons = synthetic_points(rng, args.points)
+    pd.DataFrame({
+        'latitude': np.round(lats, 5),
+        'longitude': np.round(lons, 5),
+        'report_date': [str(start + pd.Timedelta(seconds=int(s))) for s in offsets],
+    }).to_csv(filename, index=False)
+    return {'filename': filename}
+
+
+def positions_frame(positions):
+    # One row per (rounded time, position row) pair
+    return pd.DataFrame([
+        {'rounded_time': time_string, 'latitude': float(row['latitude']),
+         'longitude': float(row['longitude']), 'report_date': row['report_date']}
+        for time_string, row in positions
+    ])
+
+
+def reference_hourly_positions(inputs):
+    return positions_frame(baseline_get_hourly_positions(inputs['filename']).items())
+
+
+def candidate_hourly_positions(inputs):
+    sys.path.append(os.path.join(os.path.dirname(os.path.realpath(__file__)), 'TQ'))
+    from extract_hourly_positions import stream_reports, stream_hourly_positions
+    # the synthetic reports are in time order, as the streaming version expects
+    positions = stream_hourly_positions(stream_reports(inputs['filename']))
+    return positions_frame((row['rounded_time'], row) for row in positions)
+
+
+def setup_trajectory(workdir, rng, args):
+    # Needs a real GRIB2 file, named like the files of DATA_DIR
+    if not args.grib:
+        return None
+    sys.path.append(os.path.join(os.path.dirname(os.path.realpath(__file__)), 'TQ'))
+    import get_trajectory_point_forecasts as tq
+    filename = os.path.basename(args.grib)
+    bundle = filename.split('.')[-4]
+    issuance, valid_time = tq.parse_datetime(filename)
+    lats, lons = synthetic_points(rng, args.points)
+    return {
+        'filepath': args.grib,
+        'bundle': bundle,
+        'variables': tq.DEF_VARIABLES[bundle],
+        'issuance': issuance,
+        'time': str(valid_time),
+        # positions are passed as strings, as read from the position CSVs
+        'points': [(i, '{:.5f}'.format(lat), '{:.5f}'.format(lon + 360)) for i, (lat, lon) in enumerate(zip(lats, lons))],
+    }
+
+
+def trajectory_frame(results):
+    # Flatten (point, rows) pairs into one dataframe
+    records = []
+    for point, rows in results:
+        for row in rows:
+            records.append({'point': point, 'variable': row['Variable'], 'value': float(row['Value']), 'units': row['Units']})
+    return pd.DataFrame(records)
+
+
+def reference_trajectory(inputs):
+    results = []
+    for point, lat, lon in inputs['points']:
+        config = [inputs['filepath'], inputs['bundle'], inputs['variables'], inputs['issuance'], inputs['time'], lat, lon]
+        results.append((point, baseline_process_file(config)))
+    return trajectory_frame(results)
+
+
+def candidate_trajectory(inputs):
+    import get_trajectory_point_forecasts as tq
+    config = [inputs['filepath'], inputs['bundle'], inputs['variables'], inputs['issuance'], inputs['time'], inputs['points'], 'bilinear']
+    with contextlib.redirect_stdout(io.StringIO()):
+        batch = tq.process_fleet_file(config)
+    # expand the batch into the (point, rows) pairs of the reference,
+    # leaving out the derived variables the original code did not have
+    results = []
+    for i, point in enumerate(batch.keys):
+        rows = [
+            {'Variable': name, 'Value': value, 'Units': units}
+            for name, long_name, value, units, dtype in batch.point_values(i)
+            if name in inputs['variables']
+        ]
+        results.append((point, rows))
+    return trajectory_frame(results)
+
+
+# Each case lists its input builder, the reference and default candidate
+# implementations, and the columns identifying a row of the output.
+CASES = {
+    'geo_filter': {
+        'setup': setup_geo_filter,
+        'reference': reference_geo_filter,
+        'candidate': candidate_geo_filter,
+        'keys': ['latitude', 'longitude'],
+    },
+    'country_checker': {
+        'setup': setup_country_checker,
+        'reference': reference_country_checker,
+        'candidate': candidate_country_checker,
+        'keys': ['point'],
+    },
+    'polygon_index': {
+        'setup': setup_country_checker,
+        'reference': reference_country_checker,
+        'candidate': candidate_polygon_index,
+        'keys': ['point'],
+    },
+    'hourly_positions': {
+        'setup': setup_hourly_positions,
+        'reference': reference_hourly_positions,
+        'candidate': candidate_hourly_positions,
+        'keys': ['rounded_time'],
+    },
+    'trajectory': {
+        'setup': setup_trajectory,
+        'reference': reference_trajectory,
+        'candidate': candidate_trajectory,
+        'keys': ['point', 'variable'],
+    },
+}
+
+
+#
+# Comparison
+#
+
+def compare_frames(reference, candidate, keys=None, rtol=1e-6, atol=1e-9):
+    """
+    Compare two dataframes regardless of row order, with numeric columns
+    compared within tolerance, and return a list of the differences found
+    """
+    problems = []
+    if sorted(reference.columns) != sorted(candidate.columns):
+        return ['columns differ: {} != {}'.format(sorted(reference.columns), sorted(candidate.columns))]
+    if len(reference) != len(candidate):
+        problems.append('row counts differ: {} != {}'.format(len(reference), len(candidate)))
+        return problems
+    # put both frames in the same row order
+    keys = keys or list(reference.columns)
+    reference = reference.sort_values(keys).reset_index(drop=True)
+    candidate = candidate.loc[:, reference.columns].sort_values(keys).reset_index(drop=True)
+    for column in reference.columns:
+        ref = reference[column]
+        cand = candidate[column]
+        if pd.api.types.is_numeric_dtype(ref) and pd.api.types.is_numeric_dtype(cand):
+            close = np.isclose(ref.values.astype(float), cand.values.astype(float), rtol=rtol, atol=atol, equal_nan=True)
+        else:
+            close = (ref.astype(str).values == cand.astype(str).values)
+        if not close.all():
+            first = int(np.argmin(close))
+            problems.append('{}: {} rows differ, first at row {} ({} != {})'.format(
+                column, int((~close).sum()), first, ref.iloc[first], cand.iloc[first]
+            ))
+    return problems
+
+
+def load_output(path):
+    """
+    Load a CSV, JSON or means.js output file into a dataframe,
+    flattening nested JSON objects into (key, value) rows
+    """
+    if path.endswith('.csv'):
+        return pd.read_csv(path)
+    with open(path, 'r') as infile:
+        text = infile.read()
+    if path.endswith('.js'):
+        # strip the `var NAME = ` prefix and the trailing semicolon
+        text = text[text.index('=') + 1:].strip().rstrip(';')
+    records = []
+
+    def flatten(prefix, value):
+        if isinstance(value, dict):
+            for key, item in value.items():
+                flatten(prefix + '/' + str(key), item)
+        elif isinstance(value, list):
+            for i, item in enumerate(value):
+                flatten(prefix + '/' + str(i), item)
+        else:
+            try:
+                records.append((prefix, float(value), ''))
+            except (TypeError, ValueError):
+                records.append((prefix, np.nan, str(value)))
+
+    flatten('', json.loads(text))
+    return pd.DataFrame(records, columns=['key', 'number', 'text'])
+
+
+def compare_outputs(reference_path, candidate_path, rtol=1e-6, atol=1e-9):
+    """
+    Compare two output files, or every output file of two directories,
+    returning a list of the differences found
+    """
+    if os.path.isdir(reference_path):
+        names = sorted(os.listdir(reference_path))
+        pairs = [(os.path.join(reference_path, n), os.path.join(candidate_path, n)) for n in names]
+    else:
+        pairs = [(reference_path, candidate_path)]
+    problems = []
+    for ref_file, cand_file in pairs:
+        if not os.path.exists(cand_file):
+            problems.append('{}: missing'.format(cand_file))
+            continue
+        for problem in compare_frames(load_output(ref_file), load_output(cand_file), rtol=rtol, atol=atol):
+            problems.append('{}: {}'.format(cand_file, problem))
+    return problems
+
+
+#
+# Timing
+#
+
+def best_time(func, inputs, repeat):
+    """
+    Return the output of the first call and the best time of `repeat` calls
+    """
+    times = []
+    output = None
+    for i in range(repeat):
+        start = time.perf_counter()
+        result = func(inputs)
+        times.append(time.perf_counter() - start)
+        if output is None:
+            output = result
+    return output, min(times)
+
+
+def load_function(spec):
+    """
+    Import a `module:function` specification
+    """
+    module_name, func_name = spec.split(':')
+    return getattr(importlib.import_module(module_name), func_name)
+
+
+def run_case(name, case, candidate, workdir, args, baseline):
+    """
+    Run one case and return (status, speedup entry), printing its report
+    """
+    rng = np.random.default_rng(args.seed)
+    inputs = case['setup'](workdir, rng, args)
+    if inputs is None:
+        print('{:<18} SKIP (no input)'.format(name))
+        return 'skip', None
+    reference, reference_time = best_time(case['reference'], inputs, args.repeat)
+    output, candidate_time = best_time(candidate, inputs, args.repeat)
+    problems = compare_frames(reference, output, case['keys'], args.rtol, args.atol)
+    speedup = reference_time / max(candidate_time, 1e-9)
+    # without a stored speedup, the candidate may not be slower than the reference
+    expected = baseline.get(name, {}).get('speedup', 1.0)
+    status = 'ok'
+    if problems:
+        status = 'mismatch'
+    elif speedup < expected / (1 + args.margin):
+        status = 'slower'
+    print('{:<18} {:<8} reference {:.4f} s  candidate {:.4f} s  ({:.2f}x){}'.format(
+        name, status.upper(), reference_time, candidate_time, speedup,
+        '  baseline {:.2f}x'.format(expected) if name in baseline else '',
+    ))
+    for problem in problems:
+        print('    ' + problem)
+    return status, {'speedup': speedup}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Check candidate implementations against the current ones for equal output and no slowdown'
+    )
+    parser.add_argument('cases', nargs='*', help='The cases to run (default: all of {})'.format(', '.join(CASES)))
+    parser.add_argument('--candidate', action='append', default=[], help='Replace the candidate of a case, as case=module:function')
+    parser.add_argument('--baseline', default=BASELINE_FILE, help='JSON file of the stored speedups of the candidates')
+    parser.add_argument('--update-baseline', action='store_true', help='Store the speedups of this run as the new baseline')
+    parser.add_argument('--margin', type=float, default=0.2, help='Allowed loss of speedup against the baseline, as a fraction')
+    parser.add_argument('--repeat', type=int, default=3, help='Number of timed runs of each implementation, the best is kept')
+    parser.add_argument('--points', type=int, default=2000, help='Number of synthetic positions')
+    parser.add_argument('--seed', type=int, default=0, help='Seed of the synthetic inputs')
+    parser.add_argument('--rtol', type=float, default=1e-6, help='Relative tolerance of numeric comparisons')
+    parser.add_argument('--atol', type=float, default=1e-9, help='Absolute tolerance of numeric comparisons')
+    parser.add_argument('--grib', default=None, help='A local GRIB2 file for the trajectory case')
+    parser.add_argument('--compare', nargs=2, default=None, metavar=('REFERENCE', 'CANDIDATE'), help='Compare two output files or directories instead of running the cases')
+    args = parser.parse_args()
+
+    if args.compare:
+        problems = compare_outputs(args.compare[0], args.compare[1], args.rtol, args.atol)
+        for problem in problems:
+            print(problem)
+        print('{} differences'.format(len(problems)))
+        sys.exit(1 if problems else 0)
+
+    candidates = {}
+    for spec in args.candidate:
+        name, func = spec.split('=', 1)
+        candidates[name] = load_function(func)
+    baseline = {}
+    if os.path.exists(args.baseline):
+        with open(args.baseline, 'r') as infile:
+            baseline = json.load(infile)
+
+    failed = False
+    with tempfile.TemporaryDirectory() as workdir:
+        for name in args.cases or list(CASES):
+            case = CASES[name]
+            status, entry = run_case(name, case, candidates.get(name, case['candidate']), workdir, args, baseline)
+            failed = failed or status in ('mismatch', 'slower')
+            if entry and args.update_baseline and status != 'mismatch':
+                baseline[name] = entry
+
+    if args.update_baseline:
+        with open(args.baseline, 'w') as outfile:
+            json.dump(baseline, outfile, indent=4)
+    sys.exit(1 if failed else 0)
@@ -0,0 +1,107 @@
+"""
+Build a binary region store from shapefiles or GeoJSON files
+
+This replaces the manual ogr2ogr steps of the README with one command:
+the features are reprojected to WGS84 (EPSG:4326), selected by an
+attribute filter, optionally buffered and dissolved, and their polygons
+are written as flat arrays of vertices, ring offsets and envelopes,
+followed by the selected attributes (see `utils_polygon.PolygonIndex`).
+Scripts then load the store with a memory map, without OGR, e.g.
+
+    python build_region_store.py ukraine/ukraine.shp -o ukraine/ukraine.regions --dissolve
+    python build_region_store.py 500cities/cities.shp -o 500cities/cities.regions --fields NAME ST
+    python build_region_store.py input.shp -o selected.regions --where "ID='1'"
+"""
+import argparse
+from osgeo import ogr, osr
+# local
+from utils_polygon import PolygonIndex
+
+
+def wgs84_transform(layer):
+    """
+    Return the transformation of a layer's coordinates to WGS84,
+    or None if the layer is already in WGS84 or has no spatial reference
+    """
+    source = layer.GetSpatialRef()
+    if source is None:
+        return None
+    target = osr.SpatialReference()
+    target.ImportFromEPSG(4326)
+    # GDAL 3 uses (lat, lon) order for EPSG:4326 unless told otherwise
+    if hasattr(osr, 'OAMS_TRADITIONAL_GIS_ORDER'):
+        source = source.Clone()
+        source.SetAxisMappingStrategy(osr.OAMS_TRADITIONAL_GIS_ORDER)
+        target.SetAxisMappingStrategy(osr.OAMS_TRADITIONAL_GIS_ORDER)
+    if source.IsSame(target):
+        return None
+    return osr.CoordinateTransformation(source, target)
+
+
+def read_features(filename, fields=None, where=None, buffer=0):
+    """
+    Return the (attributes, geometry) pairs of the features of a shapefile
+    or GeoJSON file in WGS84, keeping the given fields (default: all of them)
+    of the features matching an OGR SQL `where` clause
+    """
+    source = ogr.Open(filename)
+    if source is None:
+        raise IOError('Cannot open {}'.format(filename))
+    layer = source.GetLayer()
+    if where:
+        layer.SetAttributeFilter(where)
+    if fields is None:
+        definition = layer.GetLayerDefn()
+        fields = [definition.GetFieldDefn(i).GetName() for i in range(definition.GetFieldCount())]
+    transform = wgs84_transform(layer)
+    features = []
+    layer.ResetReading()
+    for feature in layer:
+        geometry = feature.GetGeometryRef()
+        if geometry is None:
+            continue
+        # the geometry is owned by the feature, so it is copied before changing it
+        geometry = geometry.Clone()
+        if transform:
+            geometry.Transform(transform)
+        if buffer:
+            geometry = geometry.Buffer(buffer)
+        features.append(({field: feature.GetField(field) for field in fields}, geometry))
+    return features
+
+
+def dissolve(features, field=None):
+    """
+    Merge the geometries of all features, or of the features sharing
+    the value of a field, into one feature each
+    """
+    groups = {}
+    for attributes, geometry in features:
+        key = attributes.get(field) if field else None
+        if key in groups:
+            groups[key] = (groups[key][0], groups[key][1].Union(geometry))
+        else:
+            groups[key] = ({field: key} if field else {}, geometry)
+    return list(groups.values())
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('inputs', nargs='+', help='shapefiles or GeoJSON files of the areas')
+    parser.add_argument('-o', '--output', required=True, help='the region store to write, e.g. areas.regions')
+    parser.add_argument('--where', default=None, help="attribute filter of the features to keep, e.g. \"ID='1'\"")
+    parser.add_argument('--fields', nargs='+', default=None, help='attributes to keep (default: all)')
+    parser.add_argument('--buffer', type=float, default=0, help='distance in degrees to grow every area by')
+    parser.add_argument('--dissolve', action='store_true', help='merge all features into one')
+    parser.add_argument('--dissolve-by', default=None, help='merge the features sharing the value of this field')
+    args = parser.parse_args()
+
+    features = []
+    for filename in args.inputs:
+        features += read_features(filename, args.fields, args.where, args.buffer)
+    if args.dissolve or args.dissolve_by:
+        features = dissolve(features, args.dissolve_by)
+    index = PolygonIndex.from_geometries([g for a, g in features], [a for a, g in features])
+    index.save(args.output)
+    print('Wrote {} regions with {} rings and {} vertices to {}'.format(
+        len(index), len(index.ring_offsets) - 1, len(index.coords), args.output))
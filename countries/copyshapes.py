@@ -3,34 +3,64 @@
 
 from osgeo import ogr
 
-def filter_file(filter_func, infile, outfile):
+def filter_file(filter_func, infile, outfile, where=None, bbox=None, simplify=None, batch_size=1000):
     """
     Saves all infile shapes which pass through filter_func to outfile.
-    
+
     Example:
     filter_file(lambda x: x.GetField('ISO2') == 'CZ', 'TM_WORLD_BORDERS-0.3.shp', 'cz.shp')
+
+    filter_func may be None when the OGR filters are enough:
+    where    -- attribute filter as an SQL where clause, e.g. "ISO2 = 'CZ'"
+    bbox     -- spatial filter rectangle (minx, miny, maxx, maxy)
+    simplify -- simplify geometries to this tolerance in layer units,
+                e.g. the forecast grid resolution in degrees
+
+    Filters are evaluated by OGR while the layer is read sequentially,
+    and output features are written in transactions of batch_size.
     """
     driver = ogr.GetDriverByName('ESRI Shapefile')
-    
+
     inDS = driver.Open(infile)
     inLayer = inDS.GetLayer()
-    
+    # push the filters down to OGR, so non-matching features are never returned
+    if where is not None:
+        inLayer.SetAttributeFilter(where)
+    if bbox is not None:
+        inLayer.SetSpatialFilterRect(*bbox)
+
     outDS = driver.CreateDataSource(outfile)
-    outLayer = outDS.CreateLayer('filtered')
-    
-    feat = inLayer.GetFeature(0) # first feature
-    for field in feat.keys():
-        outLayer.CreateField(feat.GetFieldDefnRef(field))
-    del feat
-    
+    outLayer = outDS.CreateLayer('filtered', inLayer.GetSpatialRef(), inLayer.GetGeomType())
+
+    inDefn = inLayer.GetLayerDefn()
+    for i in range(inDefn.GetFieldCount()):
+        outLayer.CreateField(inDefn.GetFieldDefn(i))
+
     featureDefn = outLayer.GetLayerDefn()
-    for i in range(inLayer.GetFeatureCount()):
-        feat = inLayer.GetFeature(i)
-        if not filter_func(feat):
+    fieldCount = featureDefn.GetFieldCount()
+    pending = 0
+    outLayer.StartTransaction()
+    inLayer.ResetReading()
+    for feat in inLayer:
+        if filter_func is not None and not filter_func(feat):
             continue
-        
+
         outFeature = ogr.Feature(featureDefn)
-        outFeature.SetGeometry(feat.GetGeometryRef())
-        for field in feat.keys():
-            outFeature.SetField(field, feat.GetField(field))
+        geometry = feat.GetGeometryRef()
+        if simplify is not None and geometry is not None:
+            geometry = geometry.SimplifyPreserveTopology(simplify)
+        outFeature.SetGeometry(geometry)
+        for i in range(fieldCount):
+            outFeature.SetField(i, feat.GetField(i))
         outLayer.CreateFeature(outFeature)
+
+        pending += 1
+        if pending == batch_size:
+            outLayer.CommitTransaction()
+            outLayer.StartTransaction()
+            pending = 0
+    outLayer.CommitTransaction()
+
+    # flush the output to disk
+    del outLayer
+    del outDS
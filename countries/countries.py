@@ -42,9 +42,43 @@ class CountryChecker(object):
     """ Loads a country shape file, checks coordinates for country location. """
     
     def __init__(self, country_file):
-        driver = ogr.GetDriverByName('ESRI Shapefile')
-        self.countryFile = driver.Open(country_file)
-        self.layer = self.countryFile.GetLayer()
+        """ The shape file is only opened on first use of the layer """
+        self.filename = country_file
+        self.countryFile = None
+        # the geometries as WKB with their envelopes, and the areas
+        # rebuilt from them in a process the checker was sent to
+        self.payload = None
+        self.area = None
+    
+    def getLayer(self):
+        if self.area is not None:
+            return self.area
+        if self.countryFile is None:
+            driver = ogr.GetDriverByName('ESRI Shapefile')
+            self.countryFile = driver.Open(self.filename)
+        return self.countryFile.GetLayer()
+    layer = property(getLayer)
+
+    def getPayload(self):
+        """ Geometries and fields of every feature, built once (see `utils_geometry`) """
+        if self.payload is None:
+            from utils_geometry import GeometryPayload
+            layer = self.layer
+            defn = layer.GetLayerDefn()
+            fields = [defn.GetFieldDefn(i).GetName() for i in range(defn.GetFieldCount())]
+            self.payload = GeometryPayload.from_layer(layer, fields)
+        return self.payload
+
+    def __getstate__(self):
+        # The open shape file cannot be pickled, so the geometries are sent
+        # as WKB with their envelopes, and rebuilt once by the receiver
+        return {'filename': self.filename, 'payload': self.getPayload()}
+
+    def __setstate__(self, state):
+        from utils_geometry import Area
+        self.__init__(state['filename'])
+        self.payload = state['payload']
+        self.area = Area(self.payload)
     
     def getCountry(self, point):
         """
@@ -52,7 +86,12 @@ class CountryChecker(object):
         Output is either country shape index or None
         """
         
-        for i in range(self.layer.GetFeatureCount()):
+        if self.area is not None:
+            # only the shapes whose envelope holds the point are tested
+            shapes = self.area.candidates(point.ogr.GetY(), point.ogr.GetX())
+        else:
+            shapes = range(self.layer.GetFeatureCount())
+        for i in shapes:
             country = self.layer.GetFeature(i)
             if country.geometry().Contains(point.ogr):
                 return Country(country)
@@ -1,16 +1,24 @@
 import argparse
 import json
 import glob
+import os
+from functools import partial
 from datetime import datetime, timedelta
 import dateutil.parser
 import pandas as pd
 import numpy as np
 import xarray as xr
-import plotly.graph_objects as go
 # local
 from countries import countries
-
-GEOMETRY = None
+from utils_cube import CubeStore
+from utils_regions import build_registry, load_registry, save_registry, write_if_changed, compute_grid_masks
+from utils_render import to_grid, grid_bounds, colorscale_to_cmap, render_png, png_data_uri
+from utils_derived import convert_units
+from utils_prefetch import prefetch, load_dataset
+from utils_aggregate import LeadStack, STATISTICS
+from utils_stats import RunningStats
+
+# the shapefile is opened on the first lookup, not at import
 CC = countries.CountryChecker('500cities/cities.shp')
 PLACES = [
     { 'city': 'New Orleans', 'state': 'LA' },
@@ -21,97 +29,67 @@ PLACES = [
     { 'city': 'Portland', 'state': 'OR' }
 ]
 
-def within_area(latlon):
-    global GEOMETRY
-    lat = float(latlon[0])
-    lon = float(latlon[1])
-    # longitude values in the data are from 0 to 360
-    # but longitude values in the shapefile are -180 to 180
-    if lon > 180:
-        lon = lon - 360
-    # find the shapefile region that this point is inside of
-    # area = CC.getCountry(countries.Point(lat, lon))
-    point = CC.getPoint(lat, lon)
-    contained = GEOMETRY.Contains(point)
-    if contained:
-        return True
+def json_number(value):
+    """
+    Return a number that JSON can represent, with None for NaN
+    """
+    if isinstance(value, int):
+        return value
+    return None if value is None or np.isnan(value) else float(value)
+
+def get_registry(registry_path=None):
+    """
+    Return the regions of all places, loading them from the registry file
+    if it exists, otherwise resolving them from the shapefile.
+    Places missing from the registry file are resolved from the shapefile
+    and the file is saved again with them.
+    The area of each city is saved to GeoJSON when it has changed.
+    """
+    if registry_path and os.path.exists(registry_path):
+        registry = load_registry(registry_path)
+        missing = [p for p in PLACES if p['city'] not in registry]
+        if missing:
+            registry.update(build_registry(CC, missing))
+            save_registry(registry_path, registry)
     else:
-        return False
-
-def filter_data(dataset):
-    global GEOMETRY
-
-    df = dataset.to_dataframe()
-    df = df.loc[:,['time','tp']]
-
-    df_us = df.sort_index(level=0)
-
-    latvals = df_us.index.get_level_values('latitude')
-    lonvals = df_us.index.get_level_values('longitude')
-
-    # initialize values
-    minlat = 90
-    maxlat = -90
-    minlon = 180
-    maxlon = -180
-    buf = json.loads(GEOMETRY.ExportToJson())
-    for coord in buf['coordinates'][0]:
-        lon = coord[0]
-        lat = coord[1]
-        if lat < minlat:
-            minlat = lat
-        if lat > maxlat:
-            maxlat = lat
-        if lon < minlon:
-            minlon = lon
-        if lon > maxlon:
-            maxlon = lon
-
-    # print(minlat, maxlat, minlon, maxlon)
-
-    # convert longitude to 0-360 range
-    if minlon < 0:
-        minlon += 360
-    if maxlon < 0:
-        maxlon += 360
-
-    # print(minlat, maxlat, minlon, maxlon)
-
-    # latitude filter
-    latfilter = ((latvals >= minlat) & (latvals <= maxlat))
-    # longitude filter
-    lonfilter = ((lonvals >= minlon) & (lonvals <= maxlon))
-    # apply filters to the dataframe
-    df_us = df_us.loc[latfilter & lonfilter]
-
-    # add another boolean column to our data
-    # which we can then filter on to delete unwanted rows
-    df_us['inArea'] = df_us.index.map(within_area)
-
-    # national filter
-    df_us = df_us[df_us['inArea'] != False]
-
-    # reset lat and lon vals based on filtered dataframe
-    latvals = df_us.index.get_level_values('latitude')
-    lonvals = df_us.index.get_level_values('longitude')
-
-    # step = 0.75
-    # to_bin = lambda x: np.floor(x/step)*step
-    to_bin = lambda x: x
-    df_us["latbin"] = latvals.map(to_bin)
-    df_us["lonbin"] = lonvals.map(to_bin)
-    # df_us['time'] = '2020-04-07'
-
-    df_flat = df_us.drop_duplicates(subset=['latbin','lonbin'])
-
-    df_no_nan = df_flat[np.isfinite(df_flat['tp'])]
+        registry = build_registry(CC, PLACES)
+    for region in registry.values():
+        # save the city area to GeoJSON
+        city = region.name.replace(' ', '_')
+        write_if_changed('areas_geojson/' + city + '.geojson', region.feature_json)
+    return registry
+
+def filter_data(dataset, region):
+    """
+    Crop the precipitation data to the grid points inside of the region,
+    using the region's grid mask which is computed once per grid
+    """
+    lats = dataset['latitude'].values
+    lons = dataset['longitude'].values
+    lat_idx, lon_idx, mask = region.grid_mask(lats, lons)
+    rows, cols = np.nonzero(mask)
+
+    # only the cells inside of the region are read
+    tp = dataset['tp'].isel(latitude=lat_idx, longitude=lon_idx).values
+    tp = tp.reshape(mask.shape)[rows, cols]
+
+    latvals = lats[lat_idx][rows]
+    lonvals = lons[lon_idx][cols]
+    index = pd.MultiIndex.from_arrays([latvals, lonvals], names=['latitude', 'longitude'])
+
+    df_us = pd.DataFrame({'latbin': latvals, 'lonbin': lonvals, 'tp': tp}, index=index)
+    df_us = df_us.sort_index(level=0)
+
+    df_no_nan = df_us[np.isfinite(df_us['tp'])]
     df_viz = df_no_nan.loc[:, ['latbin','lonbin','tp']]
 
     return df_viz
 
-def visualize(df_viz, mapbox_token):
+def visualize(df_viz, mapbox_token, raster=True):
+    # plotly is only imported when a plot is requested
+    import plotly.graph_objects as go
 
-    df_viz['tp'] = df_viz['tp'] * 0.0393701 # conversion from mm to in
+    df_viz['tp'] = convert_units(df_viz['tp'], 'mm', 'in')
     # max_precip = 6 # limiting the highest daily precipitation for coloring plot
     # df_viz['tp'][df_viz['tp'] >= max_precip] = max_precip 
     # df_viz.tail(20)
@@ -133,26 +111,62 @@ def visualize(df_viz, mapbox_token):
     # print(val_max, val_min)
 
     data = []
-
-    # https://images.plot.ly/plotly-documentation/images/python_cheat_sheet.pdf?_ga=2.113218049.441476779.1587291103-1421256715.1585761166
-    data.append(
-        go.Scattermapbox(
-            lon=df_viz['lonbin'].values,
-            lat=df_viz['latbin'].values,
-            mode='markers',
-            text=df_viz['tp'].values,
-            marker=go.Marker(
-                cmax=val_max,
-                cmin=val_min,
-                color=df_viz['tp'].values,
-                colorscale=colorscale,
-                reversescale=True,
-                showscale = True,
-                opacity = 0.65
-        
-            ),
+    layers = []
+
+    if raster:
+        # draw the whole grid as a single image overlay,
+        # so the plot size does not depend on the number of points
+        lons = df_viz['lonbin'].values
+        # longitude values in the data are from 0 to 360
+        lons = np.where(lons > 180, lons - 360, lons)
+        lat_axis, lon_axis, grid = to_grid(df_viz['latbin'].values, lons, df_viz['tp'].values)
+        west, east, south, north = grid_bounds(lat_axis, lon_axis)
+        cmap = colorscale_to_cmap(colorscale, reverse=True)
+        png = render_png(grid, cmap, val_min, val_max)
+        layers.append(dict(
+            sourcetype='image',
+            source=png_data_uri(png),
+            coordinates=[[west, north], [east, north], [east, south], [west, south]],
+            opacity=0.65
+        ))
+        # an invisible two-point trace, only to show the color scale
+        data.append(
+            go.Scattermapbox(
+                lon=[west, west],
+                lat=[south, south],
+                mode='markers',
+                hoverinfo='skip',
+                marker=go.scattermapbox.Marker(
+                    cmax=val_max,
+                    cmin=val_min,
+                    color=[val_min, val_max],
+                    colorscale=colorscale,
+                    reversescale=True,
+                    showscale = True,
+                    opacity = 0
+                ),
+            )
+        )
+    else:
+        # https://images.plot.ly/plotly-documentation/images/python_cheat_sheet.pdf?_ga=2.113218049.441476779.1587291103-1421256715.1585761166
+        data.append(
+            go.Scattermapbox(
+                lon=df_viz['lonbin'].values,
+                lat=df_viz['latbin'].values,
+                mode='markers',
+                text=df_viz['tp'].values,
+                marker=go.Marker(
+                    cmax=val_max,
+                    cmin=val_min,
+                    color=df_viz['tp'].values,
+                    colorscale=colorscale,
+                    reversescale=True,
+                    showscale = True,
+                    opacity = 0.65
+            
+                ),
+            )
         )
-    )
 
     layout = go.Layout(
         margin=dict(t=0,b=0,r=0,l=0),
@@ -168,54 +182,62 @@ def visualize(df_viz, mapbox_token):
             ),
             pitch=0,
             zoom=4,
-            style='dark'
+            style='dark',
+            layers=layers
         ),
     )
 
     fig = go.Figure(data=data, layout=layout)
     fig.show()
 
-    # print out how long this script run took
-    ending = datetime.now()
-    print('Ending:', ending)
-    print()
-    print('Elapsed:', ending - starting)
+def run(filenames, cube_path=None, registry_path=None, prefetch_depth=0, aggregate=None, window_hours=24, rolling=False, tz='UTC', processes=0, prefetch_threads=False):
+    """
+    Process the forecast files in order, writing the per-time city CSVs,
+    the combined CSV and the city averages.
+    With a prefetch depth, the next files are decoded in full on
+    background processes (or threads) while the current one is filtered
+    and written, otherwise only the values inside of the cities are decoded.
+    With a list of statistics to aggregate, the precipitation of every
+    time window is also written, e.g. daily totals into `precip_data/daily`.
+    With a number of processes, the grid masks of the cities are computed
+    in parallel the first time a grid is seen.
+    Can be called repeatedly from one process, since the shapefile
+    and the other heavy resources are only loaded once.
+    """
+    # resolve the city regions once for all files
+    registry = get_registry(registry_path)
 
-if __name__ == '__main__':
-    parser = argparse.ArgumentParser()
-    parser.add_argument('mapbox_token', help='the CSV file to inspect')
-    args = parser.parse_args()
+    all_data = pd.DataFrame()
 
-    starting = datetime.now()
-    print('Starting:', starting)
+    previous_time_data = {}
+
+    if cube_path:
+        cube = CubeStore(cube_path, variables=['tp_min', 'tp_max', 'tp_mean', 'tp_stdev', 'tp_p50', 'tp_p90', 'tp_p99'])
 
+    # the city statistics of each time are written as soon as they are computed
+    os.makedirs('means/stats', exist_ok=True)
+    # the city averages of every time, written to means.js at the end
     all_means = {}
-    all_data = pd.DataFrame()
 
-    filenames = glob.glob('forecast/*.grib2')
-    filenames = sorted(filenames)
+    # the precipitation of every lead time, for the time window statistics
+    stack = LeadStack(['precip'])
 
-    previous_time_data = {}
-
-    for filename in filenames:
-        DATASET = xr.open_dataset(
-            filename,
-            engine='cfgrib'
-        )
+    # decode the files ahead of time only when prefetching
+    loader = partial(load_dataset, engine='cfgrib', lazy=not prefetch_depth)
+    for filename, DATASET in prefetch(filenames, loader, prefetch_depth, not prefetch_threads):
 
         dataframes = []
         means = {}
+        city_stats = {}
+        stats = {'tp_min': [], 'tp_max': [], 'tp_mean': [], 'tp_stdev': [], 'tp_p50': [], 'tp_p90': [], 'tp_p99': []}
+
+        if processes:
+            compute_grid_masks(registry, DATASET['latitude'].values, DATASET['longitude'].values, processes)
 
         for p in PLACES:
             city = p['city']
-            # get the city feature from the shapefile
-            feature = CC.getFeature(city, p['state'])
-            # get the centroid point of the city feature
-            centroid = feature.geometry().Centroid()
-            # create a 1-degree buffer around the centroid
-            GEOMETRY = centroid.Buffer(1)
-            # filter the weather data to the buffer region
-            accum_df = filter_data(DATASET)
+            # filter the weather data to the 1-degree buffer region around the city
+            accum_df = filter_data(DATASET, registry[city])
             # make a new copy of the dataframe
             df = accum_df.copy(deep=True )
             # convert from accumulated value
@@ -229,22 +251,22 @@ if __name__ == '__main__':
             df.drop(columns=['latbin', 'lonbin'])
             # store the result
             dataframes.append(df)
-            # print some statistics
-            val_min = df['tp'].min()
-            val_max = df['tp'].max()
-            val_mean = df['tp'].mean()
-            val_stdev = df['tp'].std()
-            # print()
-            # print(city)
-            # print("max: " + str(val_max))
-            # print("min: " + str(val_min))
-            # print("mean: " + str(val_mean))
-            # print("stdev: " + str(val_stdev))
-            means[city] = str(val_mean)
-            # save the city area to GeoJSON
-            city = city.replace(' ', '_')
-            with open('areas_geojson/' + city + '.geojson', 'w') as outfile:
-                outfile.write(feature.ExportToJson())
+            # compute all of the statistics in one pass over the city's cells
+            running = RunningStats().update(df['tp'].values)
+            summary = running.summary()
+            # the averages keep the original format, the mean in the precision of the data
+            means[city] = str(df['tp'].mean())
+            stats['tp_min'].append(summary['min'])
+            stats['tp_max'].append(summary['max'])
+            stats['tp_mean'].append(summary['mean'])
+            stats['tp_stdev'].append(summary['std'])
+            stats['tp_p50'].append(summary['p50'])
+            stats['tp_p90'].append(summary['p90'])
+            stats['tp_p99'].append(summary['p99'])
+            # the mergeable state is kept so that cities or runs can be combined later
+            city_stats[city] = {key: json_number(value) for key, value in summary.items()}
+            city_stats[city]['state'] = running.to_dict()
+        DATASET.close()
 
         # convert filename to datetime object
         hours = int(filename[-9:-6])
@@ -252,16 +274,32 @@ if __name__ == '__main__':
         dt = dateutil.parser.parse(date) + timedelta(hours=hours)
         # convert datetime object to string
         forecast_time = str(dt)
-        # store the city averages for this time
+        # append the city statistics to the chunked store
+        if cube_path:
+            cities = [p['city'] for p in PLACES]
+            cube.append(dateutil.parser.parse(date), hours, cities, stats)
+        # store the city averages and write the statistics of this time
         all_means[forecast_time] = means
+        with open('means/stats/' + forecast_time + '.json', 'w') as outfile:
+            json.dump(city_stats, outfile, separators=(',', ':'))
         # combine all city data into one dataframe
         dataframe = pd.concat(dataframes)
+        if aggregate:
+            stack.append(dt, dataframe.reset_index().rename(columns={'tp': 'precip'}))
         dataframe['time'] = forecast_time
         dataframe = dataframe.loc[:, ['tp','time']]
         all_data = pd.concat([all_data, dataframe])
         # export the combined cities dataframe to CSV, named by time
         dataframe.to_csv('precip_data/' + forecast_time + '.csv')
 
+    # the precipitation is accumulated over the step ending at each time
+    if aggregate:
+        stack.write('precip_data', aggregate, window_hours, rolling, tz, accumulated=True)
+
+    # save the regions with their grid masks for the next run
+    if registry_path:
+        save_registry(registry_path, registry)
+
     with open('means/means.js', 'w') as outfile:
         outfile.write('var AVERAGES = ' + json.dumps(all_means, indent=4) + ';')
 
@@ -270,4 +308,32 @@ if __name__ == '__main__':
     all_data = all_data.loc[:, ['precip','time']]
     all_data.to_csv('precip_data/COMBINED.csv')
 
-    # visualize(dataframe, args.mapbox_token)
+    return all_data
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('mapbox_token', help='the CSV file to inspect')
+    parser.add_argument('--cube', default=None, help='directory of a chunked store to append the city statistics to')
+    parser.add_argument('--registry', default=None, help='JSON file to load the city regions from, and save them to')
+    parser.add_argument('--prefetch', type=int, default=0, help='number of files to decode ahead in the background')
+    parser.add_argument('--prefetch-threads', action='store_true', help='decode ahead on threads instead of processes, only for thread-safe decoders')
+    parser.add_argument('--aggregate', nargs='+', choices=STATISTICS, default=None, help='also write these statistics over time windows of the lead times')
+    parser.add_argument('--window', type=int, default=24, help='length of the aggregation windows in hours')
+    parser.add_argument('--rolling', action='store_true', help='aggregate over trailing windows ending at each lead time instead of calendar windows')
+    parser.add_argument('--timezone', default='UTC', help='time zone of the calendar windows, e.g. America/Chicago')
+    parser.add_argument('--processes', type=int, default=0, help='number of worker processes computing the city grid masks of a new grid')
+    args = parser.parse_args()
+
+    starting = datetime.now()
+    print('Starting:', starting)
+
+    filenames = glob.glob('forecast/*.grib2')
+    filenames = sorted(filenames)
+
+    all_data = run(filenames, args.cube, args.registry, args.prefetch, args.aggregate, args.window, args.rolling, args.timezone, args.processes, args.prefetch_threads)
+
+    # print out how long this script run took
+    ending = datetime.now()
+    print('Ending:', ending)
+    print()
+    print('Elapsed:', ending - starting)
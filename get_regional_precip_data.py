@@ -8,19 +8,16 @@ It then crops the data to the area of a provided shapefile.
 import argparse
 import xarray as xr
 import pandas as pd
-import matplotlib.pyplot as plt
-from osgeo.ogr import GetDriverByName
 import os
 import sys
 dir_path = os.path.dirname(os.path.realpath(__file__))
 parent = os.path.join(dir_path, os.pardir)
 sys.path.append(os.path.join(parent,'..'))
-from utils_grib import coarse_geo_filter, precise_geo_filter
-# Load the shapefile area
-filename = os.path.join(dir_path, 'shpfile/italy.shp')
-driver = GetDriverByName('ESRI Shapefile')
-shpfile = driver.Open(filename)
-AREA = shpfile.GetLayer()
+from utils_grib import coarse_geo_filter, precise_geo_filter, load_area
+from utils_grib_index import open_subset
+from utils_render import to_grid, grid_bounds
+# The shapefile area is only opened when data is first filtered
+AREA_FILE = os.path.join(dir_path, 'shpfile/italy.shp')
 
 # DEF_VARIABLES = (
 #     'TMP_P0_L103_GLL0',        # Temperature
@@ -38,15 +35,21 @@ AREA = shpfile.GetLayer()
 # )
 
 # Load and filter grib data to get regional precipitation
-def parse_data(filepath1, filepath2):
-    # Load the grib files into xarray datasets
-    ds1 = xr.open_dataset(filepath1, engine='pynio')
-    ds2 = xr.open_dataset(filepath2, engine='pynio')
-    # Print information on data variables
-    # print(ds1.keys())
-    # Convert the xarray datasets to dataframes
-    df1 = ds1.to_dataframe()
-    df2 = ds2.to_dataframe()
+def parse_data(filepath1, filepath2, area_file=AREA_FILE):
+    # Get the shapefile area, which is opened once per process
+    AREA = load_area(area_file)
+    # Load only the precipitation messages of the grib files into xarray datasets
+    variables = ['APCP_P8_L1_GLL0_acc']
+    with open_subset(filepath1, variables) as subset1, open_subset(filepath2, variables) as subset2:
+        ds1 = xr.open_dataset(subset1, engine='pynio')
+        ds2 = xr.open_dataset(subset2, engine='pynio')
+        # Print information on data variables
+        # print(ds1.keys())
+        # Convert the xarray datasets to dataframes
+        df1 = ds1.to_dataframe()
+        df2 = ds2.to_dataframe()
+        ds1.close()
+        ds2.close()
     # Create a new dataframe with the same lat/lon index
     df = pd.DataFrame(index=df1.index)
     # Since the grib data is forecast-total accumulated precipitation,
@@ -65,19 +68,32 @@ def parse_data(filepath1, filepath2):
     return df_viz
 
 # Visualize the data
-def plot_data(data):
+def plot_data(data, raster=True):
+    # matplotlib is only imported when plotting
+    import matplotlib.pyplot as plt
     x = data['longitude'].values
     y = data['latitude'].values
     color = data['precip'].values
-    plt.scatter(
-        x,
-        y,
-        c=color,
-        s=10,
-        cmap='Blues',
-        edgecolors='gray',
-        linewidths=0.1
-    )
+    if raster:
+        # Draw the regular grid as a single image instead of one marker per point
+        lat_axis, lon_axis, grid = to_grid(y, x, color)
+        plt.imshow(
+            grid,
+            origin='lower',
+            extent=grid_bounds(lat_axis, lon_axis),
+            cmap='Blues',
+            interpolation='nearest'
+        )
+    else:
+        plt.scatter(
+            x,
+            y,
+            c=color,
+            s=10,
+            cmap='Blues',
+            edgecolors='gray',
+            linewidths=0.1
+        )
     plt.title('Precipitation (mm)')
     plt.colorbar()
     plt.show()
@@ -92,6 +108,9 @@ if __name__ == '__main__':
     parser.add_argument(
         'filepath2', type=str, help='The path to the later Basic bundle GRIB file to open'
     )
+    parser.add_argument(
+        '--markers', action='store_true', help='Plot one marker per grid point instead of a raster image'
+    )
     args = parser.parse_args()
     data = parse_data(args.filepath1, args.filepath2)
-    plot_data(data)
+    plot_data(data, raster=not args.markers)
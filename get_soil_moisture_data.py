@@ -1,85 +1,170 @@
+import argparse
 import glob
+from functools import partial
 from datetime import datetime, timedelta
 import dateutil.parser
 import pandas as pd
 import numpy as np
 import xarray as xr
+# local
+from utils_cube import CubeStore
+from utils_landmask import load_land_mask
+from utils_prefetch import prefetch, load_dataset
+from utils_aggregate import LeadStack, STATISTICS
 
-def parse_data(ds):
-    # Print information on data variables
-    # print(ds.keys())
-    # Rename the wind variables for clarity
-    ds = ds.rename({'SOILW_P0_2L106_GLL0': 'soil_moisture'})
-    # Get only the wind values to reduce the volume of data,
-    # otherwise converting to a dataframe will take a long time
-    ds = ds.get(['soil_moisture'])
-    # Convert the xarray dataset to a dataframe
-    df = ds.to_dataframe()
-    # Get longitude values from index
-    lons = df.index.get_level_values('lon_0')
-    # Map longitude range from (0 to 360) into (-180 to 180)
-    maplon = lambda lon: (lon - 360) if (lon > 180) else lon
-    # Create new longitude and latitude columns in the dataframe
-    df['longitude'] = lons.map(maplon)
-    df['latitude'] = df.index.get_level_values('lat_0')
-    df['depth'] = df.index.get_level_values('lv_DBLL0')
-    # Get the area's bounding box
-    minlon = -23
-    maxlon = 82
-    minlat = -11
-    maxlat = 42
-    # Perform an initial coarse filter on the global dataframe
-    # by limiting the data to the area's bounding box,
-    # thereby reducing the total processing time of the `area_filter`
-    latfilter = ((df['latitude'] >= minlat) & (df['latitude'] <= maxlat))
-    lonfilter = ((df['longitude'] >= minlon) & (df['longitude'] <= maxlon))
-    # depth filter
+# The only variable read from the forecast files
+SOIL_VARIABLES = ['SOILW_P0_2L106_GLL0']
+# Columns written to the output CSVs
+COLUMNS = ['latitude','longitude','soil_moisture','time']
+# The area's bounding box
+MINLON = -23
+MAXLON = 82
+MINLAT = -11
+MAXLAT = 42
+# Estimated peak number of bytes held per grid cell while a band is filtered,
+# covering the band's values, the coordinates and the dataframe built from them
+BYTES_PER_CELL = 64
+
+def parse_data_chunked(ds, memory_budget_mb=None, land_file=None):
+    """
+    Filter the soil moisture of the top layer (0-10cm) to the area's
+    bounding box and to land, working through the grid in bands of
+    latitude rows sized to the memory budget,
+    yielding one filtered dataframe per band.
+    Water cells are removed with the static land mask of the grid,
+    so only land cells are ever turned into rows,
+    and cells missing from the file are removed as well.
+    Each band is read from the dataset on its own, so with a lazily
+    opened file only one band of the field is held in memory at a time.
+    The whole field is only read once per grid, to derive the land mask
+    when none is saved yet.
+    """
+    da = ds['SOILW_P0_2L106_GLL0']
+    # depth filter, applied before any values are decoded
     # # depth of 0 = '0-10cm'
-    # # depth of 1 = '10-40cm'
-    # # depth of 2 = '40-100cm'
-    # # depth of 3 = '100-200cm'
-    depthfilter = (df['depth'] == 0)
-    # water filter (oceans and lakes have soil moisture 100% so we exclude those)
-    waterfilter = (df['soil_moisture'] < 1)
-    # Apply filters to the dataframe
-    df = df.loc[latfilter & lonfilter & depthfilter & waterfilter]
-    return df
+    da = da.sel(lv_DBLL0=0)
+    lats = da['lat_0'].values
+    lons = da['lon_0'].values
+    # The land mask is derived from this field the first time the grid is seen
+    land = load_land_mask(lats, lons, soil_moisture=lambda: da.values, area_file=land_file)
+    # Map longitude range from (0 to 360) into (-180 to 180)
+    lons = np.where(lons > 180, lons - 360, lons)
+    # Limit the grid axes to the area's bounding box
+    lat_idx = np.nonzero((lats >= MINLAT) & (lats <= MAXLAT))[0]
+    lon_idx = np.nonzero((lons >= MINLON) & (lons <= MAXLON))[0]
+    if len(lon_idx) == 0:
+        return
+    # Number of latitude rows that fit in the memory budget
+    if memory_budget_mb:
+        band = int(memory_budget_mb * 1024 * 1024 // (len(lon_idx) * BYTES_PER_CELL))
+        band = max(1, band)
+    else:
+        band = len(lat_idx)
+    for start in range(0, len(lat_idx), band):
+        rows = lat_idx[start:start + band]
+        # Read the rows of this band, which are contiguous, from the dataset
+        values = da.isel(lat_0=slice(rows[0], rows[-1] + 1), lon_0=lon_idx).values
+        # Index of the land cells of this band, without the cells
+        # that are missing from this file
+        landband = land[np.ix_(rows, lon_idx)] & np.isfinite(values)
+        band_rows, band_cols = np.nonzero(landband)
+        # Only the land cells of this band are kept
+        soil_moisture = values[landband]
+        yield pd.DataFrame({
+            'latitude': lats[rows][band_rows],
+            'longitude': lons[lon_idx][band_cols],
+            'soil_moisture': soil_moisture,
+        })
 
-if __name__ == '__main__':
+def run(filenames, cube_path=None, memory_budget_mb=None, land_file=None, prefetch_depth=0, aggregate=None, window_hours=24, rolling=False, tz='UTC', prefetch_threads=False):
+    """
+    Process the forecast files in order,
+    writing one CSV per time and a combined CSV.
+    With a memory budget the grid is processed in latitude bands,
+    and each band is streamed to the CSVs before the next is filtered.
+    Otherwise each file is only opened, and the field is decoded
+    when it is filtered.
+    With a prefetch depth, the next files are decoded in full on
+    background processes (or threads) while the current one is filtered
+    and written. This holds several decoded files in memory, so it cannot
+    be combined with a memory budget.
+    With a list of statistics to aggregate, the soil moisture of every
+    time window is also written, e.g. daily means into `sm_data/daily`.
+    Returns the filtered data of all files, as written to the combined CSV.
+    """
+    if memory_budget_mb and prefetch_depth:
+        raise ValueError('Files cannot be prefetched within a memory budget')
 
-    all_data = pd.DataFrame()
+    if cube_path:
+        cube = CubeStore(cube_path, variables=['soil_moisture'], station_chunk=1024)
 
-    filenames = glob.glob('forecast/*.grib2')
-    filenames = sorted(filenames)
+    # the soil moisture of every lead time, for the time window statistics
+    stack = LeadStack(['soil_moisture'])
+    # the filtered land cells of the area, which are small next to the global grid
+    all_data = []
+
+    # the combined CSV is appended to as each file is processed,
+    # instead of holding all of the data in memory
+    with open('sm_data/COMBINED.csv', 'w') as combined:
+        combined.write(','.join(COLUMNS) + '\n')
 
-    for filename in filenames:
-        DATASET = xr.open_dataset(filename, engine='pynio')
-        # filter the weather data to the buffer region
-        dataframe = parse_data(DATASET)
-        # # print some statistics
-        # val_min = df['soil_moisture'].min()
-        # val_max = df['soil_moisture'].max()
-        # val_mean = df['soil_moisture'].mean()
-        # val_stdev = df['soil_moisture'].std()
-        # # print()
-        # # print("max: " + str(val_max))
-        # # print("min: " + str(val_min))
-        # # print("mean: " + str(val_mean))
-        # # print("stdev: " + str(val_stdev))
+        # only decode the soil moisture messages of each file,
+        # and only ahead of time when prefetching
+        loader = partial(load_dataset, variables=SOIL_VARIABLES, lazy=not prefetch_depth)
+        for filename, DATASET in prefetch(filenames, loader, prefetch_depth, not prefetch_threads):
+            # convert filename to datetime object
+            hours = int(filename[-9:-6])
+            date = filename[15:23]
+            dt = dateutil.parser.parse(date) + timedelta(hours=hours)
+            # convert datetime object to string
+            forecast_time = str(dt)
 
-        # convert filename to datetime object
-        hours = int(filename[-9:-6])
-        date = filename[15:23]
-        dt = dateutil.parser.parse(date) + timedelta(hours=hours)
-        # convert datetime object to string
-        forecast_time = str(dt)
+            with open('sm_data/' + forecast_time + '.csv', 'w') as outfile:
+                outfile.write(','.join(COLUMNS) + '\n')
+                bands = []
+                # filter the weather data to the region
+                dataframes = parse_data_chunked(DATASET, memory_budget_mb, land_file)
+                for dataframe in dataframes:
+                    # append the grid values to the chunked store, one station per grid cell
+                    if cube_path:
+                        stations = dataframe['latitude'].astype(str) + ',' + dataframe['longitude'].astype(str)
+                        cube.append(dateutil.parser.parse(date), hours, stations, {'soil_moisture': dataframe['soil_moisture'].values})
 
-        dataframe['time'] = forecast_time
-        dataframe = dataframe.loc[:, ['latitude','longitude','soil_moisture','time']]
-        all_data = pd.concat([all_data, dataframe])
-        # export the combined dataframe to CSV, named by time
-        dataframe.to_csv('sm_data/' + forecast_time + '.csv', index=False)
+                    if aggregate:
+                        bands.append(dataframe)
+                    dataframe['time'] = forecast_time
+                    dataframe = dataframe.loc[:, COLUMNS]
+                    all_data.append(dataframe)
+                    # export the dataframe to the CSV named by time and to the combined CSV
+                    dataframe.to_csv(outfile, index=False, header=False)
+                    dataframe.to_csv(combined, index=False, header=False)
+                DATASET.close()
+                if aggregate:
+                    stack.append(dt, pd.concat(bands))
+
+    if aggregate:
+        stack.write('sm_data', aggregate, window_hours, rolling, tz)
+
+    if not all_data:
+        return pd.DataFrame(columns=COLUMNS)
+    return pd.concat(all_data, ignore_index=True)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--cube', default=None, help='directory of a chunked store to append the grid values to')
+    parser.add_argument('--memory-budget', type=float, default=None, help='process the grid in latitude bands using at most this many megabytes')
+    parser.add_argument('--land-mask-shapefile', default=None, help='derive the land mask from this shapefile instead of the soil moisture field')
+    parser.add_argument('--prefetch', type=int, default=0, help='number of files to decode ahead in the background')
+    parser.add_argument('--prefetch-threads', action='store_true', help='decode ahead on threads instead of processes, only for thread-safe decoders')
+    parser.add_argument('--aggregate', nargs='+', choices=STATISTICS, default=None, help='also write these statistics over time windows of the lead times')
+    parser.add_argument('--window', type=int, default=24, help='length of the aggregation windows in hours')
+    parser.add_argument('--rolling', action='store_true', help='aggregate over trailing windows ending at each lead time instead of calendar windows')
+    parser.add_argument('--timezone', default='UTC', help='time zone of the calendar windows, e.g. America/Chicago')
+    args = parser.parse_args()
+    if args.memory_budget and args.prefetch:
+        parser.error('--prefetch cannot be combined with --memory-budget')
+
+    filenames = glob.glob('forecast/*.grib2')
+    filenames = sorted(filenames)
 
-    # ALL DATA
-    all_data = all_data.loc[:, ['latitude','longitude','soil_moisture','time']]
-    all_data.to_csv('sm_data/COMBINED.csv', index=False)
+    run(filenames, args.cube, args.memory_budget, args.land_mask_shapefile, args.prefetch, args.aggregate, args.window, args.rolling, args.timezone, args.prefetch_threads)
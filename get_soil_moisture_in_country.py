@@ -1,7 +1,8 @@
 import os
 import sys
 import glob
-from osgeo.ogr import GetDriverByName
+import argparse
+from functools import partial
 from datetime import datetime, timedelta
 import dateutil.parser
 import pandas as pd
@@ -10,75 +11,112 @@ import xarray as xr
 dir_path = os.path.dirname(os.path.realpath(__file__))
 parent = os.path.join(dir_path, os.pardir)
 sys.path.append(os.path.join(parent,'..'))
-from utils_grib import coarse_geo_filter, precise_geo_filter
-# Load the shapefile area
-filename = os.path.join(dir_path, 'ukraine/ukraine.shp')
-driver = GetDriverByName('ESRI Shapefile')
-shpfile = driver.Open(filename)
-AREA = shpfile.GetLayer()
+from utils_grib import grid_area_mask
+from utils_landmask import load_land_mask
+from utils_prefetch import prefetch, load_dataset
+from utils_aggregate import LeadStack, STATISTICS
+# The shapefile area is only opened when data is first filtered
+AREA_FILE = os.path.join(dir_path, 'ukraine/ukraine.shp')
 
-# TMP_P0_L1_GLL0
-# LHTFL_P0_L1_GLL0 
-# SHTFL_P0_L1_GLL0 
-# SPFH_P0_L103_GLL0
-# TSOIL_P0_2L106_GLL0
-# SOILW_P0_2L106_GLL0
-# DSWRF_P8_L1_GLL0_acc
-# USWRF_P8_L1_GLL0_acc
-# DLWRF_P8_L1_GLL0_acc
-# ULWRF_P8_L1_GLL0_acc
-# ULWRF_P8_L8_GLL0_acc
+# The only variable read from the agricultural files
+SOIL_VARIABLES = ['SOILW_P0_2L106_GLL0']
+
+# The variables of a full agricultural profile
+PROFILE_VARIABLES = [
+    'TMP_P0_L1_GLL0',          # Temperature
+    'LHTFL_P0_L1_GLL0',        # Latent heat net flux
+    'SHTFL_P0_L1_GLL0',        # Sensible heat net flux
+    'SPFH_P0_L103_GLL0',       # Specific humidity
+    'TSOIL_P0_2L106_GLL0',     # Soil temperature
+    'SOILW_P0_2L106_GLL0',     # Volumetric soil moisture content
+    'DSWRF_P8_L1_GLL0_acc',    # Downward short-wave radiation flux
+    'USWRF_P8_L1_GLL0_acc',    # Upward short-wave radiation flux
+    'DLWRF_P8_L1_GLL0_acc',    # Downward long-wave radiation flux
+    'ULWRF_P8_L1_GLL0_acc',    # Upward long-wave radiation flux (surface)
+    'ULWRF_P8_L8_GLL0_acc',    # Upward long-wave radiation flux (top of atmosphere)
+]
 # lv_DBLL0_l1
 # lv_DBLL0_l0
 
-def parse_data(ds):
-    # Print information on data variables
-    # print(ds.keys())
-    # Rename the wind variables for clarity
-    ds = ds.rename({'SOILW_P0_2L106_GLL0': 'soil_moisture'})
-    # Get only the wind values to reduce the volume of data,
-    # otherwise converting to a dataframe will take a long time
-    ds = ds.get(['soil_moisture'])
-    # Convert the xarray dataset to a dataframe
-    df = ds.to_dataframe()
-    # Get longitude values from index
-    lons = df.index.get_level_values('lon_0')
-    # Map longitude range from (0 to 360) into (-180 to 180)
-    maplon = lambda lon: (lon - 360) if (lon > 180) else lon
-    # Create new longitude and latitude columns in the dataframe
-    df['longitude'] = lons.map(maplon)
-    df['latitude'] = df.index.get_level_values('lat_0')
-    df['depth'] = df.index.get_level_values('lv_DBLL0')
-    # Perform an initial coarse filter on the global dataframe
-    # by limiting the data to the area's bounding box,
-    # thereby reducing the total processing time of the `precise_geo_filter`
-    df = coarse_geo_filter(df, AREA)
-    # Perform the precise filter to remove data outside of the shapefile area
-    df = precise_geo_filter(df, AREA)
-    # depth filter
-    # # depth of 0 = '0-10cm'
-    # # depth of 1 = '10-40cm'
-    # # depth of 2 = '40-100cm'
-    # # depth of 3 = '100-200cm'
-    depthfilter = (df['depth'] == 0)
-    # water filter (oceans and lakes have soil moisture 100% so we exclude those)
-    waterfilter = (df['soil_moisture'] < 1)
-    # Apply filters to the dataframe
-    df = df.loc[depthfilter & waterfilter]
+def parse_profile(ds, variables, depths=(0,), area_file=AREA_FILE, land_file=None, processes=0):
+    """
+    Extract several variables and soil depths in one pass,
+    returning a wide dataframe with one row per land grid point
+    inside of the shapefile area, and one column per (variable, depth).
+    The area and land masks are computed once per grid and applied to every field,
+    the area mask on a pool of `processes` workers if given.
+    Grid points where the file's soil moisture is missing are left out.
+    """
+    lats = ds['lat_0'].values
+    lons = ds['lon_0'].values
+    # Get the grid points inside of the area, which are computed once per grid
+    lat_idx, lon_idx, area_mask = grid_area_mask(lats, lons, area_file, processes)
+    # water filter (oceans and lakes have soil moisture 100% so we exclude those),
+    # using the static land mask which is derived the first time the grid is seen
+    soil_moisture = lambda: ds['SOILW_P0_2L106_GLL0'].sel(lv_DBLL0=0).values
+    land = load_land_mask(lats, lons, soil_moisture=soil_moisture, area_file=land_file)
+    mask = area_mask & land[np.ix_(lat_idx, lon_idx)]
+    # the cells missing from this file's soil moisture are dropped as well
+    if 'SOILW_P0_2L106_GLL0' in ds:
+        soil = ds['SOILW_P0_2L106_GLL0'].isel(lat_0=lat_idx, lon_0=lon_idx).sel(lv_DBLL0=0).values
+        mask = mask & np.isfinite(soil)
+    # Coordinates of the remaining grid points
+    rows, cols = np.nonzero(mask)
+    longitude = lons[lon_idx][cols]
+    df = pd.DataFrame({
+        'latitude': lats[lat_idx][rows],
+        'longitude': np.where(longitude > 180, longitude - 360, longitude),
+    })
+    for name in variables:
+        if name not in ds:
+            continue
+        var = ds[name].isel(lat_0=lat_idx, lon_0=lon_idx)
+        if 'lv_DBLL0' in var.dims:
+            # depth of 0 = '0-10cm'
+            # depth of 1 = '10-40cm'
+            # depth of 2 = '40-100cm'
+            # depth of 3 = '100-200cm'
+            for depth in depths:
+                df[name + '_' + str(depth)] = var.sel(lv_DBLL0=depth).values[mask]
+        else:
+            df[name] = var.values[mask]
     return df
 
-if __name__ == '__main__':
-
+def run(filenames, area_file=AREA_FILE, output_dir='ukraine_data', variables=None, depths=(0,), land_file=None, prefetch_depth=0, aggregate=None, window_hours=24, rolling=False, tz='UTC', processes=0, prefetch_threads=False):
+    """
+    Process the agricultural forecast files in order,
+    writing one CSV per time and a combined CSV.
+    If a list of variables is given, a wide table of every
+    (variable, depth) is written instead of the soil moisture only.
+    With a prefetch depth, the next files are decoded in full on
+    background processes (or threads) while the current one is filtered
+    and written, otherwise only the values inside of the area are decoded.
+    With a list of statistics to aggregate, every column is also
+    aggregated over time windows, e.g. daily min/max temperature
+    and mean soil moisture into `<output_dir>/daily`.
+    With a number of processes, the area mask of a new grid is
+    computed in parallel.
+    """
+    stack = None
     all_data = pd.DataFrame()
+    if variables:
+        # soil moisture is always read for the water filter
+        subset_variables = sorted(set(variables) | set(SOIL_VARIABLES))
+    else:
+        subset_variables = SOIL_VARIABLES
 
-    filenames = glob.glob('agricast/*.grib2')
-    filenames = sorted(filenames)
-
-    for filename in filenames:
+    # only decode the needed messages of each file,
+    # and only ahead of time when prefetching
+    loader = partial(load_dataset, variables=subset_variables, lazy=not prefetch_depth)
+    for filename, DATASET in prefetch(filenames, loader, prefetch_depth, not prefetch_threads):
         print('Processing ', filename)
-        DATASET = xr.open_dataset(filename, engine='pynio')
         # filter the weather data to the buffer region
-        dataframe = parse_data(DATASET)
+        if variables:
+            dataframe = parse_profile(DATASET, variables, depths, area_file, land_file, processes)
+        else:
+            dataframe = parse_profile(DATASET, SOIL_VARIABLES, (0,), area_file, land_file, processes)
+            dataframe = dataframe.rename(columns={'SOILW_P0_2L106_GLL0_0': 'soil_moisture'})
+        DATASET.close()
         # # print some statistics
         # val_min = df['soil_moisture'].min()
         # val_max = df['soil_moisture'].max()
@@ -97,12 +135,47 @@ if __name__ == '__main__':
         # convert datetime object to string
         forecast_time = str(dt)
 
+        # the values of every lead time, for the time window statistics
+        if aggregate:
+            if stack is None:
+                stack = LeadStack([c for c in dataframe.columns if c not in ('latitude', 'longitude')])
+            stack.append(dt, dataframe)
         dataframe['time'] = forecast_time
-        dataframe = dataframe.loc[:, ['latitude','longitude','soil_moisture','time']]
+        if not variables:
+            dataframe = dataframe.loc[:, ['latitude','longitude','soil_moisture','time']]
         all_data = pd.concat([all_data, dataframe])
         # export the combined dataframe to CSV, named by time
-        dataframe.to_csv('ukraine_data/' + forecast_time + '.csv', index=False)
+        dataframe.to_csv(os.path.join(output_dir, forecast_time + '.csv'), index=False)
+
+    if stack is not None:
+        stack.write(output_dir, aggregate, window_hours, rolling, tz)
 
     # ALL DATA
-    all_data = all_data.loc[:, ['latitude','longitude','soil_moisture','time']]
-    all_data.to_csv('ukraine_data/COMBINED.csv', index=False)
+    if not variables:
+        all_data = all_data.loc[:, ['latitude','longitude','soil_moisture','time']]
+    all_data.to_csv(os.path.join(output_dir, 'COMBINED.csv'), index=False)
+    return all_data
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--variables', nargs='+', default=None, help='extract these variables into one wide table')
+    parser.add_argument('--profile', action='store_true', help='extract every variable of the agricultural profile')
+    parser.add_argument('--depths', nargs='+', type=int, default=[0], help='soil depth levels to extract (0-3)')
+    parser.add_argument('--land-mask-shapefile', default=None, help='derive the land mask from this shapefile instead of the soil moisture field')
+    parser.add_argument('--prefetch', type=int, default=0, help='number of files to decode ahead in the background')
+    parser.add_argument('--prefetch-threads', action='store_true', help='decode ahead on threads instead of processes, only for thread-safe decoders')
+    parser.add_argument('--aggregate', nargs='+', choices=STATISTICS, default=None, help='also write these statistics over time windows of the lead times')
+    parser.add_argument('--window', type=int, default=24, help='length of the aggregation windows in hours')
+    parser.add_argument('--rolling', action='store_true', help='aggregate over trailing windows ending at each lead time instead of calendar windows')
+    parser.add_argument('--timezone', default='UTC', help='time zone of the calendar windows, e.g. America/Chicago')
+    parser.add_argument('--processes', type=int, default=0, help='number of worker processes computing the area mask of a new grid')
+    args = parser.parse_args()
+
+    variables = PROFILE_VARIABLES if args.profile else args.variables
+
+    filenames = glob.glob('agricast/*.grib2')
+    filenames = sorted(filenames)
+
+    run(filenames, variables=variables, depths=args.depths, land_file=args.land_mask_shapefile, prefetch_depth=args.prefetch,
+        aggregate=args.aggregate, window_hours=args.window, rolling=args.rolling, tz=args.timezone, processes=args.processes,
+        prefetch_threads=args.prefetch_threads)
@@ -0,0 +1,83 @@
+"""
+Tests of the batch extraction of point values from an open forecast file,
+with a stub of the PyNIO file
+
+The trajectory script imports PyNIO, so these tests are skipped where it
+is not installed. Run from the repository root with
+`python -m unittest discover tests`.
+"""
+import os
+import sys
+import importlib.util
+import unittest
+from datetime import datetime
+import numpy as np
+
+TESTS_DIR = os.path.dirname(os.path.realpath(__file__))
+sys.path.insert(0, os.path.join(TESTS_DIR, os.pardir, 'TQ'))
+
+LATS = np.arange(-10, 10.5, 0.5)
+LONS = np.arange(0, 360, 0.5)
+
+
+class StubVariable(object):
+    """ Variable of a stub file, returning the selection of a point in the given shape """
+
+    def __init__(self, field, shape=(), long_name='Temperature', units='K'):
+        self.field = field
+        self.shape = shape
+        self.attributes = {'long_name': long_name, 'units': units}
+
+    def __getitem__(self, select):
+        if isinstance(select, slice):
+            return self.field
+        # 'lat_0|{lat}i lon_0|{lon}i', taking the nearest value for the test
+        lat, lon = [float(part.split('|')[1][:-1]) for part in select.split()]
+        value = self.field[np.abs(LATS - lat).argmin(), np.abs(LONS - lon).argmin()]
+        return np.full(self.shape, value, dtype=self.field.dtype)
+
+
+class StubFile(object):
+    """ Open PyNIO file holding a few variables """
+
+    def __init__(self, variables):
+        self.variables = dict(variables)
+        self.variables['lat_0'] = StubVariable(LATS)
+        self.variables['lon_0'] = StubVariable(LONS)
+
+
+@unittest.skipUnless(importlib.util.find_spec('Nio'), 'PyNIO is not installed')
+class ExtractBatchTest(unittest.TestCase):
+
+    def setUp(self):
+        import get_trajectory_point_forecasts
+        self.tq = get_trajectory_point_forecasts
+        self.field = (np.arange(len(LATS) * len(LONS)) % 1000).reshape(len(LATS), len(LONS)).astype('float32')
+        self.points = [(0, '1.00000', '20.00000'), (1, '-3.50000', '359.50000'), (2, '5.00000', '180.00000')]
+        self.expected = np.array([self.field[22, 40], self.field[13, 719], self.field[30, 360]])
+
+    def extract(self, shape, mode='bilinear'):
+        nc = StubFile({'TMP_P0_L103_GLL0': StubVariable(self.field, shape)})
+        return self.tq.extract_batch(
+            nc, 'basic', ['TMP_P0_L103_GLL0', 'WTMP_P0_L1_GLL0'], datetime(2020, 3, 17), '2020-03-17 03:00:00',
+            self.points, mode,
+        )
+
+    def test_bilinear_selections_of_any_shape(self):
+        # a point's selection may be a scalar, or an array of one value
+        for shape in [(), (1,), (1, 1)]:
+            batch = self.extract(shape)
+            np.testing.assert_array_equal(batch.values[:, 0], self.expected)
+            self.assertEqual(np.dtype(batch.dtypes[0]), np.float32)
+            # variables missing from the file are left out
+            self.assertIsNone(batch.long_names[1])
+            self.assertTrue(np.isnan(batch.values[:, 1]).all())
+
+    def test_nearest(self):
+        batch = self.extract((), 'nearest')
+        np.testing.assert_array_equal(batch.values[:, 0], self.expected)
+        self.assertEqual(batch.point_values(0)[0][:2], ['TMP_P0_L103_GLL0', 'Temperature'])
+
+
+if __name__ == '__main__':
+    unittest.main()
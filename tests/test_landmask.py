@@ -0,0 +1,81 @@
+"""
+Tests of the static land masks, as applied to the soil moisture fields
+of later forecast files
+
+Run from the repository root with `python -m unittest discover tests`.
+"""
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+import numpy as np
+import xarray as xr
+
+TESTS_DIR = os.path.dirname(os.path.realpath(__file__))
+sys.path.insert(0, os.path.join(TESTS_DIR, os.pardir))
+import utils_landmask
+from utils_landmask import derive_land_mask, load_land_mask
+from get_soil_moisture_data import parse_data_chunked
+
+LATS = np.arange(0, 10, 1.0)
+LONS = np.arange(0, 10, 1.0)
+
+
+def soil_dataset(field):
+    """ Dataset of a soil moisture field at the top depth, like the forecast files """
+    values = np.stack([field, field])
+    return xr.Dataset(
+        {'SOILW_P0_2L106_GLL0': (('lv_DBLL0', 'lat_0', 'lon_0'), values)},
+        coords={'lv_DBLL0': [0, 1], 'lat_0': LATS, 'lon_0': LONS},
+    )
+
+
+class LandMaskTest(unittest.TestCase):
+
+    def setUp(self):
+        # masks are saved to the working directory and cached per process
+        self.cwd = os.getcwd()
+        self.root = tempfile.mkdtemp()
+        os.chdir(self.root)
+        utils_landmask.LAND_MASKS.clear()
+        # water cells are saturated, one land cell is missing from the first file
+        self.field = np.full((len(LATS), len(LONS)), 0.3)
+        self.field[:, 7:] = 1.0
+        self.field[0, 0] = np.nan
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        shutil.rmtree(self.root)
+        utils_landmask.LAND_MASKS.clear()
+
+    def test_derive_land_mask(self):
+        mask = derive_land_mask(self.field)
+        self.assertEqual(mask.sum(), len(LATS) * 7 - 1)
+        self.assertFalse(mask[0, 0])
+        self.assertFalse(mask[:, 7:].any())
+
+    def test_mask_is_saved_and_reused(self):
+        mask = load_land_mask(LATS, LONS, soil_moisture=self.field)
+        utils_landmask.LAND_MASKS.clear()
+        # the saved mask is read without a field to derive it from
+        np.testing.assert_array_equal(load_land_mask(LATS, LONS), mask)
+
+    def test_missing_cells_of_a_later_file_are_dropped(self):
+        first = parse_data_chunked(soil_dataset(self.field))
+        self.assertEqual(sum(len(df) for df in first), len(LATS) * 7 - 1)
+        # a later file is missing a cell inside of the saved land mask
+        later = self.field.copy()
+        later[0, 0] = 0.4
+        later[5, 3] = np.nan
+        for budget in (None, 0.0001):
+            data = list(parse_data_chunked(soil_dataset(later), budget))
+            values = np.concatenate([df['soil_moisture'].values for df in data])
+            self.assertEqual(len(values), len(LATS) * 7 - 2)
+            self.assertTrue(np.isfinite(values).all())
+            # the cell missing from the first file stays out with the land mask
+            self.assertNotIn(0.4, values)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,155 @@
+"""
+Tests of the shared-filesystem work queue, with local worker processes
+on a temporary queue directory
+
+Run from the repository root with `python -m unittest discover tests`.
+"""
+import os
+import sys
+import time
+import shutil
+import tempfile
+import unittest
+import multiprocessing
+
+TESTS_DIR = os.path.dirname(os.path.realpath(__file__))
+sys.path.insert(0, os.path.join(TESTS_DIR, os.pardir))
+from utils_workqueue import WorkQueue, run_jobs, work
+
+# The job of the queued units, as imported by the workers
+JOB = 'test_workqueue:square'
+
+
+def square(arg):
+    """ Job returning the square of its argument, the worker and its directory """
+    if arg < 0:
+        raise ValueError('negative argument {}'.format(arg))
+    time.sleep(0.05)
+    return arg * arg, os.getpid(), os.getcwd()
+
+
+def claim_and_die(root):
+    """ Claim one unit and exit without completing it, like a crashed worker """
+    WorkQueue(root).claim()
+    os._exit(1)
+
+
+class WorkQueueTest(unittest.TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.queue = WorkQueue(self.root)
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def submit(self, arg, unit_id):
+        return self.queue.submit(JOB, arg, unit_id, path=[TESTS_DIR])
+
+    def test_claim_and_complete(self):
+        self.submit(2, 'a')
+        self.submit(3, 'b')
+        unit_id, unit = self.queue.claim()
+        self.assertEqual(unit_id, 'a')
+        self.assertEqual(unit['arg'], 2)
+        self.assertEqual(self.queue.status(), {'pending': 1, 'claimed': 1, 'done': 0, 'failed': 0})
+        self.queue.complete(unit_id, 4)
+        self.assertEqual(self.queue.result('a'), 4)
+        self.assertFalse(self.queue.finished(['a', 'b']))
+        self.assertEqual(self.queue.claim()[0], 'b')
+        self.assertIsNone(self.queue.claim())
+
+    def test_fail(self):
+        self.submit(-1, 'a')
+        unit_id, unit = self.queue.claim()
+        self.queue.fail(unit_id, 'Traceback')
+        self.assertTrue(self.queue.finished(['a']))
+        with self.assertRaises(RuntimeError):
+            self.queue.result('a')
+
+    def test_requeue_stale(self):
+        self.submit(2, 'a')
+        self.submit(3, 'b')
+        self.queue.claim()
+        self.queue.claim()
+        # unit a was claimed long ago, unit b just now
+        old = time.time() - 100
+        os.utime(os.path.join(self.root, 'claimed', 'a.pkl'), (old, old))
+        self.assertEqual(self.queue.requeue_stale(10), ['a'])
+        self.assertEqual(self.queue.status()['pending'], 1)
+        self.assertEqual(self.queue.claim()[0], 'a')
+
+    def test_claim_time_is_recorded_before_the_claim(self):
+        # a unit submitted long ago is not stale as soon as it is claimed
+        self.submit(2, 'a')
+        old = time.time() - 100
+        os.utime(os.path.join(self.root, 'pending', 'a.pkl'), (old, old))
+        self.queue.claim()
+        self.assertEqual(self.queue.requeue_stale(10), [])
+
+    def test_requeued_claim_completed_by_the_original_worker(self):
+        self.submit(2, 'a')
+        self.queue.claim()
+        # a slow worker's claim is requeued and claimed by another worker
+        old = time.time() - 100
+        os.utime(os.path.join(self.root, 'claimed', 'a.pkl'), (old, old))
+        self.assertEqual(self.queue.requeue_stale(10), ['a'])
+        self.assertEqual(self.queue.claim()[0], 'a')
+        # the first result is kept, the other one is dropped
+        self.assertTrue(self.queue.complete('a', 'first'))
+        self.assertFalse(self.queue.complete('a', 'second'))
+        self.assertFalse(self.queue.fail('a', 'Traceback'))
+        self.assertEqual(self.queue.result('a'), 'first')
+        self.assertEqual(self.queue.status(), {'pending': 0, 'claimed': 0, 'done': 1, 'failed': 0})
+
+    def test_requeued_claim_completed_before_it_is_claimed_again(self):
+        self.submit(2, 'a')
+        self.queue.claim()
+        old = time.time() - 100
+        os.utime(os.path.join(self.root, 'claimed', 'a.pkl'), (old, old))
+        self.queue.requeue_stale(10)
+        # the requeued copy is not run again once the original claim is done
+        self.assertTrue(self.queue.complete('a', 4))
+        self.assertIsNone(self.queue.claim())
+        self.assertEqual(self.queue.result('a'), 4)
+        self.assertEqual(self.queue.status(), {'pending': 0, 'claimed': 0, 'done': 1, 'failed': 0})
+
+    def test_run_jobs_with_local_workers(self):
+        results = run_jobs(self.root, JOB, list(range(12)), workers=3, poll=0.1, path=[TESTS_DIR])
+        self.assertEqual([value for value, pid, cwd in results], [i * i for i in range(12)])
+        # the units are shared between the coordinator and its workers
+        self.assertGreater(len(set(pid for value, pid, cwd in results)), 1)
+        # finished units are removed from the queue
+        self.assertEqual(self.queue.status(), {'pending': 0, 'claimed': 0, 'done': 0, 'failed': 0})
+
+    def test_run_jobs_failure(self):
+        with self.assertRaises(RuntimeError):
+            run_jobs(self.root, JOB, [1, -1, 2], workers=2, poll=0.1, path=[TESTS_DIR])
+
+    def test_jobs_run_in_the_coordinator_directory(self):
+        cwd = os.getcwd()
+        other = tempfile.mkdtemp()
+        try:
+            results = run_jobs(self.root, JOB, [1, 2], workers=1, poll=0.1, cwd=other, path=[TESTS_DIR])
+        finally:
+            shutil.rmtree(other)
+        self.assertEqual([os.path.realpath(c) for v, p, c in results], [os.path.realpath(other)] * 2)
+        # the coordinator's own directory is left unchanged
+        self.assertEqual(os.getcwd(), cwd)
+
+    def test_unit_of_a_dead_worker_is_processed_again(self):
+        self.submit(2, 'a')
+        self.submit(3, 'b')
+        dead = multiprocessing.Process(target=claim_and_die, args=(self.root,))
+        dead.start()
+        dead.join()
+        self.assertEqual(self.queue.status()['claimed'], 1)
+        time.sleep(0.5)
+        # the worker processes b, then requeues and processes the stale claim of a
+        self.assertEqual(work(self.root, stale=0.2), 2)
+        self.assertTrue(self.queue.finished(['a', 'b']))
+        self.assertEqual(self.queue.result('a')[0], 4)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,157 @@
+"""
+Temporal aggregation of gridded values over lead times
+
+The values of each forecast file are stacked into one (lead, cell, variable)
+array, and calendar windows (e.g. local days) or trailing rolling windows
+are reduced along the lead axis with NumPy `reduceat`, one call per
+statistic for all windows, cells and variables at once. Missing values
+are ignored, and the number of lead times in each window is reported
+so that partial windows at the ends of a forecast can be recognised.
+"""
+import os
+import numpy as np
+import pandas as pd
+
+# Statistics that can be computed over a window
+STATISTICS = ('sum', 'mean', 'min', 'max')
+
+
+def window_bounds(labels):
+    """
+    Return the start and end positions of the runs of equal labels
+    in a sorted array of labels, and the label of each run
+    """
+    labels = np.asarray(labels)
+    starts = np.concatenate([[0], np.nonzero(labels[1:] != labels[:-1])[0] + 1])
+    ends = np.concatenate([starts[1:], [len(labels)]])
+    return starts, ends, labels[starts]
+
+
+def calendar_windows(times, hours=24, tz='UTC', accumulated=False):
+    """
+    Return the start and end positions and the local start time
+    of the calendar windows of `hours` hours covering sorted UTC times.
+    Accumulated values are amounts over the step ending at their valid time,
+    so a value valid at the start of a window counts toward the previous one.
+    """
+    times = pd.DatetimeIndex(times)
+    if times.tz is None:
+        times = times.tz_localize('UTC')
+    if accumulated:
+        times = times - pd.Timedelta(seconds=1)
+    # floor the wall-clock time of the configured time zone
+    local = times.tz_convert(tz).tz_localize(None)
+    labels = local.floor('{}h'.format(hours)).values
+    return window_bounds(labels)
+
+
+def rolling_windows(times, hours=24):
+    """
+    Return the start and end positions of the trailing windows
+    (t - hours, t] ending at each of the sorted times
+    """
+    times = pd.DatetimeIndex(times).values
+    starts = np.searchsorted(times, times - np.timedelta64(hours, 'h'), side='right')
+    ends = np.arange(1, len(times) + 1)
+    return starts, ends, times
+
+
+def reduce_windows(stack, starts, ends, stat):
+    """
+    Reduce a stack along its first axis over every [start, end) window,
+    ignoring NaN, with NaN where a window has no valid values
+    """
+    # a trailing row lets windows end at the last lead time
+    padded = np.concatenate([stack, np.full((1,) + stack.shape[1:], np.nan, dtype=stack.dtype)])
+    # reduceat reduces between consecutive indices,
+    # so the windows are given as (start, end) pairs and every other result is kept
+    indices = np.empty(2 * len(starts), dtype=np.int64)
+    indices[0::2] = starts
+    indices[1::2] = ends
+    valid = np.isfinite(padded)
+    count = np.add.reduceat(valid.astype(np.int32), indices, axis=0)[0::2]
+    # an empty window would reduce to the single value at its start
+    empty = (np.asarray(ends) <= np.asarray(starts)).reshape((-1,) + (1,) * (stack.ndim - 1))
+    count = np.where(empty, 0, count)
+    if stat in ('sum', 'mean'):
+        total = np.add.reduceat(np.where(valid, padded, 0), indices, axis=0)[0::2]
+        result = total / np.maximum(count, 1) if stat == 'mean' else total
+    elif stat == 'max':
+        result = np.fmax.reduceat(padded, indices, axis=0)[0::2]
+    elif stat == 'min':
+        result = np.fmin.reduceat(padded, indices, axis=0)[0::2]
+    else:
+        raise ValueError('Unknown statistic {}, expected one of {}'.format(stat, STATISTICS))
+    return np.where(count > 0, result, np.nan)
+
+
+class LeadStack(object):
+    """ Values of a set of grid cells stacked over the lead times of a forecast """
+
+    def __init__(self, names):
+        self.names = list(names)
+        self.index = None
+        self.times = []
+        self.layers = []
+
+    def append(self, valid_time, df):
+        """
+        Add the values of one lead time from a dataframe with latitude
+        and longitude columns and one column per variable.
+        The cells of the first lead time define the stack, and cells
+        missing from later lead times are filled with NaN.
+        """
+        df = df.set_index(['latitude', 'longitude'])
+        # a cell shared by several areas is only kept once
+        df = df[~df.index.duplicated()]
+        if self.index is None:
+            self.index = df.index
+        elif not df.index.equals(self.index):
+            df = df.reindex(self.index)
+        self.times.append(pd.Timestamp(valid_time))
+        self.layers.append(df.loc[:, self.names].values.astype(np.float32))
+
+    def aggregate(self, stats, hours=24, rolling=False, tz='UTC', accumulated=False):
+        """
+        Return a list of (window label, dataframe) pairs, each dataframe holding
+        the latitude, longitude, one `<variable>_<stat>` column per variable
+        and statistic, and the number of lead times in the window
+        """
+        if not self.layers:
+            return []
+        # order the lead times, which may come from several issuances
+        order = np.argsort(pd.DatetimeIndex(self.times).asi8, kind='stable')
+        times = [self.times[i] for i in order]
+        stack = np.stack([self.layers[i] for i in order])
+        if rolling:
+            starts, ends, labels = rolling_windows(times, hours)
+        else:
+            starts, ends, labels = calendar_windows(times, hours, tz, accumulated)
+        results = {stat: reduce_windows(stack, starts, ends, stat) for stat in stats}
+        coords = self.index.to_frame(index=False)
+        windows = []
+        for w, label in enumerate(labels):
+            df = coords.copy()
+            for stat in stats:
+                for v, name in enumerate(self.names):
+                    df[name + '_' + stat] = results[stat][w, :, v]
+            df['steps'] = ends[w] - starts[w]
+            windows.append((pd.Timestamp(label), df))
+        return windows
+
+    def write(self, output_dir, stats, hours=24, rolling=False, tz='UTC', accumulated=False):
+        """
+        Write one CSV per window into a subdirectory of `output_dir`
+        named after the windows, e.g. `daily/2020-03-17T00.csv`
+        """
+        if rolling:
+            subdir = 'rolling_{}h'.format(hours)
+        elif hours == 24:
+            subdir = 'daily'
+        else:
+            subdir = 'window_{}h'.format(hours)
+        path = os.path.join(output_dir, subdir)
+        os.makedirs(path, exist_ok=True)
+        for label, df in self.aggregate(stats, hours, rolling, tz, accumulated):
+            df.to_csv(os.path.join(path, label.strftime('%Y-%m-%dT%H') + '.csv'), index=False)
+        return path
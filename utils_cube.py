@@ -0,0 +1,186 @@
+"""
+Append-only chunked time-series store for point forecasts
+
+Values are held in a 4-D (issuance, lead, station, variable) cube laid out
+on local disk similar to Zarr: a small `meta.json` describes the variables
+and the registered stations, and every issuance gets its own directory of
+`.npy` chunk files. Each chunk holds every lead time and every variable
+for a fixed-size block of stations, so a time series for one station only
+reads a single column of one chunk per issuance.
+
+    <store>/meta.json
+    <store>/<issuance>/<block>.npy    # shape (max_lead + 1, station_chunk, n_variables)
+"""
+import os
+import json
+from datetime import datetime, timedelta
+import numpy as np
+import pandas as pd
+
+META_FILE = 'meta.json'
+ISSUANCE_FORMAT = '%Y%m%dT%H'
+
+
+class CubeStore(object):
+    """ Chunked (issuance, lead, station, variable) store on local disk """
+
+    def __init__(self, path, variables=None, max_lead=384, station_chunk=64):
+        """
+        Open the store at `path`, creating it if it does not exist yet.
+        The variables, maximum lead hour and chunk size are fixed
+        when the store is created and read back from disk afterwards.
+        """
+        self.path = path
+        meta_path = os.path.join(path, META_FILE)
+        if os.path.exists(meta_path):
+            with open(meta_path, 'r') as metafile:
+                self.meta = json.load(metafile)
+        else:
+            if not variables:
+                raise ValueError('variables are required to create a new store')
+            os.makedirs(path, exist_ok=True)
+            self.meta = {
+                'variables': list(variables),
+                'max_lead': int(max_lead),
+                'station_chunk': int(station_chunk),
+                'stations': [],
+            }
+            self._save_meta()
+        # Build the lookup tables from the metadata
+        self.variables = self.meta['variables']
+        self.max_lead = self.meta['max_lead']
+        self.station_chunk = self.meta['station_chunk']
+        self._variable_index = {v: i for i, v in enumerate(self.variables)}
+        self._station_index = {s: i for i, s in enumerate(self.meta['stations'])}
+
+    def _save_meta(self):
+        # Write to a temporary file first so that readers
+        # never see a partially written metadata file
+        meta_path = os.path.join(self.path, META_FILE)
+        tmp_path = meta_path + '.tmp'
+        with open(tmp_path, 'w') as metafile:
+            json.dump(self.meta, metafile)
+        os.replace(tmp_path, meta_path)
+
+    def _chunk_path(self, issuance, block):
+        return os.path.join(self.path, issuance.strftime(ISSUANCE_FORMAT), str(block) + '.npy')
+
+    def _register_stations(self, stations):
+        # Assign an index to every station that has not been seen before
+        added = False
+        for station in stations:
+            if station not in self._station_index:
+                self._station_index[station] = len(self.meta['stations'])
+                self.meta['stations'].append(station)
+                added = True
+        if added:
+            self._save_meta()
+        return np.array([self._station_index[s] for s in stations], dtype=np.int64)
+
+    def stations(self):
+        """
+        Return the list of registered station names
+        """
+        return list(self.meta['stations'])
+
+    def issuances(self):
+        """
+        Return the sorted list of issuance times held in the store
+        """
+        issuances = []
+        for name in os.listdir(self.path):
+            if os.path.isdir(os.path.join(self.path, name)):
+                issuances.append(datetime.strptime(name, ISSUANCE_FORMAT))
+        return sorted(issuances)
+
+    def append(self, issuance, lead, stations, values):
+        """
+        Write the values of one forecast file into the store.
+        `values` maps each variable name to a sequence aligned with `stations`,
+        and `lead` is the number of hours since `issuance`
+        """
+        lead = int(lead)
+        if lead < 0 or lead > self.max_lead:
+            raise ValueError('lead {} is outside of the store range 0-{}'.format(lead, self.max_lead))
+        station_ids = self._register_stations(list(stations))
+        # Make sure the issuance directory exists
+        os.makedirs(os.path.dirname(self._chunk_path(issuance, 0)), exist_ok=True)
+        # Resolve the variable columns being written
+        names = [name for name in values if name in self._variable_index]
+        columns = [self._variable_index[name] for name in names]
+        data = np.column_stack([np.asarray(values[name], dtype=np.float32) for name in names])
+        # Write each block of stations into its own chunk
+        blocks = station_ids // self.station_chunk
+        for block in np.unique(blocks):
+            rows = (blocks == block)
+            offsets = station_ids[rows] % self.station_chunk
+            chunk_path = self._chunk_path(issuance, block)
+            if os.path.exists(chunk_path):
+                chunk = np.load(chunk_path, mmap_mode='r+')
+            else:
+                shape = (self.max_lead + 1, self.station_chunk, len(self.variables))
+                chunk = np.lib.format.open_memmap(chunk_path, mode='w+', dtype=np.float32, shape=shape)
+                chunk[:] = np.nan
+            chunk[lead, offsets[:, None], columns] = data[rows]
+            chunk.flush()
+            del chunk
+
+    def select(self, station, start=None, end=None, variables=None):
+        """
+        Return the time series of a single station as a dataframe,
+        optionally limited to valid times between `start` and `end`
+        """
+        if station not in self._station_index:
+            return pd.DataFrame(columns=['issuance', 'lead', 'valid_time'] + list(variables or self.variables))
+        variables = list(variables or self.variables)
+        columns = [self._variable_index[v] for v in variables]
+        station_id = self._station_index[station]
+        block = station_id // self.station_chunk
+        offset = station_id % self.station_chunk
+        frames = []
+        for issuance in self.issuances():
+            # Skip issuances whose valid times cannot overlap the requested range
+            if end is not None and issuance > end:
+                continue
+            if start is not None and issuance + timedelta(hours=self.max_lead) < start:
+                continue
+            chunk_path = self._chunk_path(issuance, block)
+            if not os.path.exists(chunk_path):
+                continue
+            # Only the column of this station is read from the memory-mapped chunk
+            chunk = np.load(chunk_path, mmap_mode='r')
+            series = np.array(chunk[:, offset, columns])
+            del chunk
+            # Drop lead times that were never written for this station
+            leads = np.nonzero(~np.isnan(series).all(axis=1))[0]
+            frame = pd.DataFrame(series[leads], columns=variables)
+            frame.insert(0, 'valid_time', [issuance + timedelta(hours=int(h)) for h in leads])
+            frame.insert(0, 'lead', leads)
+            frame.insert(0, 'issuance', issuance)
+            frames.append(frame)
+        if not frames:
+            return pd.DataFrame(columns=['issuance', 'lead', 'valid_time'] + variables)
+        df = pd.concat(frames, ignore_index=True)
+        # Apply the valid time range filter
+        if start is not None:
+            df = df.loc[df['valid_time'] >= start]
+        if end is not None:
+            df = df.loc[df['valid_time'] <= end]
+        return df.reset_index(drop=True)
+
+
+if __name__ == '__main__':
+    import argparse
+    import dateutil.parser
+    parser = argparse.ArgumentParser(
+        description='Print the time series of one station from a chunked forecast store'
+    )
+    parser.add_argument('store', type=str, help='The path to the store directory')
+    parser.add_argument('station', type=str, help='The name of the station to query')
+    parser.add_argument('--start', type=str, default=None, help='The earliest valid time to include')
+    parser.add_argument('--end', type=str, default=None, help='The latest valid time to include')
+    args = parser.parse_args()
+    start = dateutil.parser.parse(args.start) if args.start else None
+    end = dateutil.parser.parse(args.end) if args.end else None
+    store = CubeStore(args.store)
+    print(store.select(args.station, start, end).to_string(index=False))
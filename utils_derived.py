@@ -0,0 +1,110 @@
+"""
+Derived variables and unit conversions
+
+Derived variables are declared once in `DERIVED_VARIABLES` with the GRIB2
+variables they depend on, and are computed with NumPy on whole arrays,
+so the same declaration serves full grids and batches of points.
+"""
+import numpy as np
+
+
+def speed(u, v):
+    """
+    Return the speed of a vector from its eastward and northward components
+    """
+    return np.hypot(u, v)
+
+
+def direction_from(u, v):
+    """
+    Return the direction a vector is coming from, in degrees clockwise
+    from north (meteorological convention, used for wind)
+    """
+    return np.mod(np.degrees(np.arctan2(-u, -v)), 360)
+
+
+def direction_to(u, v):
+    """
+    Return the direction a vector is heading to, in degrees clockwise
+    from north (oceanographic convention, used for currents)
+    """
+    return np.mod(np.degrees(np.arctan2(u, v)), 360)
+
+
+# Each derived variable lists the variables it depends on,
+# which are passed to its function in the same order
+DERIVED_VARIABLES = {
+    'wind_speed': {
+        'inputs': ('UGRD_P0_L103_GLL0', 'VGRD_P0_L103_GLL0'),
+        'func': speed,
+        'long_name': 'Wind speed',
+        'units': 'm s-1',
+    },
+    'wind_direction': {
+        'inputs': ('UGRD_P0_L103_GLL0', 'VGRD_P0_L103_GLL0'),
+        'func': direction_from,
+        'long_name': 'Wind direction (from which blowing)',
+        'units': 'degree true',
+    },
+    'sea_water_speed': {
+        'inputs': ('UOGRD_P0_L1_GLL0', 'VOGRD_P0_L1_GLL0'),
+        'func': speed,
+        'long_name': 'Current speed',
+        'units': 'm s-1',
+    },
+    'sea_water_direction': {
+        'inputs': ('UOGRD_P0_L1_GLL0', 'VOGRD_P0_L1_GLL0'),
+        'func': direction_to,
+        'long_name': 'Current direction (towards which flowing)',
+        'units': 'degree true',
+    },
+}
+
+# Conversion functions keyed by (from units, to units)
+UNIT_CONVERSIONS = {
+    ('mm', 'in'): lambda x: x * 0.0393701,
+    ('kg m-2', 'mm'): lambda x: x,
+    ('kg m-2', 'in'): lambda x: x * 0.0393701,
+    ('K', 'C'): lambda x: x - 273.15,
+    ('K', 'F'): lambda x: (x - 273.15) * 9 / 5 + 32,
+    ('m s-1', 'kn'): lambda x: x * 1.94384,
+    ('m s-1', 'km h-1'): lambda x: x * 3.6,
+    ('Pa', 'hPa'): lambda x: x / 100,
+    ('m', 'ft'): lambda x: x * 3.28084,
+}
+
+
+def convert_units(values, from_units, to_units):
+    """
+    Convert an array (or scalar) of values between units
+    """
+    if from_units == to_units:
+        return values
+    if (from_units, to_units) not in UNIT_CONVERSIONS:
+        raise ValueError('No conversion from {} to {}'.format(from_units, to_units))
+    return UNIT_CONVERSIONS[(from_units, to_units)](values)
+
+
+def available(variables):
+    """
+    Return the names of the derived variables whose inputs
+    are all among the given variables
+    """
+    variables = set(variables)
+    return [name for name, spec in DERIVED_VARIABLES.items() if set(spec['inputs']) <= variables]
+
+
+def derive(values, names=None):
+    """
+    Compute derived variables from a dictionary of input arrays,
+    returning a dictionary of the derived arrays.
+    By default every derived variable whose inputs are present is computed.
+    """
+    if names is None:
+        names = available(values)
+    derived = {}
+    for name in names:
+        spec = DERIVED_VARIABLES[name]
+        inputs = [np.asarray(values[i], dtype=float) for i in spec['inputs']]
+        derived[name] = spec['func'](*inputs)
+    return derived
@@ -0,0 +1,234 @@
+"""
+Picklable geometry payloads for worker pools
+
+OGR layers and geometries cannot be pickled, so a shapefile area cannot be
+sent to `multiprocessing` workers, and every worker opening the shapefile
+itself for every task is slow. A `GeometryPayload` holds the geometries as
+WKB with their envelopes and attribute fields in flat arrays. The payload
+is written once into shared memory by `geometry_pool`, and the pool
+initializer of every worker rebuilds the geometries from it exactly once,
+so tasks only carry the name of the area and their own coordinates.
+"""
+import contextlib
+import multiprocessing
+from multiprocessing import resource_tracker, shared_memory
+import numpy as np
+from osgeo import ogr
+
+# The areas rebuilt by the pool initializer, keyed by name,
+# in the worker processes of a `geometry_pool`
+WORKER_AREAS = {}
+
+
+def attach_shared_memory(name):
+    """
+    Attach to a shared memory block created by another process,
+    leaving its tracking and unlinking to the creator
+    """
+    try:
+        # Python 3.13 and later can attach without tracking the block
+        return shared_memory.SharedMemory(name=name, track=False)
+    except TypeError:
+        pass
+    # Earlier versions register every attached block with the resource
+    # tracker. Workers of a pool share the tracker of their parent, where
+    # the block is already registered, but a process without a tracker
+    # would start its own, which reports the block as leaked and unlinks it
+    # when the process exits
+    own_tracker = resource_tracker._resource_tracker._fd is None
+    block = shared_memory.SharedMemory(name=name)
+    if own_tracker:
+        resource_tracker.unregister(block._name, 'shared_memory')
+    return block
+
+
+class GeometryPayload(object):
+    """ WKB, envelopes and fields of a list of geometries """
+
+    def __init__(self, wkb, offsets, envelopes, properties=None):
+        # the WKB of geometry i is wkb[offsets[i]:offsets[i + 1]]
+        self.wkb = np.frombuffer(wkb, dtype=np.uint8) if isinstance(wkb, bytes) else wkb
+        self.offsets = np.asarray(offsets, dtype=np.int64)
+        # (minlon, maxlon, minlat, maxlat) of every geometry
+        self.envelopes = np.asarray(envelopes, dtype=float).reshape(-1, 4)
+        self.properties = properties if properties is not None else [{} for e in self.envelopes]
+
+    def __len__(self):
+        return len(self.envelopes)
+
+    @classmethod
+    def from_geometries(cls, geometries, properties=None):
+        blobs = [bytes(g.ExportToWkb()) for g in geometries]
+        offsets = np.concatenate([[0], np.cumsum([len(b) for b in blobs], dtype=np.int64)])
+        envelopes = [g.GetEnvelope() for g in geometries]
+        return cls(b''.join(blobs), offsets, envelopes, properties)
+
+    @classmethod
+    def from_layer(cls, layer, fields=()):
+        """
+        Create a payload of the features of an OGR layer, with the given fields
+        """
+        geometries = []
+        properties = []
+        for i in range(layer.GetFeatureCount()):
+            feature = layer.GetFeature(i)
+            geometries.append(feature.geometry())
+            properties.append({field: feature.GetField(field) for field in fields})
+        return cls.from_geometries(geometries, properties)
+
+    def geometry(self, i):
+        return ogr.CreateGeometryFromWkb(self.wkb[self.offsets[i]:self.offsets[i + 1]].tobytes())
+
+    def extent(self):
+        """
+        Return the (minlon, maxlon, minlat, maxlat) extent of all geometries
+        """
+        return (
+            self.envelopes[:, 0].min(),
+            self.envelopes[:, 1].max(),
+            self.envelopes[:, 2].min(),
+            self.envelopes[:, 3].max(),
+        )
+
+    def to_shared_memory(self):
+        """
+        Copy the payload into a new shared memory block, returning the block,
+        which the caller has to unlink, and a small picklable descriptor
+        """
+        sizes = [self.envelopes.nbytes, self.offsets.nbytes, self.wkb.nbytes]
+        block = shared_memory.SharedMemory(create=True, size=max(sum(sizes), 1))
+        start = 0
+        for array, size in zip([self.envelopes, self.offsets, self.wkb], sizes):
+            block.buf[start:start + size] = array.tobytes()
+            start += size
+        descriptor = {'name': block.name, 'count': len(self), 'wkb_size': self.wkb.nbytes, 'properties': self.properties}
+        return block, descriptor
+
+    @classmethod
+    def from_shared_memory(cls, descriptor):
+        """
+        Copy a payload out of the shared memory block of a descriptor
+        """
+        block = attach_shared_memory(descriptor['name'])
+        try:
+            count = descriptor['count']
+            buffer = bytes(block.buf[:count * 32 + (count + 1) * 8 + descriptor['wkb_size']])
+        finally:
+            block.close()
+        envelopes = np.frombuffer(buffer, dtype=float, count=count * 4)
+        offsets = np.frombuffer(buffer, dtype=np.int64, count=count + 1, offset=count * 32)
+        wkb = np.frombuffer(buffer, dtype=np.uint8, offset=count * 32 + (count + 1) * 8)
+        return cls(wkb, offsets, envelopes, descriptor['properties'])
+
+
+class AreaFeature(object):
+    """ Feature of an `Area`, with the methods of an OGR feature used on areas """
+
+    def __init__(self, geometry, properties):
+        self._geometry = geometry
+        self.properties = properties
+
+    def geometry(self):
+        return self._geometry
+
+    def GetField(self, name):
+        return self.properties.get(name)
+
+
+class Area(object):
+    """
+    Geometries rebuilt from a payload, usable in place of the OGR layer
+    of a shapefile area (`GetExtent`, `GetFeatureCount`, `GetFeature`),
+    and pickled as its payload
+    """
+
+    def __init__(self, payload):
+        self.payload = payload
+        self.features = [AreaFeature(payload.geometry(i), payload.properties[i]) for i in range(len(payload))]
+        self.point = ogr.Geometry(ogr.wkbPoint)
+
+    def __getstate__(self):
+        return {'payload': self.payload}
+
+    def __setstate__(self, state):
+        self.__init__(state['payload'])
+
+    def GetExtent(self):
+        return self.payload.extent()
+
+    def GetFeatureCount(self):
+        return len(self.features)
+
+    def GetFeature(self, i):
+        return self.features[i]
+
+    def candidates(self, lat, lon):
+        """
+        Return the indices of the geometries whose envelope holds the point, in order
+        """
+        envelopes = self.payload.envelopes
+        return np.nonzero(
+            (lon >= envelopes[:, 0]) & (lon <= envelopes[:, 1]) & (lat >= envelopes[:, 2]) & (lat <= envelopes[:, 3])
+        )[0]
+
+    def contains(self, lat, lon):
+        """
+        Return whether the point is in any of the geometries, testing only
+        those whose envelope holds it
+        """
+        self.point.AddPoint(lon, lat)
+        for i in self.candidates(lat, lon):
+            if self.features[i].geometry().Contains(self.point):
+                return True
+        return False
+
+
+def init_worker(descriptors):
+    """
+    Pool initializer: rebuild every area from shared memory once per worker
+    """
+    for name, descriptor in descriptors.items():
+        WORKER_AREAS[name] = Area(GeometryPayload.from_shared_memory(descriptor))
+
+
+def worker_area(name):
+    """
+    Return an area rebuilt by the initializer of this worker
+    """
+    return WORKER_AREAS[name]
+
+
+@contextlib.contextmanager
+def geometry_pool(processes, payloads):
+    """
+    Yield a `multiprocessing` pool whose workers hold the areas of a
+    {name: payload} dictionary, available through `worker_area(name)`.
+    The payloads are shared with the workers through shared memory,
+    which is released when the pool is closed.
+    """
+    blocks = []
+    descriptors = {}
+    try:
+        for name, payload in payloads.items():
+            block, descriptors[name] = payload.to_shared_memory()
+            blocks.append(block)
+        with multiprocessing.Pool(processes, initializer=init_worker, initargs=(descriptors,)) as pool:
+            yield pool
+    finally:
+        for block in blocks:
+            block.close()
+            block.unlink()
+
+
+def area_mask_rows(task):
+    """
+    Pool task: return the mask of grid points inside of a worker's area
+    for a block of latitude rows, given as (area name, lats, lons)
+    """
+    name, lats, lons = task
+    area = worker_area(name)
+    mask = np.zeros((len(lats), len(lons)), dtype=bool)
+    for i, lat in enumerate(lats):
+        for j, lon in enumerate(lons):
+            mask[i, j] = area.contains(float(lat), float(lon))
+    return mask
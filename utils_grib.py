@@ -1,9 +1,25 @@
-from osgeo.ogr import Geometry, wkbPoint
+import numpy as np
+from osgeo.ogr import Geometry, wkbPoint, GetDriverByName
 # Only one OGR point needs to be created,
 # since each call to `OGR_POINT.AddPoint`
 # in the `check_point_in_area` function
 # will reset the variable
 OGR_POINT = Geometry(wkbPoint)
+# Opened shapefile data sources, keyed by filename,
+# so that each shapefile is only opened once per process
+SHAPEFILES = {}
+
+def load_area(filename):
+	"""
+	Return the layer of the specified shapefile,
+	opening the shapefile on first use
+	"""
+	if filename not in SHAPEFILES:
+		driver = GetDriverByName('ESRI Shapefile')
+		# Keep a reference to the data source,
+		# otherwise the layer becomes invalid
+		SHAPEFILES[filename] = driver.Open(filename)
+	return SHAPEFILES[filename].GetLayer()
 
 def coarse_geo_filter(df, AREA):
 	"""
@@ -69,3 +85,48 @@ def check_point_in_area(latlon, AREA):
 			break
 	# Return flag indicating whether point is in the area
 	return point_in_area
+
+# Boolean grid masks of shapefile areas, keyed by shapefile
+# and grid axes, so each mask is only computed once per process
+GRID_MASKS = {}
+
+def grid_area_mask(lats, lons, area_file, processes=0):
+	"""
+	Return the indices of the latitude and longitude axis values
+	inside of the extent of the shapefile area,
+	and a 2-D boolean array over those indices indicating
+	which grid points are inside of the area itself.
+	With a number of processes, the rows of the mask are split
+	over a pool of workers that each rebuild the area once.
+	A binary region store (see build_region_store.py) is located
+	with a vectorized polygon index instead, without OGR.
+	"""
+	key = (area_file, lats.tobytes(), lons.tobytes())
+	if key not in GRID_MASKS and area_file.endswith('.regions'):
+		from utils_polygon import PolygonIndex
+		GRID_MASKS[key] = PolygonIndex.load(area_file).grid_mask(lats, lons)
+	if key not in GRID_MASKS:
+		AREA = load_area(area_file)
+		# Map longitude range from (0 to 360) into (-180 to 180)
+		lons = np.where(lons > 180, lons - 360, lons)
+		# Coarse filter of the grid axes to the area's bounding box
+		minlon, maxlon, minlat, maxlat = AREA.GetExtent()
+		lat_idx = np.nonzero((lats >= minlat) & (lats <= maxlat))[0]
+		lon_idx = np.nonzero((lons >= minlon) & (lons <= maxlon))[0]
+		# Precise filter of each remaining grid point
+		if processes and len(lat_idx) and len(lon_idx):
+			from utils_geometry import GeometryPayload, geometry_pool, area_mask_rows
+			# The area is shared with the workers as WKB,
+			# and each task only carries its block of rows
+			payload = GeometryPayload.from_layer(AREA)
+			blocks = np.array_split(lats[lat_idx], processes)
+			with geometry_pool(processes, {area_file: payload}) as pool:
+				masks = pool.map(area_mask_rows, [(area_file, block, lons[lon_idx]) for block in blocks])
+			mask = np.concatenate(masks)
+		else:
+			mask = np.zeros((len(lat_idx), len(lon_idx)), dtype=bool)
+			for i, lat in enumerate(lats[lat_idx]):
+				for j, lon in enumerate(lons[lon_idx]):
+					mask[i, j] = check_point_in_area((lat, lon), AREA)
+		GRID_MASKS[key] = (lat_idx, lon_idx, mask)
+	return GRID_MASKS[key]
@@ -0,0 +1,244 @@
+"""
+Byte-offset index of the messages in a GRIB2 file
+
+The section headers of every message are walked once per file and the
+message offset, length, parameter, level and forecast time are stored in a
+sidecar `<file>.idx.json`. Readers can then copy only the messages of the
+variables they need into a small temporary GRIB2 file and decode that,
+instead of having the decoder scan and parse the whole bundle.
+
+Variables are selected with the PyNIO names used throughout this repo,
+for example `SOILW_P0_2L106_GLL0` or `APCP_P8_L1_GLL0_acc`.
+"""
+import os
+import re
+import json
+import struct
+import tempfile
+from contextlib import contextmanager
+
+INDEX_SUFFIX = '.idx.json'
+# Missing value of a type of fixed surface
+MISSING_SURFACE = 255
+
+# GRIB2 (discipline, parameter category, parameter number) of each short name
+PARAMETERS = {
+    # meteorological products
+    'TMP': (0, 0, 0),        # Temperature
+    'DPT': (0, 0, 6),        # Dew point temperature
+    'TMAX': (0, 0, 4),       # Maximum temperature
+    'TMIN': (0, 0, 5),       # Minimum temperature
+    'LHTFL': (0, 0, 10),     # Latent heat net flux
+    'SHTFL': (0, 0, 11),     # Sensible heat net flux
+    'SPFH': (0, 1, 0),       # Specific humidity
+    'RH': (0, 1, 1),         # Relative humidity
+    'APCP': (0, 1, 8),       # Total precipitation
+    'UGRD': (0, 2, 2),       # U-component of wind
+    'VGRD': (0, 2, 3),       # V-component of wind
+    'GUST': (0, 2, 22),      # Wind speed (gust)
+    'PRMSL': (0, 3, 1),      # Pressure reduced to MSL
+    'DSWRF': (0, 4, 192),    # Downward short-wave radiation flux
+    'USWRF': (0, 4, 193),    # Upward short-wave radiation flux
+    'DLWRF': (0, 5, 192),    # Downward long-wave radiation flux
+    'ULWRF': (0, 5, 193),    # Upward long-wave radiation flux
+    'TCDC': (0, 6, 1),       # Total cloud cover
+    # land surface products
+    'TSOIL': (2, 0, 2),      # Soil temperature
+    'SOILW': (2, 0, 192),    # Volumetric soil moisture content
+    # oceanographic products
+    'HTSGW': (10, 0, 3),     # Significant height of combined wind waves and swell
+    'WWSDIR': (10, 0, 14),   # Direction of combined wind waves and swell
+    'MWSPER': (10, 0, 15),   # Mean period of combined wind waves and swell
+    'UOGRD': (10, 1, 2),     # U-component of current
+    'VOGRD': (10, 1, 3),     # V-component of current
+    'WTMP': (10, 3, 0),      # Water temperature
+}
+SHORT_NAMES = {v: k for k, v in PARAMETERS.items()}
+
+# PyNIO variable names, e.g. `SOILW_P0_2L106_GLL0` is soil moisture
+# from product template 0 on a layer between two surfaces of type 106
+NIO_NAME = re.compile(r'^(?P<short>[A-Z0-9]+)_P(?P<pdt>\d+)_(?P<layer>2?)L(?P<level>\d+)_')
+
+
+def _signed(value, bits):
+    # GRIB2 stores negative numbers with a sign bit instead of two's complement
+    sign = 1 << (bits - 1)
+    if value & sign:
+        return -(value & (sign - 1))
+    return value
+
+
+def _level(scale, value):
+    # Convert a scaled level value into a number
+    if scale == 255 or value == 0xFFFFFFFF:
+        return None
+    return _signed(value, 32) / (10 ** _signed(scale, 8))
+
+
+def scan_messages(filepath):
+    """
+    Walk the section headers of every message in a GRIB2 file
+    and return a list of dictionary records, one per field
+    """
+    records = []
+    size = os.path.getsize(filepath)
+    with open(filepath, 'rb') as gribfile:
+        offset = 0
+        while offset + 16 <= size:
+            gribfile.seek(offset)
+            header = gribfile.read(16)
+            if header[:4] != b'GRIB':
+                # Skip any padding between messages
+                offset += 1
+                continue
+            if header[7] != 2:
+                raise ValueError('{} is not a GRIB2 file'.format(filepath))
+            discipline = header[6]
+            length = struct.unpack('>Q', header[8:16])[0]
+            reference_time = None
+            # Walk sections 1 to 7, stopping before the `7777` end section
+            position = offset + 16
+            end = offset + length - 4
+            while position < end:
+                gribfile.seek(position)
+                section = gribfile.read(5)
+                section_length, number = struct.unpack('>IB', section)
+                if number == 1:
+                    # Identification section: reference time
+                    content = section + gribfile.read(14)
+                    year = struct.unpack('>H', content[12:14])[0]
+                    reference_time = '{:04d}-{:02d}-{:02d} {:02d}:{:02d}:{:02d}'.format(
+                        year, content[14], content[15], content[16], content[17], content[18]
+                    )
+                elif number == 4:
+                    # Product definition section: parameter, level and forecast time.
+                    # A message can repeat sections 4 to 7 for several fields,
+                    # so one record is stored per product definition
+                    content = section + gribfile.read(29)
+                    pdt = struct.unpack('>H', content[7:9])[0]
+                    category = content[9]
+                    parameter = content[10]
+                    records.append({
+                        'offset': offset,
+                        'length': length,
+                        'discipline': discipline,
+                        'category': category,
+                        'parameter': parameter,
+                        'name': SHORT_NAMES.get((discipline, category, parameter)),
+                        'pdt': pdt,
+                        'reference_time': reference_time,
+                        'time_unit': content[17],
+                        'forecast_time': struct.unpack('>I', content[18:22])[0],
+                        'level_type': content[22],
+                        'level': _level(content[23], struct.unpack('>I', content[24:28])[0]),
+                        'second_level_type': content[28],
+                        'second_level': _level(content[29], struct.unpack('>I', content[30:34])[0]),
+                    })
+                if section_length == 0:
+                    raise ValueError('Corrupt section in {} at byte {}'.format(filepath, position))
+                position += section_length
+            offset += length
+    return records
+
+
+def load_index(filepath):
+    """
+    Return the message records of a GRIB2 file,
+    reading them from the sidecar index if it is up to date,
+    otherwise scanning the file and writing a new sidecar
+    """
+    stat = os.stat(filepath)
+    index_path = filepath + INDEX_SUFFIX
+    if os.path.exists(index_path):
+        with open(index_path, 'r') as indexfile:
+            index = json.load(indexfile)
+        # Only trust the index if the GRIB2 file has not changed since
+        if index['size'] == stat.st_size and index['mtime'] == stat.st_mtime:
+            return index['messages']
+    messages = scan_messages(filepath)
+    index = {'size': stat.st_size, 'mtime': stat.st_mtime, 'messages': messages}
+    try:
+        with open(index_path, 'w') as indexfile:
+            json.dump(index, indexfile)
+    except OSError:
+        # The data directory may be read-only,
+        # in which case the index is simply not cached
+        pass
+    return messages
+
+
+def matches(record, variable):
+    """
+    Return whether a message record holds data of the given PyNIO variable
+    """
+    match = NIO_NAME.match(variable)
+    if match is None or record['name'] != match.group('short'):
+        return False
+    if record['pdt'] != int(match.group('pdt')):
+        return False
+    if record['level_type'] != int(match.group('level')):
+        return False
+    # `2L` names are layers between two surfaces
+    is_layer = record['second_level_type'] != MISSING_SURFACE
+    return is_layer == bool(match.group('layer'))
+
+
+def select_messages(records, variables):
+    """
+    Return the sorted (offset, length) pairs of all messages
+    holding data of the given PyNIO variables
+    """
+    selected = set()
+    for record in records:
+        for variable in variables:
+            if matches(record, variable):
+                selected.add((record['offset'], record['length']))
+                break
+    return sorted(selected)
+
+
+@contextmanager
+def open_subset(filepath, variables):
+    """
+    Yield the path to a temporary GRIB2 file holding only the messages
+    of the given variables, which is removed again on exit.
+    The original path is yielded when none of the variables can be
+    found in the index, so that the caller can always decode the result.
+    """
+    try:
+        selected = select_messages(load_index(filepath), variables)
+    except (OSError, ValueError, struct.error):
+        selected = []
+    if not selected:
+        yield filepath
+        return
+    handle, subset_path = tempfile.mkstemp(suffix='.grib2')
+    try:
+        # Copy the selected messages straight from their byte ranges
+        with open(filepath, 'rb') as infile, os.fdopen(handle, 'wb') as outfile:
+            for offset, length in selected:
+                infile.seek(offset)
+                outfile.write(infile.read(length))
+        yield subset_path
+    finally:
+        os.remove(subset_path)
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(
+        description='Build the sidecar message index of GRIB2 files and print their inventory'
+    )
+    parser.add_argument('filepaths', type=str, nargs='+', help='The GRIB2 files to index')
+    args = parser.parse_args()
+    for filepath in args.filepaths:
+        for i, record in enumerate(load_index(filepath)):
+            print('{}:{}:{}:{}:lvl={}:{}:f{}'.format(
+                i + 1,
+                record['offset'],
+                record['name'] or '{discipline}.{category}.{parameter}'.format(**record),
+                record['level_type'],
+                record['level'],
+                record['reference_time'],
+                record['forecast_time'],
+            ))
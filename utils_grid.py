@@ -0,0 +1,17 @@
+"""
+Keys of regular forecast grids
+
+Masks and lookups that only depend on the grid of a forecast field are
+cached per grid under a short key, in memory and in files on disk.
+This module has no dependencies, so that the land masks, which do not
+need OGR, and the OGR regions can share the same keys.
+"""
+
+
+def grid_key(lats, lons):
+    """
+    Return a short string identifying a regular lat/lon grid
+    """
+    return '{}x{}_{:g}_{:g}_{:g}_{:g}'.format(
+        len(lats), len(lons), lats[0], lats[-1], lons[0], lons[-1]
+    )
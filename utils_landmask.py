@@ -0,0 +1,88 @@
+"""
+Static land-sea masks of forecast grids
+
+Oceans and lakes have a soil moisture of 100%, so the soil moisture
+scripts used to drop every row with `soil_moisture >= 1` after building
+the full dataframe of each file. Instead, a land mask is derived once per
+grid, either from a soil moisture field or from a shapefile of land areas,
+and saved as a bit-packed `.npz` file. Callers then gather only the land
+cells of each field through the mask.
+"""
+import os
+import numpy as np
+# local
+from utils_grid import grid_key
+
+# Directory holding the saved masks
+MASK_DIR = 'landmask'
+# Land masks already loaded in this process, keyed by grid
+LAND_MASKS = {}
+
+
+def derive_land_mask(soil_moisture):
+    """
+    Return a 2-D boolean land mask from a (lat, lon) soil moisture field,
+    where water cells are saturated (>= 1) or missing
+    """
+    soil_moisture = np.asarray(soil_moisture)
+    return np.isfinite(soil_moisture) & (soil_moisture < 1)
+
+
+def shapefile_land_mask(lats, lons, area_file):
+    """
+    Return a 2-D boolean land mask of the grid from a shapefile of land areas
+    """
+    # OGR is only needed when a mask is built from a shapefile
+    from utils_grib import grid_area_mask
+    mask = np.zeros((len(lats), len(lons)), dtype=bool)
+    lat_idx, lon_idx, area_mask = grid_area_mask(lats, lons, area_file)
+    mask[np.ix_(lat_idx, lon_idx)] = area_mask
+    return mask
+
+
+def save_land_mask(path, mask):
+    """
+    Save a boolean mask as a bit-packed `.npz` file
+    """
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    np.savez_compressed(path, bits=np.packbits(mask, axis=None), shape=mask.shape)
+
+
+def read_land_mask(path):
+    """
+    Read a boolean mask saved by `save_land_mask`
+    """
+    with np.load(path) as data:
+        shape = tuple(data['shape'])
+        bits = np.unpackbits(data['bits'], count=shape[0] * shape[1])
+    return bits.reshape(shape).astype(bool)
+
+
+def load_land_mask(lats, lons, soil_moisture=None, area_file=None, mask_dir=MASK_DIR):
+    """
+    Return the land mask of a grid, loading it from the process cache
+    or from disk, and otherwise deriving and saving it.
+    The mask is derived from `area_file` if one is given,
+    otherwise from the `soil_moisture` (lat, lon) field,
+    which is only read if the mask does not exist yet
+    and may be a callable returning the field.
+    """
+    key = grid_key(lats, lons)
+    if area_file:
+        key += '_' + os.path.splitext(os.path.basename(area_file))[0]
+    if key not in LAND_MASKS:
+        path = os.path.join(mask_dir, key + '.npz')
+        if os.path.exists(path):
+            mask = read_land_mask(path)
+        elif area_file:
+            mask = shapefile_land_mask(lats, lons, area_file)
+            save_land_mask(path, mask)
+        elif soil_moisture is not None:
+            if callable(soil_moisture):
+                soil_moisture = soil_moisture()
+            mask = derive_land_mask(soil_moisture)
+            save_land_mask(path, mask)
+        else:
+            raise ValueError('No land mask saved for grid {} and no source to derive it from'.format(key))
+        LAND_MASKS[key] = mask
+    return LAND_MASKS[key]
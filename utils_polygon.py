@@ -0,0 +1,327 @@
+"""
+Vectorized point-in-polygon lookups over many polygons
+
+OGR tests one point against one geometry per call, so finding the polygon
+of every position is a Python loop over positions and polygons.
+`PolygonIndex` converts the polygons once into flat arrays (the vertices
+of all rings, with the offsets of each ring and of each polygon's rings),
+indexes their envelopes on a regular grid of cells, and then locates
+whole arrays of points at once: each point is only tested against the
+polygons whose envelope covers it, with an even-odd ray crossing test
+over the edges of their rings in NumPy.
+
+An index can be saved to a compact binary region store (see
+`build_region_store.py`), which is memory-mapped when loaded, so that
+areas are available in milliseconds without opening shapefiles with OGR.
+"""
+import json
+import mmap
+import struct
+import numpy as np
+
+# Size in degrees of the cells of the envelope index
+CELL_SIZE = 1.0
+# Largest number of (point, edge) pairs tested in one array operation
+BLOCK_SIZE = 1 << 20
+# File suffix of binary region stores
+STORE_SUFFIX = '.regions'
+# Header of a region store: magic, version, padding, then the number of
+# polygons, rings and vertices and the byte length of the attributes
+STORE_MAGIC = b'REGIONS1'
+STORE_HEADER = struct.Struct('<8sII4Q')
+STORE_VERSION = 1
+
+
+def geometry_rings(geometry):
+    """
+    Return the rings of an OGR polygon or multipolygon as a list of (n, 2)
+    arrays of (lon, lat) vertices. Holes need no special handling: with the
+    even-odd rule, a point inside of a hole crosses the edges of two rings.
+    """
+    name = geometry.GetGeometryName()
+    if name in ('MULTIPOLYGON', 'GEOMETRYCOLLECTION'):
+        rings = []
+        for i in range(geometry.GetGeometryCount()):
+            part = geometry.GetGeometryRef(i)
+            # a union can leave lines or points in a collection, which have no area
+            if part.GetGeometryName() in ('POLYGON', 'MULTIPOLYGON', 'GEOMETRYCOLLECTION'):
+                rings += geometry_rings(part)
+        return rings
+    if name != 'POLYGON':
+        raise ValueError('Expected a polygon or multipolygon, got {}'.format(name))
+    return [
+        np.array(geometry.GetGeometryRef(i).GetPoints(), dtype=float)[:, :2]
+        for i in range(geometry.GetGeometryCount())
+    ]
+
+
+class PolygonIndex(object):
+    """ Polygons as flat ring arrays, with a grid index of their envelopes """
+
+    def __init__(self, coords, ring_offsets, polygon_offsets, properties=None, cell_size=CELL_SIZE, envelopes=None):
+        # (n, 2) array of the (lon, lat) vertices of all rings
+        self.coords = np.asarray(coords, dtype=float)
+        # the vertices of ring r are coords[ring_offsets[r]:ring_offsets[r + 1]]
+        self.ring_offsets = np.asarray(ring_offsets, dtype=np.int64)
+        # the rings of polygon p are ring_offsets[polygon_offsets[p]:polygon_offsets[p + 1]]
+        self.polygon_offsets = np.asarray(polygon_offsets, dtype=np.int64)
+        # e.g. the shapefile fields of each polygon
+        self.properties = properties if properties is not None else [{} for p in range(len(self))]
+        self.cell_size = cell_size
+        self._build_edges(envelopes)
+        self._build_grid()
+
+    def __len__(self):
+        return len(self.polygon_offsets) - 1
+
+    @classmethod
+    def from_rings(cls, polygons, properties=None, cell_size=CELL_SIZE):
+        """
+        Create an index from a list of polygons, each a list of rings of (lon, lat) vertices
+        """
+        rings = [np.asarray(ring, dtype=float).reshape(-1, 2) for polygon in polygons for ring in polygon]
+        ring_sizes = [len(ring) for ring in rings]
+        polygon_sizes = [len(polygon) for polygon in polygons]
+        coords = np.concatenate(rings) if rings else np.zeros((0, 2))
+        return cls(
+            coords,
+            np.concatenate([[0], np.cumsum(ring_sizes, dtype=np.int64)]),
+            np.concatenate([[0], np.cumsum(polygon_sizes, dtype=np.int64)]),
+            properties,
+            cell_size,
+        )
+
+    @classmethod
+    def from_geometries(cls, geometries, properties=None, cell_size=CELL_SIZE):
+        """
+        Create an index from OGR polygon or multipolygon geometries
+        """
+        return cls.from_rings([geometry_rings(g) for g in geometries], properties, cell_size)
+
+    @classmethod
+    def from_shapefile(cls, filename, fields=('NAME', 'ST'), buffer=0, cell_size=CELL_SIZE):
+        """
+        Create an index of the features of a shapefile, keeping the given
+        fields of each feature, optionally buffered by `buffer` degrees
+        """
+        # GDAL is only needed to build an index, not to query it
+        from osgeo import ogr
+        driver = ogr.GetDriverByName('ESRI Shapefile')
+        source = driver.Open(filename)
+        layer = source.GetLayer()
+        geometries = []
+        properties = []
+        for i in range(layer.GetFeatureCount()):
+            feature = layer.GetFeature(i)
+            geometry = feature.geometry()
+            if buffer:
+                geometry = geometry.Buffer(buffer)
+            geometries.append(geometry)
+            properties.append({field: feature.GetField(field) for field in fields})
+        index = cls.from_geometries(geometries, properties, cell_size)
+        source = None
+        return index
+
+    def _build_edges(self, envelopes=None):
+        # The edges of every ring, from each vertex to the next one,
+        # closing each ring back to its first vertex. The closing edge of a
+        # ring whose last vertex repeats its first one has zero length,
+        # and is never crossed.
+        starts = self.coords
+        ends = np.roll(self.coords, -1, axis=0)
+        ends[self.ring_offsets[1:] - 1] = self.coords[self.ring_offsets[:-1]]
+        self.x0, self.y0 = starts[:, 0], starts[:, 1]
+        self.x1, self.y1 = ends[:, 0], ends[:, 1]
+        # the longitude change per degree of latitude along each edge,
+        # which is not used for horizontal edges
+        with np.errstate(divide='ignore', invalid='ignore'):
+            self.slope = (self.x1 - self.x0) / (self.y1 - self.y0)
+        # the edges of polygon p are [edge_offsets[p], edge_offsets[p + 1])
+        self.edge_offsets = self.ring_offsets[self.polygon_offsets]
+        # (minlon, maxlon, minlat, maxlat) of every polygon
+        if envelopes is not None:
+            self.envelopes = np.asarray(envelopes, dtype=float).reshape(-1, 4)
+            return
+        self.envelopes = np.zeros((len(self), 4))
+        for p in range(len(self)):
+            vertices = self.coords[self.edge_offsets[p]:self.edge_offsets[p + 1]]
+            if len(vertices):
+                self.envelopes[p] = [vertices[:, 0].min(), vertices[:, 0].max(), vertices[:, 1].min(), vertices[:, 1].max()]
+            else:
+                self.envelopes[p] = [np.inf, -np.inf, np.inf, -np.inf]
+
+    def _build_grid(self):
+        # A regular grid of cells over the envelopes of all polygons,
+        # listing for each cell the polygons whose envelope overlaps it
+        valid = self.envelopes[:, 0] <= self.envelopes[:, 1]
+        if not valid.any():
+            self.origin = (0.0, 0.0)
+            self.shape = (0, 0)
+            self.cell_offsets = np.zeros(1, dtype=np.int64)
+            self.cell_polygons = np.zeros(0, dtype=np.int64)
+            return
+        self.origin = (
+            np.floor(self.envelopes[valid, 0].min() / self.cell_size) * self.cell_size,
+            np.floor(self.envelopes[valid, 2].min() / self.cell_size) * self.cell_size,
+        )
+        # polygons without vertices have infinite envelopes, and no cells
+        with np.errstate(invalid='ignore'):
+            first = self._cells(self.envelopes[:, 0], self.envelopes[:, 2])
+            last = self._cells(self.envelopes[:, 1], self.envelopes[:, 3])
+        self.shape = (int(last[1][valid].max()) + 1, int(last[0][valid].max()) + 1)
+        cells = []
+        polygons = []
+        for p in np.nonzero(valid)[0]:
+            cols = np.arange(first[0][p], last[0][p] + 1)
+            rows = np.arange(first[1][p], last[1][p] + 1)
+            ids = (rows[:, None] * self.shape[1] + cols[None, :]).ravel()
+            cells.append(ids)
+            polygons.append(np.full(len(ids), p, dtype=np.int64))
+        cells = np.concatenate(cells)
+        polygons = np.concatenate(polygons)
+        # sorted by cell, keeping the polygons of each cell in index order
+        order = np.argsort(cells, kind='stable')
+        self.cell_polygons = polygons[order]
+        counts = np.bincount(cells, minlength=self.shape[0] * self.shape[1])
+        self.cell_offsets = np.concatenate([[0], np.cumsum(counts)])
+
+    def _cells(self, lons, lats):
+        # Column and row of the grid cell of each coordinate
+        cols = np.floor((lons - self.origin[0]) / self.cell_size).astype(np.int64)
+        rows = np.floor((lats - self.origin[1]) / self.cell_size).astype(np.int64)
+        return cols, rows
+
+    def candidates(self, lats, lons):
+        """
+        Return the (point, polygon) pairs of every point and every polygon
+        whose envelope contains it, sorted by polygon
+        """
+        n = len(lats)
+        if self.shape == (0, 0) or n == 0:
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+        cols, rows = self._cells(lons, lats)
+        inside = (cols >= 0) & (cols < self.shape[1]) & (rows >= 0) & (rows < self.shape[0])
+        cells = np.where(inside, rows * self.shape[1] + cols, 0)
+        counts = np.where(inside, self.cell_offsets[cells + 1] - self.cell_offsets[cells], 0)
+        # expand every point into one pair per polygon listed in its cell
+        points = np.repeat(np.arange(n), counts)
+        first = np.repeat(self.cell_offsets[cells] - (np.cumsum(counts) - counts), counts)
+        polygons = self.cell_polygons[first + np.arange(len(points))]
+        # keep the pairs whose polygon envelope holds the point
+        envelopes = self.envelopes[polygons]
+        x = lons[points]
+        y = lats[points]
+        keep = (x >= envelopes[:, 0]) & (x <= envelopes[:, 1]) & (y >= envelopes[:, 2]) & (y <= envelopes[:, 3])
+        points = points[keep]
+        polygons = polygons[keep]
+        order = np.argsort(polygons, kind='stable')
+        return points[order], polygons[order]
+
+    def contains(self, polygon, lats, lons):
+        """
+        Return whether each point is inside of one polygon
+        """
+        start, stop = self.edge_offsets[polygon], self.edge_offsets[polygon + 1]
+        x0, y0, y1, slope = self.x0[start:stop], self.y0[start:stop], self.y1[start:stop], self.slope[start:stop]
+        inside = np.zeros(len(lats), dtype=bool)
+        # test blocks of points against all edges, bounding the memory used
+        block = max(1, BLOCK_SIZE // max(stop - start, 1))
+        for i in range(0, len(lats), block):
+            y = lats[i:i + block, None]
+            x = lons[i:i + block, None]
+            # count the edges crossed by a ray from each point towards increasing longitude
+            with np.errstate(invalid='ignore'):
+                crosses = ((y0 > y) != (y1 > y)) & (x < x0 + (y - y0) * slope)
+            inside[i:i + block] = np.count_nonzero(crosses, axis=1) % 2 == 1
+        return inside
+
+    def locate(self, lats, lons):
+        """
+        Return the index of the first polygon containing each point, or -1,
+        with the longitudes in either the (0 to 360) or the (-180 to 180) range
+        """
+        lats = np.asarray(lats, dtype=float).ravel()
+        lons = np.asarray(lons, dtype=float).ravel()
+        lons = np.where(lons > 180, lons - 360, lons)
+        points, polygons = self.candidates(lats, lons)
+        inside = np.zeros(len(points), dtype=bool)
+        # test the points of each candidate polygon together
+        bounds = np.concatenate([[0], np.nonzero(np.diff(polygons))[0] + 1, [len(polygons)]])
+        for start, stop in zip(bounds[:-1], bounds[1:]):
+            if stop > start:
+                chosen = points[start:stop]
+                inside[start:stop] = self.contains(polygons[start], lats[chosen], lons[chosen])
+        # the lowest polygon index containing each point
+        result = np.full(len(lats), len(self), dtype=np.int64)
+        np.minimum.at(result, points[inside], polygons[inside])
+        result[result == len(self)] = -1
+        return result
+
+    def grid_mask(self, lats, lons):
+        """
+        Return the indices of the latitude and longitude axis values inside
+        of the extent of all polygons, and a 2-D boolean array over those
+        indices indicating which grid points are inside of any polygon
+        """
+        # Map longitude range from (0 to 360) into (-180 to 180)
+        lons = np.where(lons > 180, lons - 360, lons)
+        valid = self.envelopes[:, 0] <= self.envelopes[:, 1]
+        if valid.any():
+            minlon, maxlon = self.envelopes[valid, 0].min(), self.envelopes[valid, 1].max()
+            minlat, maxlat = self.envelopes[valid, 2].min(), self.envelopes[valid, 3].max()
+            lat_idx = np.nonzero((lats >= minlat) & (lats <= maxlat))[0]
+            lon_idx = np.nonzero((lons >= minlon) & (lons <= maxlon))[0]
+        else:
+            lat_idx = lon_idx = np.zeros(0, dtype=np.int64)
+        grid_lats, grid_lons = np.meshgrid(lats[lat_idx], lons[lon_idx], indexing='ij')
+        mask = self.locate(grid_lats, grid_lons) >= 0
+        return lat_idx, lon_idx, mask.reshape(len(lat_idx), len(lon_idx))
+
+    def save(self, path):
+        """
+        Write the index to a binary region store: the header, the vertices,
+        the ring and polygon offsets and the envelopes as little-endian
+        arrays, then the attributes of the polygons as JSON
+        """
+        attributes = json.dumps(self.properties).encode('utf-8')
+        with open(path, 'wb') as outfile:
+            outfile.write(STORE_HEADER.pack(
+                STORE_MAGIC, STORE_VERSION, 0,
+                len(self), len(self.ring_offsets) - 1, len(self.coords), len(attributes),
+            ))
+            outfile.write(self.coords.astype('<f8').tobytes())
+            outfile.write(self.ring_offsets.astype('<i8').tobytes())
+            outfile.write(self.polygon_offsets.astype('<i8').tobytes())
+            outfile.write(self.envelopes.astype('<f8').tobytes())
+            outfile.write(attributes)
+
+    @classmethod
+    def load(cls, path, cell_size=CELL_SIZE):
+        """
+        Load an index from a binary region store, mapping its arrays
+        from the file instead of reading them
+        """
+        with open(path, 'rb') as infile:
+            data = mmap.mmap(infile.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, padding, polygons, rings, vertices, length = STORE_HEADER.unpack_from(data)
+        if magic != STORE_MAGIC or version != STORE_VERSION:
+            raise ValueError('{} is not a version {} region store'.format(path, STORE_VERSION))
+        arrays = []
+        offset = STORE_HEADER.size
+        for dtype, count in (('<f8', vertices * 2), ('<i8', rings + 1), ('<i8', polygons + 1), ('<f8', polygons * 4)):
+            arrays.append(np.frombuffer(data, dtype=dtype, count=count, offset=offset))
+            offset += count * 8
+        properties = json.loads(data[offset:offset + length].decode('utf-8'))
+        coords, ring_offsets, polygon_offsets, envelopes = arrays
+        return cls(coords.reshape(-1, 2), ring_offsets, polygon_offsets, properties, cell_size, envelopes)
+
+
+def open_index(filename, fields=('NAME', 'ST'), buffer=0):
+    """
+    Return the index of a binary region store, or of a shapefile
+    read with OGR, with the given fields of each feature.
+    The fields and buffer of a store are chosen when it is built.
+    """
+    if filename.endswith(STORE_SUFFIX):
+        return PolygonIndex.load(filename)
+    return PolygonIndex.from_shapefile(filename, fields, buffer)
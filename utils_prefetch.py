@@ -0,0 +1,95 @@
+"""
+Prefetching reader for batches of forecast files
+
+The batch scripts handle one file at a time: read and decode it, filter
+it, write the CSVs, then move on. `prefetch` decodes the next files on
+background workers while the current one is being processed, so that
+reads from network storage overlap with the filtering and writing.
+
+The GRIB decoders (PyNIO, eccodes) are not thread-safe, so the files are
+decoded on worker processes by default, and the decoded datasets are
+pickled back. Without prefetching, `open_dataset` keeps a file lazy, so
+only the values the caller reads are ever decoded.
+"""
+import contextlib
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+import xarray as xr
+# local
+from utils_grib_index import open_subset
+
+
+def open_dataset(filename, variables=None, engine='pynio'):
+    """
+    Open a forecast file without decoding it and return the dataset.
+    With a list of variables, only their messages are copied into a
+    temporary file, which is removed when the dataset is closed.
+    """
+    if variables is None:
+        return xr.open_dataset(filename, engine=engine)
+    subset = contextlib.ExitStack()
+    try:
+        ds = xr.open_dataset(subset.enter_context(open_subset(filename, variables)), engine=engine)
+    except Exception:
+        subset.close()
+        raise
+    # close the decoder's file before removing the temporary subset file
+    close = ds._close
+    def close_subset():
+        if close is not None:
+            close()
+        subset.close()
+    ds.set_close(close_subset)
+    return ds
+
+
+def load_dataset(filename, variables=None, engine='pynio', lazy=False):
+    """
+    Decode a forecast file fully into memory and return the dataset,
+    or only open it if `lazy` is set (see `open_dataset`).
+    With a list of variables, only their messages are read from the file.
+    """
+    if lazy:
+        return open_dataset(filename, variables, engine)
+    if variables is None:
+        ds = xr.open_dataset(filename, engine=engine)
+        ds.load()
+        ds.close()
+        return ds
+    with open_subset(filename, variables) as subset:
+        ds = xr.open_dataset(subset, engine=engine)
+        # read the values before the temporary subset file is removed
+        ds.load()
+        ds.close()
+    return ds
+
+
+def prefetch(items, load, depth=1, processes=True):
+    """
+    Yield (item, load(item)) for every item in order, loading up to
+    `depth` items ahead of the one being processed by the caller.
+    Loading happens on processes, and the loaded values are pickled back
+    to the caller, or on threads if `processes` is not set, which is only
+    safe if `load` is thread-safe.
+    With a depth of 0 the items are loaded one at a time in the caller.
+    """
+    if depth < 1:
+        for item in items:
+            yield item, load(item)
+        return
+    executor_class = ProcessPoolExecutor if processes else ThreadPoolExecutor
+    items = iter(items)
+    with executor_class(max_workers=depth) as executor:
+        pending = deque()
+        # start loading the first items
+        for item in items:
+            pending.append((item, executor.submit(load, item)))
+            if len(pending) == depth:
+                break
+        while pending:
+            item, future = pending.popleft()
+            # keep `depth` items loading while this one is processed
+            for next_item in items:
+                pending.append((next_item, executor.submit(load, next_item)))
+                break
+            yield item, future.result()
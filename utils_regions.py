@@ -0,0 +1,184 @@
+"""
+Registry of named forecast regions
+
+Each region holds its geometry, envelope and the boolean masks of the
+forecast grids it has been applied to, so none of them has to be worked
+out again for every forecast file. A registry can be saved to and loaded
+from a JSON file, which removes the shapefile lookups from later runs.
+"""
+import os
+import json
+import base64
+import multiprocessing
+import numpy as np
+from osgeo import ogr
+# local
+from utils_grid import grid_key
+
+
+class Region(object):
+    """ A named area with its geometry, envelope and cached grid masks """
+
+    def __init__(self, name, geometry, feature_json=None, masks=None):
+        self.name = name
+        self.geometry = geometry
+        # (minlon, maxlon, minlat, maxlat)
+        self.envelope = geometry.GetEnvelope()
+        # GeoJSON of the original shapefile feature
+        self.feature_json = feature_json
+        self.masks = masks or {}
+
+    def __getstate__(self):
+        # OGR geometries cannot be pickled, so the geometry is sent as WKB
+        state = dict(self.__dict__)
+        state['geometry'] = bytes(self.geometry.ExportToWkb())
+        return state
+
+    def __setstate__(self, state):
+        state['geometry'] = ogr.CreateGeometryFromWkb(state['geometry'])
+        self.__dict__.update(state)
+
+    def contains(self, lat, lon):
+        """
+        Return whether the point is inside of the region,
+        with the longitude in either the (0 to 360) or the (-180 to 180) range
+        """
+        if lon > 180:
+            lon = lon - 360
+        point = ogr.Geometry(ogr.wkbPoint)
+        point.AddPoint(lon, lat)
+        return self.geometry.Contains(point)
+
+    def grid_mask(self, lats, lons):
+        """
+        Return the indices of the latitude and longitude axis values
+        inside of the region's envelope, and a 2-D boolean array over those
+        indices indicating which grid points are inside of the region.
+        The result is computed once per grid.
+        """
+        key = grid_key(lats, lons)
+        if key not in self.masks:
+            minlon, maxlon, minlat, maxlat = self.envelope
+            # Map longitude range from (0 to 360) into (-180 to 180)
+            maplons = np.where(lons > 180, lons - 360, lons)
+            lat_idx = np.nonzero((lats >= minlat) & (lats <= maxlat))[0]
+            lon_idx = np.nonzero((maplons >= minlon) & (maplons <= maxlon))[0]
+            mask = np.zeros((len(lat_idx), len(lon_idx)), dtype=bool)
+            for i, lat in enumerate(lats[lat_idx]):
+                for j, lon in enumerate(maplons[lon_idx]):
+                    mask[i, j] = self.contains(lat, lon)
+            self.masks[key] = (lat_idx, lon_idx, mask)
+        return self.masks[key]
+
+    def to_dict(self):
+        """
+        Return a JSON-serializable description of the region
+        """
+        masks = {}
+        for key, (lat_idx, lon_idx, mask) in self.masks.items():
+            masks[key] = {
+                'lat_idx': lat_idx.tolist(),
+                'lon_idx': lon_idx.tolist(),
+                'mask': base64.b64encode(np.packbits(mask, axis=None)).decode('ascii'),
+            }
+        return {
+            'name': self.name,
+            'geometry': self.geometry.ExportToWkt(),
+            'feature': self.feature_json,
+            'masks': masks,
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        """
+        Rebuild a region from the output of `to_dict`
+        """
+        masks = {}
+        for key, m in data['masks'].items():
+            lat_idx = np.array(m['lat_idx'], dtype=np.int64)
+            lon_idx = np.array(m['lon_idx'], dtype=np.int64)
+            bits = np.frombuffer(base64.b64decode(m['mask']), dtype=np.uint8)
+            mask = np.unpackbits(bits, count=len(lat_idx) * len(lon_idx)).astype(bool)
+            masks[key] = (lat_idx, lon_idx, mask.reshape(len(lat_idx), len(lon_idx)))
+        geometry = ogr.CreateGeometryFromWkt(data['geometry'])
+        return cls(data['name'], geometry, data['feature'], masks)
+
+
+def build_registry(checker, places, buffer=1):
+    """
+    Resolve each place of a `CountryChecker` city shapefile into a region
+    covering a buffer (in degrees) around the city's centroid
+    """
+    registry = {}
+    for p in places:
+        # get the city feature from the shapefile
+        feature = checker.getFeature(p['city'], p['state'])
+        # create a buffer around the centroid point of the city feature
+        geometry = feature.geometry().Centroid().Buffer(buffer)
+        registry[p['city']] = Region(p['city'], geometry, feature.ExportToJson())
+    return registry
+
+
+# The registry of a `compute_grid_masks` worker,
+# unpickled once per worker by the pool initializer
+WORKER_REGISTRY = {}
+
+
+def init_mask_worker(registry):
+    WORKER_REGISTRY.update(registry)
+
+
+def region_grid_mask(task):
+    name, lats, lons = task
+    return WORKER_REGISTRY[name].grid_mask(lats, lons)
+
+
+def compute_grid_masks(registry, lats, lons, processes):
+    """
+    Compute the grid masks of all regions of a registry that do not
+    have one for this grid yet, one region per task on a pool of workers.
+    The regions are sent to each worker once, when it starts.
+    """
+    key = grid_key(lats, lons)
+    missing = [name for name, region in registry.items() if key not in region.masks]
+    if not missing:
+        return
+    regions = {name: registry[name] for name in missing}
+    with multiprocessing.Pool(min(processes, len(missing)), initializer=init_mask_worker, initargs=(regions,)) as pool:
+        masks = pool.map(region_grid_mask, [(name, lats, lons) for name in missing])
+    for name, mask in zip(missing, masks):
+        registry[name].masks[key] = mask
+
+
+def save_registry(path, registry):
+    """
+    Save a registry of regions to a JSON file
+    """
+    data = [region.to_dict() for region in registry.values()]
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as outfile:
+        json.dump(data, outfile)
+    os.replace(tmp_path, path)
+
+
+def load_registry(path):
+    """
+    Load a registry of regions saved by `save_registry`
+    """
+    with open(path, 'r') as infile:
+        data = json.load(infile)
+    return {d['name']: Region.from_dict(d) for d in data}
+
+
+def write_if_changed(path, content):
+    """
+    Write the content to a file unless it already holds exactly that content,
+    returning whether the file was written
+    """
+    if os.path.exists(path):
+        with open(path, 'r') as infile:
+            if infile.read() == content:
+                return False
+    with open(path, 'w') as outfile:
+        outfile.write(content)
+    return True
@@ -0,0 +1,96 @@
+"""
+Raster rendering of regular lat/lon grid data
+
+Instead of drawing one marker per grid point, the points are placed back
+into their 2-D grid and drawn as a single image, so rendering time and
+output size no longer depend on the number of points.
+"""
+import io
+import re
+import base64
+import numpy as np
+
+
+def _axis(values):
+    # Build the full axis of a regular grid from the values present,
+    # so that gaps between separate areas keep their true size
+    unique = np.unique(values)
+    if len(unique) == 1:
+        return unique, np.zeros(len(values), dtype=np.int64)
+    step = np.min(np.diff(unique))
+    count = int(np.rint((unique[-1] - unique[0]) / step)) + 1
+    axis = unique[0] + step * np.arange(count)
+    positions = np.rint((values - unique[0]) / step).astype(np.int64)
+    return axis, positions
+
+
+def to_grid(lats, lons, values):
+    """
+    Place point values of a regular lat/lon grid into a 2-D array,
+    returning the ascending latitude and longitude axes and the array,
+    with NaN wherever no point was given
+    """
+    lat_axis, lat_pos = _axis(np.asarray(lats, dtype=float))
+    lon_axis, lon_pos = _axis(np.asarray(lons, dtype=float))
+    grid = np.full((len(lat_axis), len(lon_axis)), np.nan)
+    grid[lat_pos, lon_pos] = values
+    return lat_axis, lon_axis, grid
+
+
+def grid_bounds(lat_axis, lon_axis):
+    """
+    Return the (west, east, south, north) edges of the grid cells,
+    which extend half a cell beyond the outermost points
+    """
+    dlat = (lat_axis[-1] - lat_axis[0]) / max(len(lat_axis) - 1, 1) or 1
+    dlon = (lon_axis[-1] - lon_axis[0]) / max(len(lon_axis) - 1, 1) or 1
+    return (
+        lon_axis[0] - dlon / 2,
+        lon_axis[-1] + dlon / 2,
+        lat_axis[0] - dlat / 2,
+        lat_axis[-1] + dlat / 2,
+    )
+
+
+def parse_color(color):
+    """
+    Convert a plotly color string (`#rrggbb`, `rgb(...)` or `rgba(...)`)
+    into an (r, g, b, a) tuple of floats from 0 to 1
+    """
+    if color.startswith('#'):
+        return tuple(int(color[i:i + 2], 16) / 255 for i in (1, 3, 5)) + (1.0,)
+    parts = [float(p) for p in re.findall(r'[\d.]+', color)]
+    alpha = parts[3] if len(parts) > 3 else 1.0
+    return (parts[0] / 255, parts[1] / 255, parts[2] / 255, alpha)
+
+
+def colorscale_to_cmap(colorscale, reverse=False):
+    """
+    Build a matplotlib colormap from a plotly colorscale
+    """
+    from matplotlib.colors import LinearSegmentedColormap
+    stops = [(position, parse_color(color)) for position, color in colorscale]
+    cmap = LinearSegmentedColormap.from_list('colorscale', stops)
+    if reverse:
+        cmap = cmap.reversed()
+    return cmap
+
+
+def render_png(grid, cmap, vmin, vmax):
+    """
+    Render a (lat, lon) grid with ascending latitudes as PNG bytes,
+    north up, with missing values transparent
+    """
+    import matplotlib.image
+    buf = io.BytesIO()
+    masked = np.ma.masked_invalid(np.flipud(grid))
+    cmap = cmap.with_extremes(bad=(0, 0, 0, 0))
+    matplotlib.image.imsave(buf, masked, cmap=cmap, vmin=vmin, vmax=vmax, format='png')
+    return buf.getvalue()
+
+
+def png_data_uri(png):
+    """
+    Encode PNG bytes as a data URI, which can be used as an image source
+    """
+    return 'data:image/png;base64,' + base64.b64encode(png).decode('ascii')
@@ -0,0 +1,257 @@
+"""
+Streaming summary statistics with mergeable quantile sketches
+
+`RunningStats` takes batches of values and keeps the count, the mean and
+variance (Welford's method, with Chan's formula to merge a whole batch at
+once), the minimum and maximum, and a DDSketch-style quantile sketch: each
+value is counted in a logarithmic bucket, so quantiles are estimated
+within a fixed relative error. Two accumulators over separate values
+(e.g. from parallel workers) merge into the accumulator of all of them,
+and an accumulator serializes to a small dictionary.
+"""
+import numpy as np
+
+# Relative accuracy of the quantile estimates
+RELATIVE_ACCURACY = 0.01
+# Values closer to zero than this are counted as zero
+MIN_VALUE = 1e-9
+# Quantiles reported by `summary`
+QUANTILES = (0.5, 0.9, 0.99)
+
+
+class BucketStore(object):
+    """ Dense array of bucket counts, starting at the bucket index `offset` """
+
+    def __init__(self, offset=0, counts=None):
+        self.offset = offset
+        self.counts = np.zeros(0, dtype=np.int64) if counts is None else np.asarray(counts, dtype=np.int64)
+
+    def add(self, indices, counts):
+        """
+        Add counts to the buckets of an array of bucket indices starting at `indices`
+        """
+        if len(counts) == 0:
+            return
+        if len(self.counts) == 0:
+            self.offset = indices
+            self.counts = np.array(counts, dtype=np.int64)
+            return
+        # grow the array to cover both ranges of buckets
+        low = min(self.offset, indices)
+        high = max(self.offset + len(self.counts), indices + len(counts))
+        if low != self.offset or high != self.offset + len(self.counts):
+            grown = np.zeros(high - low, dtype=np.int64)
+            grown[self.offset - low:self.offset - low + len(self.counts)] = self.counts
+            self.offset = low
+            self.counts = grown
+        self.counts[indices - low:indices - low + len(counts)] += counts
+
+    def total(self):
+        return int(self.counts.sum())
+
+    def to_list(self):
+        # only the non-empty buckets are listed, as [indices, counts]
+        nonzero = np.nonzero(self.counts)[0]
+        return [(nonzero + self.offset).tolist(), self.counts[nonzero].tolist()]
+
+    @classmethod
+    def from_list(cls, data):
+        indices, counts = data
+        store = cls()
+        if indices:
+            dense = np.zeros(indices[-1] - indices[0] + 1, dtype=np.int64)
+            dense[np.asarray(indices) - indices[0]] = counts
+            store.add(indices[0], dense)
+        return store
+
+
+class QuantileSketch(object):
+    """ Logarithmic bucket counts of positive and negative values, and a zero count """
+
+    def __init__(self, relative_accuracy=RELATIVE_ACCURACY):
+        self.relative_accuracy = relative_accuracy
+        self.gamma = (1 + relative_accuracy) / (1 - relative_accuracy)
+        self.log_gamma = np.log(self.gamma)
+        self.positive = BucketStore()
+        self.negative = BucketStore()
+        self.zeros = 0
+
+    def _add(self, store, values):
+        # Count every value in the bucket index ceil(log_gamma(value))
+        if len(values) == 0:
+            return
+        indices = np.ceil(np.log(values) / self.log_gamma).astype(np.int64)
+        lowest = int(indices.min())
+        store.add(lowest, np.bincount(indices - lowest))
+
+    def update(self, values):
+        """
+        Add an array of finite values to the sketch
+        """
+        values = np.asarray(values, dtype=float)
+        self._add(self.positive, values[values > MIN_VALUE])
+        self._add(self.negative, -values[values < -MIN_VALUE])
+        self.zeros += int(np.count_nonzero(np.abs(values) <= MIN_VALUE))
+
+    def merge(self, other):
+        """
+        Add the counts of another sketch with the same accuracy
+        """
+        self.positive.add(other.positive.offset, other.positive.counts)
+        self.negative.add(other.negative.offset, other.negative.counts)
+        self.zeros += other.zeros
+
+    def count(self):
+        return self.positive.total() + self.negative.total() + self.zeros
+
+    def _values(self, store):
+        # The estimate of each bucket, within the relative accuracy of all its values
+        keys = store.offset + np.arange(len(store.counts))
+        return 2 * self.gamma ** keys / (self.gamma + 1)
+
+    def quantiles(self, qs):
+        """
+        Return the estimates of several q-quantiles (0 <= q <= 1),
+        which are NaN if the sketch is empty
+        """
+        total = self.count()
+        if total == 0:
+            return [np.nan for q in qs]
+        # bucket values and counts in ascending order: negatives, zero, positives
+        values = np.concatenate([-self._values(self.negative)[::-1], [0.0], self._values(self.positive)])
+        counts = np.concatenate([self.negative.counts[::-1], [self.zeros], self.positive.counts])
+        # the first bucket whose cumulative count passes the rank of each quantile
+        ranks = np.asarray(qs, dtype=float) * (total - 1)
+        positions = np.searchsorted(np.cumsum(counts), ranks, side='right')
+        return values[np.minimum(positions, len(values) - 1)].tolist()
+
+    def quantile(self, q):
+        """
+        Return the estimate of the q-quantile (0 <= q <= 1), or NaN if empty
+        """
+        return self.quantiles([q])[0]
+
+    def to_dict(self):
+        return {
+            'a': self.relative_accuracy,
+            'z': self.zeros,
+            'p': self.positive.to_list(),
+            'n': self.negative.to_list(),
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        sketch = cls(data['a'])
+        sketch.zeros = data['z']
+        sketch.positive = BucketStore.from_list(data['p'])
+        sketch.negative = BucketStore.from_list(data['n'])
+        return sketch
+
+
+class RunningStats(object):
+    """ Count, mean, variance, minimum, maximum and quantile sketch of a stream of values """
+
+    def __init__(self, relative_accuracy=RELATIVE_ACCURACY):
+        self.count = 0
+        self.mean = 0.0
+        self.m2 = 0.0
+        self.min = np.inf
+        self.max = -np.inf
+        self.sketch = QuantileSketch(relative_accuracy)
+
+    def _combine(self, count, mean, m2):
+        # Chan's parallel form of Welford's update
+        total = self.count + count
+        delta = mean - self.mean
+        self.mean += delta * count / total
+        self.m2 += m2 + delta ** 2 * self.count * count / total
+        self.count = total
+
+    def update(self, values):
+        """
+        Add an array of values in one pass, ignoring NaN
+        """
+        values = np.asarray(values, dtype=float).ravel()
+        values = values[np.isfinite(values)]
+        if len(values) == 0:
+            return self
+        mean = float(values.mean())
+        deviations = values - mean
+        self._combine(len(values), mean, float(np.dot(deviations, deviations)))
+        self.min = min(self.min, float(values.min()))
+        self.max = max(self.max, float(values.max()))
+        self.sketch.update(values)
+        return self
+
+    def merge(self, other):
+        """
+        Add the statistics of another accumulator, as if its values
+        had been added to this one
+        """
+        if other.count == 0:
+            return self
+        self._combine(other.count, other.mean, other.m2)
+        self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+        self.sketch.merge(other.sketch)
+        return self
+
+    def variance(self, ddof=1):
+        if self.count <= ddof:
+            return np.nan
+        return self.m2 / (self.count - ddof)
+
+    def std(self, ddof=1):
+        """
+        Return the standard deviation, by default the sample standard
+        deviation like pandas
+        """
+        return float(np.sqrt(self.variance(ddof)))
+
+    def quantile(self, q):
+        return self.sketch.quantile(q)
+
+    def summary(self, quantiles=QUANTILES):
+        """
+        Return the statistics as a flat dictionary, with NaN for an empty stream
+        """
+        empty = self.count == 0
+        summary = {
+            'count': self.count,
+            'mean': np.nan if empty else self.mean,
+            'std': self.std(),
+            'min': np.nan if empty else self.min,
+            'max': np.nan if empty else self.max,
+        }
+        for q, value in zip(quantiles, self.sketch.quantiles(quantiles)):
+            # a bucket estimate can lie just outside of the values seen
+            if not empty:
+                value = min(max(value, self.min), self.max)
+            summary['p{:g}'.format(q * 100)] = value
+        return summary
+
+    def to_dict(self):
+        """
+        Return a compact JSON-serializable state, which `from_dict` restores
+        and which can be merged with the states of other workers
+        """
+        return {
+            'n': self.count,
+            'mean': self.mean,
+            'm2': self.m2,
+            'min': self.min if self.count else None,
+            'max': self.max if self.count else None,
+            'sketch': self.sketch.to_dict(),
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        stats = cls(data['sketch']['a'])
+        stats.count = data['n']
+        stats.mean = data['mean']
+        stats.m2 = data['m2']
+        if data['n']:
+            stats.min = data['min']
+            stats.max = data['max']
+        stats.sketch = QuantileSketch.from_dict(data['sketch'])
+        return stats
@@ -0,0 +1,315 @@
+"""
+Work queue on a shared filesystem
+
+A coordinator writes one work unit per task (e.g. GRIB2 file x job) into a
+queue directory that every node can see, such as an NFS volume. Workers
+claim units by renaming them from `pending/` into `claimed/`, which is
+atomic within one filesystem, so each unit is processed by exactly one
+worker without any external broker. Each result is written to its own file
+in `results/` and the coordinator merges them once every unit is done.
+
+    <queue>/pending/<unit>.pkl     # waiting to be claimed
+    <queue>/claimed/<unit>.pkl     # being processed, mtime is the claim time
+    <queue>/done/<unit>.pkl        # processed, result in results/<unit>.pkl
+    <queue>/failed/<unit>.pkl      # raised an error, traceback in results/<unit>.pkl
+    <queue>/results/<unit>.pkl
+
+A unit names its job as `module:function`, which workers import from the
+directories listed in the unit (by default the coordinator's working
+directory), and holds the single argument to pass it. The job runs in the
+coordinator's working directory, so that relative paths resolve the same
+on every node. Units and results are pickled, so any picklable arguments
+can be queued.
+
+A worker that dies leaves its unit in `claimed/`. Claims older than the
+stale timeout are moved back to `pending/` by the coordinator and by
+waiting workers, so the unit is processed again by another worker.
+A worker that was only slow may still finish its requeued unit: the first
+result of a unit is kept, and later results of the same unit are dropped.
+"""
+import os
+import sys
+import time
+import pickle
+import socket
+import importlib
+import traceback
+import multiprocessing
+
+STATES = ('pending', 'claimed', 'done', 'failed', 'results', 'tmp')
+# Seconds after which a claimed unit is assumed to belong to a dead worker
+DEFAULT_STALE = 3600
+
+
+class WorkQueue(object):
+    """ Queue of work units stored as files in a shared directory """
+
+    def __init__(self, root):
+        self.root = root
+        for state in STATES:
+            os.makedirs(os.path.join(root, state), exist_ok=True)
+
+    def _path(self, state, unit_id):
+        return os.path.join(self.root, state, unit_id + '.pkl')
+
+    def _write_tmp(self, unit_id, obj):
+        # Write to a temporary file first, which is then moved into place,
+        # so that no process ever sees a partially written file
+        tmp_path = os.path.join(self.root, 'tmp', '{}.{}.{}'.format(unit_id, socket.gethostname(), os.getpid()))
+        with open(tmp_path, 'wb') as tmpfile:
+            pickle.dump(obj, tmpfile, protocol=pickle.HIGHEST_PROTOCOL)
+        return tmp_path
+
+    def _write(self, state, unit_id, obj):
+        os.replace(self._write_tmp(unit_id, obj), self._path(state, unit_id))
+
+    def _read(self, state, unit_id):
+        with open(self._path(state, unit_id), 'rb') as unitfile:
+            return pickle.load(unitfile)
+
+    def _list(self, state):
+        return sorted(name[:-4] for name in os.listdir(os.path.join(self.root, state)) if name.endswith('.pkl'))
+
+    def submit(self, job, arg, unit_id, cwd=None, path=None):
+        """
+        Queue one work unit calling `job` (`module:function`) with `arg`,
+        run from the directory `cwd` (default: the current directory),
+        importing the module from the directories `path` (default: `cwd`)
+        """
+        cwd = cwd or os.getcwd()
+        unit = {'job': job, 'arg': arg, 'cwd': cwd, 'path': list(path or [cwd])}
+        self._write('pending', unit_id, unit)
+        return unit_id
+
+    def claim(self):
+        """
+        Claim the next pending unit, returning (unit_id, unit),
+        or None if there is nothing left to claim
+        """
+        for unit_id in self._list('pending'):
+            try:
+                # record the claim time for stale claim detection before the
+                # unit appears in claimed/, so that it never shows up there
+                # with the time it was submitted or requeued
+                os.utime(self._path('pending', unit_id))
+                # only one worker can rename a given file,
+                # the others get an error and move on to the next unit
+                os.rename(self._path('pending', unit_id), self._path('claimed', unit_id))
+            except OSError:
+                continue
+            return unit_id, self._read('claimed', unit_id)
+        return None
+
+    def complete(self, unit_id, result):
+        """
+        Store the result of a claimed unit and mark it done,
+        returning False if the unit was already finished (see `_finish`)
+        """
+        return self._finish('done', unit_id, result)
+
+    def fail(self, unit_id, error):
+        """
+        Store the error of a claimed unit and mark it failed,
+        returning False if the unit was already finished (see `_finish`)
+        """
+        return self._finish('failed', unit_id, error)
+
+    def _finish(self, state, unit_id, result):
+        """
+        Store the result of a unit and move it to `state`. A slow worker's
+        claim may have been requeued and run again by another worker, so
+        only the first result of a unit is kept, and the claim or the
+        requeued copy of the unit may be gone or still pending.
+        """
+        tmp_path = self._write_tmp(unit_id, result)
+        try:
+            # linking fails if the result exists, so the first writer wins
+            os.link(tmp_path, self._path('results', unit_id))
+        except FileExistsError:
+            return False
+        finally:
+            os.remove(tmp_path)
+        try:
+            os.rename(self._path('claimed', unit_id), self._path(state, unit_id))
+        except OSError:
+            # the claim was requeued, the unit is marked with its result only
+            self._write(state, unit_id, None)
+        # a requeued copy that was not claimed again is not run twice
+        try:
+            os.remove(self._path('pending', unit_id))
+        except OSError:
+            pass
+        return True
+
+    def requeue_stale(self, timeout):
+        """
+        Move units claimed more than `timeout` seconds ago back to pending,
+        so that the work of a crashed worker is picked up again
+        """
+        requeued = []
+        now = time.time()
+        for unit_id in self._list('claimed'):
+            try:
+                if now - os.path.getmtime(self._path('claimed', unit_id)) < timeout:
+                    continue
+                os.rename(self._path('claimed', unit_id), self._path('pending', unit_id))
+            except OSError:
+                # the unit was completed or requeued in the meantime
+                continue
+            requeued.append(unit_id)
+        return requeued
+
+    def status(self):
+        """
+        Return the number of units in each state
+        """
+        return {state: len(self._list(state)) for state in ('pending', 'claimed', 'done', 'failed')}
+
+    def result(self, unit_id):
+        """
+        Return the result of a done unit, raising an error for a failed unit
+        """
+        if os.path.exists(self._path('failed', unit_id)):
+            raise RuntimeError('Work unit {} failed:\n{}'.format(unit_id, self._read('results', unit_id)))
+        return self._read('results', unit_id)
+
+    def finished(self, unit_ids):
+        """
+        Return True once every unit is done or failed
+        """
+        finished = set(self._list('done')) | set(self._list('failed'))
+        return all(unit_id in finished for unit_id in unit_ids)
+
+    def clear(self, unit_ids):
+        """
+        Remove the files of finished units
+        """
+        for unit_id in unit_ids:
+            for state in ('done', 'failed', 'results'):
+                if os.path.exists(self._path(state, unit_id)):
+                    os.remove(self._path(state, unit_id))
+
+
+def run_unit(unit):
+    """
+    Import the job of a unit and call it with the unit's argument
+    """
+    module_name, func_name = unit['job'].split(':')
+    for directory in reversed(unit.get('path', [unit['cwd']])):
+        if directory not in sys.path:
+            sys.path.insert(0, directory)
+    func = getattr(importlib.import_module(module_name), func_name)
+    # jobs run in the coordinator's directory, so that relative paths
+    # resolve the same on every node, and the worker's own directory is
+    # restored afterwards, since it may be the coordinator itself
+    cwd = os.getcwd()
+    os.chdir(unit['cwd'])
+    try:
+        return func(unit['arg'])
+    finally:
+        os.chdir(cwd)
+
+
+def work_one(queue):
+    """
+    Claim and process a single unit, returning False if none was pending
+    """
+    claimed = queue.claim()
+    if claimed is None:
+        return False
+    unit_id, unit = claimed
+    try:
+        result = run_unit(unit)
+    except Exception:
+        queue.fail(unit_id, traceback.format_exc())
+    else:
+        queue.complete(unit_id, result)
+    return True
+
+
+def work(root, wait=False, poll=5, stale=DEFAULT_STALE):
+    """
+    Process units of the queue at `root` until none are pending,
+    or forever if `wait` is set.
+    Claims older than `stale` seconds are requeued while polling.
+    """
+    queue = WorkQueue(root)
+    processed = 0
+    while True:
+        if work_one(queue):
+            processed += 1
+            continue
+        if stale:
+            if queue.requeue_stale(stale):
+                continue
+        if not wait:
+            return processed
+        time.sleep(poll)
+
+
+def start_workers(root, n, stale=DEFAULT_STALE):
+    """
+    Start `n` local worker processes on the queue at `root`,
+    which exit once no units are pending
+    """
+    workers = [multiprocessing.Process(target=work, args=(root, False, 5, stale)) for i in range(n)]
+    for worker in workers:
+        worker.start()
+    return workers
+
+
+def run_jobs(root, job, args, workers=0, poll=1, stale=DEFAULT_STALE, cwd=None, path=None):
+    """
+    Queue one unit per argument, process them with `workers` local processes
+    plus any workers running on other nodes, and return the results in order.
+    The calling process works on the queue too until no units are pending,
+    then waits for the units claimed by other workers, requeueing the
+    claims older than `stale` seconds of workers that died.
+    The job's module is imported from the directories `path`.
+    """
+    queue = WorkQueue(root)
+    # unit names sort in submission order and are unique across coordinators
+    prefix = '{}-{}-{}'.format(int(time.time()), socket.gethostname(), os.getpid())
+    unit_ids = [
+        queue.submit(job, arg, '{}-{:06d}'.format(prefix, i), cwd, path)
+        for i, arg in enumerate(args)
+    ]
+    local = start_workers(root, workers, stale)
+    while not queue.finished(unit_ids):
+        if not work_one(queue):
+            if stale:
+                queue.requeue_stale(stale)
+            time.sleep(poll)
+    for worker in local:
+        worker.join()
+    # merge the per-unit results
+    results = [queue.result(unit_id) for unit_id in unit_ids]
+    queue.clear(unit_ids)
+    return results
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(
+        description='Process the work units of a queue directory on a shared filesystem'
+    )
+    parser.add_argument('command', choices=['worker', 'status', 'requeue'], help='Run a worker, print the queue status, or requeue stale claims')
+    parser.add_argument('queue', type=str, help='The path to the queue directory')
+    parser.add_argument('--processes', type=int, default=1, help='The number of worker processes to run on this node')
+    parser.add_argument('--wait', action='store_true', help='Keep polling for new units instead of exiting once the queue is empty')
+    parser.add_argument('--poll', type=float, default=5, help='Seconds between polls of an empty queue')
+    parser.add_argument('--stale', type=float, default=DEFAULT_STALE, help='Requeue units claimed more than this many seconds ago')
+    args = parser.parse_args()
+    if args.command == 'status':
+        print(WorkQueue(args.queue).status())
+    elif args.command == 'requeue':
+        print('Requeued {} units'.format(len(WorkQueue(args.queue).requeue_stale(args.stale))))
+    else:
+        workers = [
+            multiprocessing.Process(target=work, args=(args.queue, args.wait, args.poll, args.stale))
+            for i in range(args.processes)
+        ]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()